@@ -0,0 +1,255 @@
+import threading
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Any
+
+import numpy as np
+
+from .config import settings
+
+SENSOR_READINGS_KEY = "sensor_readings"
+
+# Размер блока для векторизованного расчета EWMA: (1 - alpha) ** -block не должно переполниться
+_EWMA_BLOCK = 128
+
+
+@dataclass
+class AnomalyReport:
+    flagged_indices: List[int]
+    detectors: List[str]
+    baseline_mean: Optional[float]
+    baseline_std: Optional[float]
+    details: Dict[str, List[int]] = field(default_factory=dict)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "flagged_indices": self.flagged_indices,
+            "detectors": self.detectors,
+            "baseline_mean": self.baseline_mean,
+            "baseline_std": self.baseline_std,
+            "details": self.details,
+        }
+
+
+class PointState:
+    """Скользящее состояние одной контрольной точки.
+
+    Окно последних показаний хранится в кольцевом буфере с накопленными суммами,
+    поэтому обновление стоит O(1) на показание независимо от размера окна.
+    """
+
+    def __init__(self, window: int):
+        self.lock = threading.Lock()
+        self.buffer = np.zeros(window)
+        self.position = 0
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.ewma: Optional[float] = None
+        self.cusum_pos = 0.0
+        self.cusum_neg = 0.0
+
+    def copy(self) -> "PointState":
+        state = PointState(self.window)
+        state.buffer[:] = self.buffer
+        state.position, state.count = self.position, self.count
+        state.total, state.total_sq = self.total, self.total_sq
+        state.ewma, state.cusum_pos, state.cusum_neg = self.ewma, self.cusum_pos, self.cusum_neg
+        return state
+
+    @property
+    def window(self) -> int:
+        return self.buffer.shape[0]
+
+    def baseline(self):
+        if self.count == 0:
+            return None, None
+        mean = self.total / self.count
+        variance = max(self.total_sq / self.count - mean * mean, 0.0)
+        return mean, float(np.sqrt(variance))
+
+    def push(self, readings: np.ndarray) -> None:
+        # Если массив длиннее окна, в буфер попадает только его хвост
+        if readings.shape[0] > self.window:
+            readings = readings[-self.window:]
+        n = readings.shape[0]
+        idx = (self.position + np.arange(n)) % self.window
+
+        # Пока буфер не заполнен, position == count, поэтому занятые ячейки - это idx < count
+        evicted = self.buffer[idx[idx < self.count]]
+
+        self.total += float(readings.sum() - evicted.sum())
+        self.total_sq += float((readings * readings).sum() - (evicted * evicted).sum())
+        self.buffer[idx] = readings
+        self.position = (self.position + n) % self.window
+        self.count = min(self.count + n, self.window)
+
+
+def _ewma(readings: np.ndarray, alpha: float, initial: float) -> np.ndarray:
+    """Векторизованный EWMA: e_t = (1 - alpha) * e_{t-1} + alpha * x_t."""
+    decay = 1.0 - alpha
+    result = np.empty_like(readings)
+    previous = initial
+    for start in range(0, readings.shape[0], _EWMA_BLOCK):
+        block = readings[start:start + _EWMA_BLOCK]
+        k = np.arange(1, block.shape[0] + 1)
+        scale = decay ** k
+        values = scale * (previous + alpha * np.cumsum(block / scale))
+        result[start:start + block.shape[0]] = values
+        previous = values[-1]
+    return result
+
+
+def _cusum(deviations: np.ndarray, initial: float) -> np.ndarray:
+    """Векторизованная рекурсия S_t = max(0, S_{t-1} + y_t) через накопленный минимум."""
+    cumulative = np.cumsum(deviations)
+    return cumulative - np.minimum(-initial, np.minimum.accumulate(cumulative))
+
+
+@dataclass
+class Observation:
+    """Проверка массива показаний: отчет и новое состояние точки.
+
+    Состояние меняет только apply() - после того как результат контроля сохранен,
+    чтобы отклоненная вставка или повтор запроса клиента не сдвигали базовую линию.
+    after - частная копия состояния после массива, база для проверки следующего массива пакета.
+    """
+    state: PointState
+    values: np.ndarray
+    ewma: float
+    cusum_pos: float
+    cusum_neg: float
+    report: Optional[AnomalyReport]
+    after: PointState
+
+    def apply(self) -> None:
+        with self.state.lock:
+            self.state.ewma = self.ewma
+            self.state.cusum_pos = self.cusum_pos
+            self.state.cusum_neg = self.cusum_neg
+            self.state.push(self.values)
+
+
+class AnomalyDetector:
+    """Потоковый детектор выбросов в sensor_readings по контрольным точкам.
+
+    Контрольные границы берутся из состояния до прихода массива, затем состояние
+    обновляется этим массивом.
+    """
+
+    def __init__(
+        self,
+        window: int = settings.ANOMALY_WINDOW,
+        warmup: int = settings.ANOMALY_WARMUP,
+        sigma: float = settings.ANOMALY_SIGMA,
+        ewma_alpha: float = settings.ANOMALY_EWMA_ALPHA,
+        ewma_limit: float = settings.ANOMALY_EWMA_LIMIT,
+        cusum_k: float = settings.ANOMALY_CUSUM_K,
+        cusum_h: float = settings.ANOMALY_CUSUM_H,
+    ):
+        self.window = window
+        self.warmup = warmup
+        self.sigma = sigma
+        self.ewma_alpha = ewma_alpha
+        self.ewma_limit = ewma_limit
+        self.cusum_k = cusum_k
+        self.cusum_h = cusum_h
+        self._states: Dict[Any, PointState] = {}
+        self._states_lock = threading.Lock()
+
+    def _state(self, key: Any) -> PointState:
+        state = self._states.get(key)
+        if state is None:
+            with self._states_lock:
+                state = self._states.setdefault(key, PointState(self.window))
+        return state
+
+    def check(
+        self,
+        inspection_point_id: Optional[int],
+        readings: Any,
+        previous: Optional[Observation] = None
+    ) -> Optional[Observation]:
+        """Проверяет массив показаний по текущему состоянию точки, не меняя его.
+
+        previous - еще не примененная проверка предыдущего массива той же точки (пакет результатов
+        в порядке inspection_time). None - в массиве нет числовых показаний.
+        """
+        try:
+            values = np.asarray(readings, dtype=float).ravel()
+        except (TypeError, ValueError):
+            return None
+        positions = np.flatnonzero(np.isfinite(values))
+        values = values[positions]
+        if values.size == 0:
+            return None
+
+        live = self._state(inspection_point_id)
+        if previous is not None:
+            state = previous.after
+        else:
+            with live.lock:
+                state = live.copy()
+        # Проверка идет по частной копии состояния; она же становится состоянием после массива
+        mean, std = state.baseline()
+        ready = state.count >= self.warmup and std > 0
+        details: Dict[str, List[int]] = {}
+        cusum_pos_end, cusum_neg_end = state.cusum_pos, state.cusum_neg
+
+        if ready:
+            z = (values - mean) / std
+
+            shewhart = np.abs(z) > self.sigma
+
+            ewma = _ewma(values, self.ewma_alpha, state.ewma if state.ewma is not None else mean)
+            ewma_sigma = std * np.sqrt(self.ewma_alpha / (2.0 - self.ewma_alpha))
+            ewma_flags = np.abs(ewma - mean) > self.ewma_limit * ewma_sigma
+
+            cusum_pos = _cusum(z - self.cusum_k, state.cusum_pos)
+            cusum_neg = _cusum(-z - self.cusum_k, state.cusum_neg)
+            cusum_flags = (cusum_pos > self.cusum_h) | (cusum_neg > self.cusum_h)
+
+            for name, flags in (("shewhart", shewhart), ("ewma", ewma_flags), ("cusum", cusum_flags)):
+                if flags.any():
+                    details[name] = positions[flags].tolist()
+
+            ewma_end = float(ewma[-1])
+            # После сигнала CUSUM сбрасывается, чтобы не повторять тревогу бесконечно
+            cusum_pos_end = 0.0 if cusum_flags.any() else float(cusum_pos[-1])
+            cusum_neg_end = 0.0 if cusum_flags.any() else float(cusum_neg[-1])
+        else:
+            ewma_end = float(_ewma(values, self.ewma_alpha, state.ewma if state.ewma is not None else values[0])[-1])
+
+        state.ewma, state.cusum_pos, state.cusum_neg = ewma_end, cusum_pos_end, cusum_neg_end
+        state.push(values)
+
+        report = None
+        if details:
+            report = AnomalyReport(
+                flagged_indices=sorted(set().union(*details.values())),
+                detectors=list(details),
+                baseline_mean=mean,
+                baseline_std=std,
+                details=details,
+            )
+        return Observation(live, values, ewma_end, cusum_pos_end, cusum_neg_end, report, state)
+
+    def observe(self, inspection_point_id: Optional[int], readings: Any) -> Optional[AnomalyReport]:
+        """Проверяет массив показаний и сразу обновляет состояние точки.
+
+        Возвращает отчет только если найдены выбросы.
+        """
+        observation = self.check(inspection_point_id, readings)
+        if observation is None:
+            return None
+        observation.apply()
+        return observation.report
+
+    def reset(self, inspection_point_id: Optional[int] = None) -> None:
+        with self._states_lock:
+            if inspection_point_id is None:
+                self._states.clear()
+            else:
+                self._states.pop(inspection_point_id, None)
+
+
+detector = AnomalyDetector()
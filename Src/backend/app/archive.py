@@ -0,0 +1,392 @@
+import bisect
+import heapq
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Optional, List, Dict, Any, Iterable
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from sqlalchemy import select, delete, exists, and_, func, text
+from sqlalchemy.orm import Session
+
+from . import models
+from .config import settings
+from .database import DEFAULT_PLANT, plant_of
+from .utils import TTLCache, as_utc
+
+logger = logging.getLogger(__name__)
+
+CLOSED_BATCH_STATUS = "отгружено"
+
+# Причина в deleted_records для строк, перенесенных в архив
+ARCHIVED_REASON = "archived"
+
+# Архивируемые таблицы: колонка времени для индекса диапазонов и JSON-колонки
+_TABLES = {
+    "production_batches": {"time": "updated_at", "json": ("metadata",)},
+    "inspection_results": {"time": "inspection_time", "json": ("measurement_data",)},
+    "defect_details": {"time": "inspection_time", "json": ("defect_location",)},
+    "anomaly_alerts": {"time": "inspection_time", "json": ("detectors", "details")},
+}
+
+
+@dataclass
+class ArchiveFile:
+    table: str
+    path: str
+    min_id: int
+    max_id: int
+    min_batch_id: int
+    max_batch_id: int
+    min_time: Optional[datetime]
+    max_time: Optional[datetime]
+
+
+class ArchiveIndex:
+    """Индекс диапазонов id, batch_id и времени по файлам архива.
+
+    Строится по метаданным parquet-файлов без чтения данных и обновляется при записи.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._files: Dict[str, List[ArchiveFile]] = {name: [] for name in _TABLES}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            for name in _TABLES:
+                directory = os.path.join(self.root, name)
+                if not os.path.isdir(directory):
+                    continue
+                for filename in os.listdir(directory):
+                    if filename.endswith(".parquet"):
+                        self._insert(_read_file_info(name, os.path.join(directory, filename)))
+            self._loaded = True
+
+    def _insert(self, info: ArchiveFile) -> None:
+        files = self._files[info.table]
+        files[:] = [f for f in files if f.path != info.path]
+        bisect.insort(files, info, key=lambda f: f.min_id)
+
+    def add(self, info: ArchiveFile) -> None:
+        self._ensure_loaded()
+        with self._lock:
+            self._insert(info)
+
+    def files(self, table: str) -> List[ArchiveFile]:
+        self._ensure_loaded()
+        return list(self._files[table])
+
+    def find_by_id(self, table: str, record_id: int) -> List[ArchiveFile]:
+        return [f for f in self.files(table) if f.min_id <= record_id <= f.max_id]
+
+    def find_by_batch(self, table: str, batch_id: int) -> List[ArchiveFile]:
+        return [f for f in self.files(table) if f.min_batch_id <= batch_id <= f.max_batch_id]
+
+    def find_by_time(self, table: str, time_from: Optional[datetime], time_to: Optional[datetime]) -> List[ArchiveFile]:
+        result = []
+        for f in self.files(table):
+            if f.min_time is None:
+                continue
+            if time_to is not None and f.min_time >= time_to:
+                continue
+            if time_from is not None and f.max_time < time_from:
+                continue
+            result.append(f)
+        return result
+
+
+def _read_file_info(table: str, path: str) -> ArchiveFile:
+    meta = pq.read_schema(path).metadata or {}
+    info = json.loads(meta.get(b"archive", b"{}"))
+    return ArchiveFile(
+        table=table,
+        path=path,
+        min_id=info["min_id"],
+        max_id=info["max_id"],
+        min_batch_id=info["min_batch_id"],
+        max_batch_id=info["max_batch_id"],
+        min_time=datetime.fromisoformat(info["min_time"]) if info.get("min_time") else None,
+        max_time=datetime.fromisoformat(info["max_time"]) if info.get("max_time") else None,
+    )
+
+
+index = ArchiveIndex(settings.ARCHIVE_DIR)
+_tables_cache = TTLCache(maxsize=settings.ARCHIVE_CACHE_SIZE, ttl=settings.ARCHIVE_CACHE_TTL)
+
+
+def has_archive(table: str) -> bool:
+    return bool(index.files(table))
+
+
+def _to_arrow_value(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _write_table(name: str, rows: List[Dict[str, Any]], batch_ids: List[int]) -> Optional[ArchiveFile]:
+    if not rows:
+        return None
+    spec = _TABLES[name]
+    for row in rows:
+        for column in spec["json"]:
+            if row.get(column) is not None:
+                row[column] = json.dumps(row[column], ensure_ascii=False)
+        for column, value in row.items():
+            row[column] = _to_arrow_value(value)
+
+    times = [row[spec["time"]] for row in rows if row.get(spec["time"]) is not None]
+    info = {
+        "min_id": min(row["id"] for row in rows),
+        "max_id": max(row["id"] for row in rows),
+        "min_batch_id": min(batch_ids),
+        "max_batch_id": max(batch_ids),
+        "min_time": min(times).isoformat() if times else None,
+        "max_time": max(times).isoformat() if times else None,
+    }
+
+    table = pa.Table.from_pylist(rows)
+    table = table.replace_schema_metadata({"archive": json.dumps(info)})
+
+    directory = os.path.join(settings.ARCHIVE_DIR, name)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}_{info['min_batch_id']}_{info['max_batch_id']}.parquet")
+    tmp_path = path + ".tmp"
+    pq.write_table(table, tmp_path, compression=settings.ARCHIVE_COMPRESSION)
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return _read_file_info(name, path)
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        logger.exception("Failed to remove archive file %s", path)
+
+
+def _select_rows(db: Session, table, where) -> List[Dict[str, Any]]:
+    return [dict(row._mapping) for row in db.execute(select(table).where(where).order_by(table.c.id))]
+
+
+def _archivable(older_than_days: int) -> list:
+    """Условия отбора партий для архивации: отгружены и без контроля новее cutoff"""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    batches = models.ProductionBatch.__table__
+    results = models.InspectionResult.__table__
+    recent_inspection = exists().where(and_(results.c.batch_id == batches.c.id, results.c.inspection_time >= cutoff))
+    return [batches.c.status == CLOSED_BATCH_STATUS, batches.c.updated_at < cutoff, ~recent_inspection]
+
+
+def count_archivable(db: Session, older_than_days: int = settings.ARCHIVE_AFTER_DAYS) -> int:
+    batches = models.ProductionBatch.__table__
+    return db.scalar(select(func.count()).select_from(batches).where(*_archivable(older_than_days)))
+
+
+def archive_closed_batches(
+    db: Session,
+    older_than_days: int = settings.ARCHIVE_AFTER_DAYS,
+    chunk_size: int = settings.ARCHIVE_CHUNK_SIZE,
+    max_chunks: Optional[int] = None
+) -> Dict[str, int]:
+    """Переносит отгруженные партии старше cutoff и их данные контроля в parquet-файлы.
+
+    Каждая порция партий архивируется в отдельной транзакции: файлы записываются
+    до удаления строк, поэтому сбой посреди порции не теряет данные; при откате
+    файлы порции удаляются, а строки, оставшиеся в архиве после падения процесса
+    до commit, при чтении перекрываются живыми.
+    """
+    batches = models.ProductionBatch.__table__
+    results = models.InspectionResult.__table__
+    defects = models.DefectDetail.__table__
+    alerts = models.AnomalyAlert.__table__
+
+    archivable = _archivable(older_than_days)
+    totals = {name: 0 for name in _TABLES}
+    chunks = 0
+
+    while max_chunks is None or chunks < max_chunks:
+        batch_ids = db.execute(
+            select(batches.c.id)
+            .where(*archivable)
+            .order_by(batches.c.id)
+            .limit(chunk_size)
+            .with_for_update(skip_locked=True)
+        ).scalars().all()
+        if not batch_ids:
+            break
+
+        result_ids = select(results.c.id).where(results.c.batch_id.in_(batch_ids))
+        rows = {
+            "production_batches": _select_rows(db, batches, batches.c.id.in_(batch_ids)),
+            "inspection_results": _select_rows(db, results, results.c.batch_id.in_(batch_ids)),
+            "defect_details": _select_rows(db, defects, defects.c.inspection_result_id.in_(result_ids)),
+            "anomaly_alerts": _select_rows(db, alerts, alerts.c.inspection_result_id.in_(result_ids)),
+        }
+
+        written = []
+        try:
+            for name, table_rows in rows.items():
+                written.append(_write_table(name, table_rows, batch_ids))
+            # Дочерние строки удаляются каскадом; для синхронизации удаление помечается как архивирование
+            db.execute(text(f"SET LOCAL app.delete_reason = '{ARCHIVED_REASON}'"))
+            db.execute(delete(batches).where(batches.c.id.in_(batch_ids)))
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Строки остались в БД: файлы порции убираются, чтобы данные не были и в архиве
+            for info in written:
+                if info is not None:
+                    _remove_file(info.path)
+            raise
+
+        for info in written:
+            if info is not None:
+                index.add(info)
+        for name, table_rows in rows.items():
+            totals[name] += len(table_rows)
+        chunks += 1
+        logger.info("Archived %s batches (%s..%s)", len(batch_ids), batch_ids[0], batch_ids[-1])
+
+    return totals
+
+
+def _load(path: str) -> pa.Table:
+    return _tables_cache.get_or_set(path, lambda: pq.read_table(path))
+
+
+def _rows(name: str, files: Iterable[ArchiveFile], mask_fn) -> List[Dict[str, Any]]:
+    spec = _TABLES[name]
+    result = []
+    for info in files:
+        table = _load(info.path)
+        filtered = table.filter(mask_fn(table))
+        for row in filtered.to_pylist():
+            for column in spec["json"]:
+                if row.get(column) is not None:
+                    row[column] = json.loads(row[column])
+            result.append(row)
+    return result
+
+
+def get_archived_batch(db: Session, batch_id: int) -> Optional[Dict[str, Any]]:
+    # Холодный архив ведется только для центральной базы: id других заводов с ним не пересекаются
+    if plant_of(db) != DEFAULT_PLANT:
+        return None
+    rows = _rows(
+        "production_batches",
+        index.find_by_id("production_batches", batch_id),
+        lambda t: pc.equal(t["id"], batch_id)
+    )
+    if not rows:
+        return None
+    batch = rows[0]
+    batch["product_type"] = db.query(models.ProductType).filter(
+        models.ProductType.id == batch["product_type_id"]
+    ).first()
+    return batch
+
+
+def iter_archived(name: str, columns: List[str]) -> Iterable[Dict[str, Any]]:
+    """Все строки архивной таблицы (только columns) для полного прохода, например перестройки индекса.
+
+    Файлы читаются по одному мимо кэша. Партия архивируется целиком одной порцией, поэтому
+    строки партии лежат в одном файле; внутри файла строки упорядочены по batch_id (партии - по id).
+    """
+    json_columns = [column for column in _TABLES[name]["json"] if column in columns]
+    order = "batch_id" if "batch_id" in columns else "id"
+    for info in index.files(name):
+        for row in pq.read_table(info.path, columns=columns).sort_by(order).to_pylist():
+            for column in json_columns:
+                if row.get(column) is not None:
+                    row[column] = json.loads(row[column])
+            yield row
+
+
+def _live_ids(db: Session, rows: List[Dict[str, Any]]) -> set:
+    if not rows:
+        return set()
+    results = models.InspectionResult.__table__
+    times = [as_utc(row["inspection_time"]) for row in rows]
+    return set(db.execute(
+        select(results.c.id).where(
+            results.c.id.in_([row["id"] for row in rows]),
+            results.c.inspection_time.between(min(times), max(times))
+        )
+    ).scalars())
+
+
+def get_archived_inspections(
+    db: Session,
+    skip: int = 0,
+    limit: int = 100,
+    batch_id: Optional[int] = None,
+    verdict: Optional[str] = None,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None
+) -> List[Dict[str, Any]]:
+    if plant_of(db) != DEFAULT_PLANT:
+        return []
+    time_from, time_to = as_utc(time_from), as_utc(time_to)
+    if batch_id:
+        files = index.find_by_batch("inspection_results", batch_id)
+    else:
+        files = index.find_by_time("inspection_results", time_from, time_to)
+
+    def mask(t: pa.Table):
+        time_type = t.schema.field("inspection_time").type
+        conditions = [pc.is_valid(t["id"])]
+        if batch_id:
+            conditions.append(pc.equal(t["batch_id"], batch_id))
+        if verdict:
+            conditions.append(pc.equal(t["overall_verdict"], verdict))
+        if time_from:
+            conditions.append(pc.greater_equal(t["inspection_time"], pa.scalar(time_from, time_type)))
+        if time_to:
+            conditions.append(pc.less(t["inspection_time"], pa.scalar(time_to, time_type)))
+        result = conditions[0]
+        for condition in conditions[1:]:
+            result = pc.and_(result, condition)
+        return result
+
+    # Файлы идут по возрастанию min_id: как только набраны skip + limit строк и следующий файл
+    # начинается с большего id, чем последняя из них, остальные файлы не читаются
+    need = skip + limit
+    candidates: List[Dict[str, Any]] = []
+    for info in files:
+        if len(candidates) >= need and info.min_id > candidates[-1]["id"]:
+            break
+        table = _load(info.path)
+        filtered = table.filter(mask(table))
+        if filtered.num_rows:
+            candidates.extend(filtered.sort_by("id").slice(0, need).to_pylist())
+            candidates = heapq.nsmallest(need, candidates, key=lambda row: row["id"])
+
+    # Строки, оставшиеся в БД после сбоя между записью файла и удалением, отдает живая таблица
+    live = _live_ids(db, candidates)
+    rows = [row for row in candidates if row["id"] not in live][skip:skip + limit]
+    for row in rows:
+        for column in _TABLES["inspection_results"]["json"]:
+            if row.get(column) is not None:
+                row[column] = json.loads(row[column])
+
+    batches: Dict[int, Optional[Dict[str, Any]]] = {}
+    for row in rows:
+        if row["batch_id"] not in batches:
+            batches[row["batch_id"]] = get_archived_batch(db, row["batch_id"])
+        row["batch"] = batches[row["batch_id"]]
+    return rows
@@ -0,0 +1,316 @@
+import contextvars
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import inspect, insert
+from sqlalchemy.orm import Session
+
+from . import models, tracing
+from .config import settings
+from .database import ReportingSessionLocal, DEFAULT_PLANT, plant_of
+from .utils import as_utc
+
+logger = logging.getLogger(__name__)
+
+UPDATE = "update"
+DELETE = "delete"
+
+BUFFERED = "buffered"
+FLUSH = "flush"
+TRANSACTIONAL = "transactional"
+
+# Значения этих колонок в журнал не попадают, фиксируется только факт изменения
+REDACTED_COLUMNS = {"hashed_password"}
+REDACTED = "***"
+
+# Пользователь текущего запроса (выставляет get_current_user, копируется и в пул потоков)
+_actor: contextvars.ContextVar[Optional[Tuple[int, str]]] = contextvars.ContextVar("audit_actor", default=None)
+
+
+def set_actor(user_id: int, username: str) -> None:
+    _actor.set((user_id, username))
+
+
+def durability(entity: str) -> Optional[str]:
+    """Гарантия записи для таблицы; None - изменения таблицы не журналируются"""
+    if not settings.AUDIT_ENABLED:
+        return None
+    return settings.AUDIT_ENTITIES.get(entity)
+
+
+def _json_value(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        # Строкой, чтобы не терять точность DECIMAL
+        return str(value)
+    return value
+
+
+def _entry(entity: str, entity_id: int, action: str, changes: Dict[str, Any]) -> Dict[str, Any]:
+    actor = _actor.get()
+    span = tracing.current_span()
+    return {
+        "entity": entity,
+        "entity_id": entity_id,
+        "action": action,
+        "changes": changes,
+        "actor_id": actor[0] if actor else None,
+        "actor": actor[1] if actor else None,
+        "trace_id": span.trace_id if span else None,
+        "changed_at": datetime.now(timezone.utc),
+    }
+
+
+def _value(column: str, value: Any) -> Any:
+    return REDACTED if column in REDACTED_COLUMNS else _json_value(value)
+
+
+def update_entry(entity: str, entity_id: int, old: Dict[str, Any], new: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Запись об изменении по значениям колонок до и после; None, если значения не изменились"""
+    changes = {
+        column: {"old": _value(column, old[column]), "new": _value(column, new[column])}
+        for column in old
+        if old[column] != new[column]
+    }
+    return _entry(entity, entity_id, UPDATE, changes) if changes else None
+
+
+def delete_entry(entity: str, row: Dict[str, Any]) -> Dict[str, Any]:
+    """Запись об удалении с полным снимком строки"""
+    # Имена колонок из RETURNING - подкласс str, а orjson принимает ключами только str
+    return _entry(entity, row["id"], DELETE, {str(column): {"old": _value(column, value)} for column, value in row.items()})
+
+
+def column_values(obj: Any, columns: Iterable[str]) -> Dict[str, Any]:
+    """Значения колонок таблицы из ORM-объекта (атрибут модели может называться иначе, чем колонка)"""
+    mapper = inspect(type(obj))
+    table = mapper.local_table
+    return {column: getattr(obj, mapper.get_property_by_column(table.c[column]).key) for column in columns}
+
+
+def _write_file(entries: List[Dict[str, Any]]) -> None:
+    os.makedirs(os.path.dirname(settings.AUDIT_FILE), exist_ok=True)
+    with open(settings.AUDIT_FILE, "a", encoding="utf-8") as f:
+        f.writelines(json.dumps(dict(entry, changed_at=entry["changed_at"].isoformat()), ensure_ascii=False) + "\n" for entry in entries)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_database(entries: List[Dict[str, Any]]) -> None:
+    db = ReportingSessionLocal()
+    try:
+        db.execute(insert(models.AuditLog), entries)
+        db.commit()
+    finally:
+        db.close()
+
+
+class AuditWriter:
+    """Буфер записей журнала и фоновая пакетная запись в приемник.
+
+    Записи сбрасываются раз в AUDIT_FLUSH_INTERVAL или при накоплении AUDIT_BATCH_SIZE;
+    ожидающие подтверждения (flush) будят запись сразу и сбрасываются одним пакетом.
+    При ошибке приемника пакет возвращается в начало буфера и повторяется позже.
+    """
+
+    def __init__(self):
+        self._pending: List[Dict[str, Any]] = []
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._submitted = 0
+        self._flushed = 0
+        self._stopping = False
+        self._urgent = False
+        self._thread = None
+        self.failures = 0
+
+    def _running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def submit(self, entries: List[Dict[str, Any]], wait: bool = False) -> None:
+        with self._condition:
+            while len(self._pending) >= settings.AUDIT_BUFFER_SIZE and self._running():
+                self._condition.wait(settings.AUDIT_FLUSH_INTERVAL)
+            self._pending.extend(entries)
+            self._submitted += len(entries)
+            target = self._submitted
+            if wait:
+                self._urgent = True
+            if wait or len(self._pending) >= settings.AUDIT_BATCH_SIZE:
+                self._condition.notify_all()
+        if not self._running():
+            # Фоновая запись не запущена (скрипты, обслуживание): пишем сразу
+            self.flush()
+            return
+        if not wait:
+            return
+
+        deadline = time.monotonic() + settings.AUDIT_FLUSH_TIMEOUT
+        with self._condition:
+            while self._flushed < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning("Audit entries were not flushed within %.1fs, left in buffer", settings.AUDIT_FLUSH_TIMEOUT)
+                    return
+                self._condition.wait(remaining)
+
+    def flush(self) -> bool:
+        """Записывает все накопленные записи; False - приемник недоступен, записи остались в буфере"""
+        with self._flush_lock:
+            with self._condition:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return True
+            try:
+                if settings.AUDIT_SINK == "file":
+                    _write_file(batch)
+                else:
+                    _write_database(batch)
+            except Exception:
+                logger.exception("Audit flush failed, %s entries kept in buffer", len(batch))
+                with self._condition:
+                    self._pending[:0] = batch
+                    self.failures += 1
+                return False
+            with self._condition:
+                self._flushed += len(batch)
+                self._condition.notify_all()
+            return True
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                # Неполный пакет ждет интервал, если его не торопят ожидающие подтверждения
+                while not (self._stopping or self._urgent or len(self._pending) >= settings.AUDIT_BATCH_SIZE):
+                    if not self._condition.wait(settings.AUDIT_FLUSH_INTERVAL):
+                        break
+                self._urgent = False
+                if self._stopping and not self._pending:
+                    return
+            if not self.flush():
+                with self._condition:
+                    if self._stopping:
+                        return
+                    self._condition.wait(settings.AUDIT_FLUSH_INTERVAL)
+
+    def start(self) -> None:
+        if not settings.AUDIT_ENABLED or self._running():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                "pending": len(self._pending),
+                "submitted": self._submitted,
+                "flushed": self._flushed,
+                "failures": self.failures,
+            }
+
+
+writer = AuditWriter()
+
+
+def _in_transaction(db: Session, entity: str) -> bool:
+    # Журнал лежит в центральной базе: в той же транзакции пишутся только ее изменения
+    return (
+        durability(entity) == TRANSACTIONAL
+        and settings.AUDIT_SINK == "database"
+        and plant_of(db) == DEFAULT_PLANT
+    )
+
+
+def before_commit(db: Session, entity: str, entries: List[Dict[str, Any]]) -> None:
+    """Вызывается до commit изменения: transactional-записи пишутся в ту же транзакцию"""
+    for entry in entries:
+        entry["plant_code"] = plant_of(db)
+    if entries and _in_transaction(db, entity):
+        db.execute(insert(models.AuditLog), entries)
+
+
+def after_commit(db: Session, entity: str, entries: List[Dict[str, Any]]) -> None:
+    """Вызывается после commit: остальные записи уходят в буфер; откаченные изменения не журналируются"""
+    mode = durability(entity)
+    if not entries or mode is None or _in_transaction(db, entity):
+        return
+    # transactional для файла или базы другого завода означает ожидание записи, как flush
+    writer.submit(entries, wait=mode != BUFFERED)
+
+
+def _file_entries() -> Iterable[Dict[str, Any]]:
+    if not os.path.exists(settings.AUDIT_FILE):
+        return
+    with open(settings.AUDIT_FILE, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                entry["changed_at"] = datetime.fromisoformat(entry["changed_at"])
+                yield entry
+
+
+def query(
+    db: Session,
+    entity: Optional[str] = None,
+    entity_id: Optional[int] = None,
+    actor_id: Optional[int] = None,
+    action: Optional[str] = None,
+    plant_code: Optional[str] = None,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None,
+    skip: int = 0,
+    limit: int = 100
+) -> List[Any]:
+    """Записи журнала, новые первыми. Буфер сбрасывается заранее, чтобы были видны последние изменения"""
+    writer.flush()
+    if settings.AUDIT_SINK == "file":
+        time_from, time_to = as_utc(time_from), as_utc(time_to)
+
+        def matches(entry: Dict[str, Any]) -> bool:
+            return (
+                (entity is None or entry["entity"] == entity)
+                and (entity_id is None or entry["entity_id"] == entity_id)
+                and (actor_id is None or entry["actor_id"] == actor_id)
+                and (action is None or entry["action"] == action)
+                and (plant_code is None or entry.get("plant_code") == plant_code)
+                and (time_from is None or entry["changed_at"] >= time_from)
+                and (time_to is None or entry["changed_at"] < time_to)
+            )
+
+        newest = heapq.nlargest(skip + limit, filter(matches, _file_entries()), key=lambda entry: entry["changed_at"])
+        return newest[skip:]
+
+    log = models.AuditLog
+    q = db.query(log)
+    if entity:
+        q = q.filter(log.entity == entity)
+    if entity_id is not None:
+        q = q.filter(log.entity_id == entity_id)
+    if actor_id is not None:
+        q = q.filter(log.actor_id == actor_id)
+    if action:
+        q = q.filter(log.action == action)
+    if plant_code:
+        q = q.filter(log.plant_code == plant_code)
+    if time_from:
+        q = q.filter(log.changed_at >= time_from)
+    if time_to:
+        q = q.filter(log.changed_at < time_to)
+    return q.order_by(log.changed_at.desc(), log.id.desc()).offset(skip).limit(limit).all()
@@ -0,0 +1,65 @@
+from collections import defaultdict
+from typing import Optional, Tuple
+
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import models, schemas, crud
+from .config import settings
+from .database import plant_of
+from .utils import TTLCache, fingerprint
+
+# Ключ - (завод, batch_id, отпечаток версии партии): любое изменение партии или ее данных дает новый ключ
+_cache = TTLCache(maxsize=settings.BATCH_FULL_CACHE_SIZE, ttl=settings.BATCH_FULL_CACHE_TTL)
+
+
+def load_batch_tree(db: Session, batch_id: int) -> Optional[models.ProductionBatch]:
+    """Загружает партию со всеми результатами контроля и дефектами за три запроса.
+
+    Коллекции заполняются вручную, поэтому сериализация не вызывает ленивых загрузок.
+    """
+    batch = db.query(models.ProductionBatch).options(
+        joinedload(models.ProductionBatch.product_type)
+    ).filter(models.ProductionBatch.id == batch_id).first()
+    if batch is None:
+        return None
+
+    inspections = db.query(models.InspectionResult).options(
+        joinedload(models.InspectionResult.inspection_point)
+    ).filter(
+        models.InspectionResult.batch_id == batch_id
+    ).order_by(models.InspectionResult.inspection_time, models.InspectionResult.id).all()
+
+    defects = db.query(models.DefectDetail).join(
+        models.DefectDetail.inspection_result
+    ).options(
+        joinedload(models.DefectDetail.defect_type)
+    ).filter(
+        models.InspectionResult.batch_id == batch_id
+    ).order_by(models.DefectDetail.id).all()
+
+    by_inspection = defaultdict(list)
+    for defect in defects:
+        by_inspection[(defect.inspection_result_id, defect.inspection_time)].append(defect)
+    for inspection in inspections:
+        set_committed_value(inspection, "defect_details", by_inspection.get((inspection.id, inspection.inspection_time), []))
+    set_committed_value(batch, "inspection_results", inspections)
+    return batch
+
+
+def batch_full(db: Session, batch_id: int) -> Optional[Tuple[str, bytes]]:
+    """Возвращает (ETag, JSON) полного дерева партии; при неизменной версии - из кэша"""
+    version = crud.get_batch_version(db, batch_id)
+    if version is None:
+        return None
+
+    etag = fingerprint(version)
+    key = (plant_of(db), batch_id, etag)
+    content = _cache.get(key)
+    if content is None:
+        batch = load_batch_tree(db, batch_id)
+        if batch is None:
+            return None
+        content = schemas.ProductionBatchFull.model_validate(batch).model_dump_json().encode()
+        _cache.set(key, content)
+    return etag, content
@@ -0,0 +1,379 @@
+import codecs
+import csv
+import json
+import tempfile
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import anyio
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from . import audit, models
+from .config import settings
+from .database import plant_of
+from .utils import TTLCache
+
+CSV = "csv"
+NDJSON = "ndjson"
+CONTENT_TYPES = {
+    "text/csv": CSV,
+    "application/csv": CSV,
+    "application/x-ndjson": NDJSON,
+    "application/ndjson": NDJSON,
+    "application/jsonl": NDJSON,
+}
+DEFAULT_STATUS = "в производстве"
+STAGING_TABLE = "batch_import_staging"
+
+# Колонки промежуточной таблицы в порядке COPY
+COLUMNS = (
+    "batch_number",
+    "product_type_id",
+    "production_date",
+    "furnace_number",
+    "shift_number",
+    "total_weight_kg",
+    "total_length_m",
+    "status",
+    "quality_rating",
+    "metadata",
+)
+# Обязательные колонки обновляются всегда, остальные - только если есть в файле и ячейка не пуста
+REQUIRED_COLUMNS = ("product_type_id", "production_date")
+
+
+class ImportFormatError(ValueError):
+    """Файл нельзя разобрать целиком (кодировка, структура CSV)"""
+
+
+# Справочник видов продукции по заводам: type_code -> id
+_product_types = TTLCache(maxsize=max(1, len(settings.PLANTS)), ttl=settings.BATCH_IMPORT_LOOKUP_TTL)
+
+
+class ProductTypeLookup:
+    """Кэшированный справочник видов продукции; неизвестный код перечитывает его один раз за импорт"""
+
+    def __init__(self, db: Session):
+        self._db = db
+        self._refreshed = False
+        self._plant = plant_of(db)
+        self._codes: Dict[str, int] = _product_types.get_or_set(self._plant, self._load)
+        self._ids: Set[int] = set(self._codes.values())
+
+    def _load(self) -> Dict[str, int]:
+        return dict(self._db.query(models.ProductType.type_code, models.ProductType.id).all())
+
+    def _refresh(self) -> bool:
+        if self._refreshed:
+            return False
+        self._refreshed = True
+        self._codes = self._load()
+        self._ids = set(self._codes.values())
+        _product_types.set(self._plant, self._codes)
+        return True
+
+    def by_code(self, code: str) -> Optional[int]:
+        if code not in self._codes:
+            self._refresh()
+        return self._codes.get(code)
+
+    def exists(self, type_id: int) -> bool:
+        if type_id not in self._ids:
+            self._refresh()
+        return type_id in self._ids
+
+
+def detect_format(explicit: Optional[str], content_type: Optional[str]) -> Optional[str]:
+    if explicit:
+        return explicit if explicit in (CSV, NDJSON) else None
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    return CONTENT_TYPES.get(media_type)
+
+
+def iter_stream_lines(stream) -> Iterator[str]:
+    """Строки тела запроса для разбора в пуле потоков.
+
+    Части тела читаются из event loop по мере разбора, поэтому файл не держится в памяти целиком.
+    """
+    chunks = stream.__aiter__()
+
+    async def next_chunk() -> Optional[bytes]:
+        try:
+            return await chunks.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    try:
+        while True:
+            chunk = anyio.from_thread.run(next_chunk)
+            if chunk is None:
+                break
+            *lines, pending = (pending + decoder.decode(chunk)).split("\n")
+            for line in lines:
+                yield line + "\n"
+        pending += decoder.decode(b"", final=True)
+    except UnicodeDecodeError as e:
+        raise ImportFormatError(f"File is not valid UTF-8: {e}")
+    if pending:
+        yield pending
+
+
+def _csv_records(lines: Iterable[str]) -> Iterator[Any]:
+    reader = csv.DictReader(lines)
+    try:
+        for record in reader:
+            if None in record:
+                yield ValueError("Row has more values than the header")
+            else:
+                yield record
+    except csv.Error as e:
+        raise ImportFormatError(f"Invalid CSV at line {reader.line_num}: {e}")
+
+
+def _ndjson_records(lines: Iterable[str]) -> Iterator[Any]:
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield ValueError("Invalid JSON")
+            continue
+        yield record if isinstance(record, dict) else ValueError("Record must be a JSON object")
+
+
+def _text(record: Dict[str, Any], name: str, max_length: int) -> Optional[str]:
+    value = record.get(name)
+    if value is None:
+        return None
+    value = str(value).strip()
+    if len(value) > max_length:
+        raise ValueError(f"{name} is longer than {max_length} characters")
+    return value or None
+
+
+def _int(record: Dict[str, Any], name: str) -> Optional[int]:
+    value = record.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an integer")
+
+
+def _decimal(record: Dict[str, Any], name: str) -> Optional[Decimal]:
+    value = record.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        number = Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError(f"{name} must be a number")
+    # DECIMAL(10, 2)
+    if not number.is_finite() or abs(number) >= Decimal("1e8"):
+        raise ValueError(f"{name} is out of range")
+    return number
+
+
+def _parse_record(record: Dict[str, Any], lookup: ProductTypeLookup) -> List[Any]:
+    """Проверяет запись и возвращает значения в порядке COLUMNS; ошибки - ValueError"""
+    batch_number = _text(record, "batch_number", 100)
+    if batch_number is None:
+        raise ValueError("batch_number is required")
+
+    code = _text(record, "product_type_code", 50)
+    if code is not None:
+        product_type_id = lookup.by_code(code)
+        if product_type_id is None:
+            raise ValueError(f"Unknown product_type_code: {code}")
+    else:
+        product_type_id = _int(record, "product_type_id")
+        if product_type_id is None:
+            raise ValueError("product_type_code or product_type_id is required")
+        if not lookup.exists(product_type_id):
+            raise ValueError(f"Unknown product_type_id: {product_type_id}")
+
+    production_date = _text(record, "production_date", 10)
+    if production_date is None:
+        raise ValueError("production_date is required")
+    try:
+        production_date = date.fromisoformat(production_date)
+    except ValueError:
+        raise ValueError("production_date must be YYYY-MM-DD")
+
+    quality_rating = _int(record, "quality_rating")
+    if quality_rating is not None and not 1 <= quality_rating <= 5:
+        raise ValueError("quality_rating must be between 1 and 5")
+
+    metadata = record.get("metadata")
+    if isinstance(metadata, str):
+        metadata = metadata.strip() or None
+        if metadata is not None:
+            try:
+                metadata = json.loads(metadata)
+            except ValueError:
+                raise ValueError("metadata must be a JSON object")
+    if metadata is not None and not isinstance(metadata, dict):
+        raise ValueError("metadata must be a JSON object")
+
+    return [
+        batch_number,
+        product_type_id,
+        production_date.isoformat(),
+        _text(record, "furnace_number", 50),
+        _int(record, "shift_number"),
+        _decimal(record, "total_weight_kg"),
+        _decimal(record, "total_length_m"),
+        _text(record, "status", 50),
+        quality_rating,
+        json.dumps(metadata, ensure_ascii=False) if metadata is not None else None,
+    ]
+
+
+def _merged_value(column: str) -> str:
+    """Значение колонки в ветке обновления: пустая ячейка файла не меняет сохраненное значение"""
+    if column in REQUIRED_COLUMNS:
+        return f"EXCLUDED.{column}"
+    if column == "status":
+        # В EXCLUDED статус уже со значением по умолчанию для новой партии, исходное значение - в файле
+        return (
+            f"COALESCE((SELECT staged.status FROM {STAGING_TABLE} staged "
+            f"WHERE staged.batch_number = EXCLUDED.batch_number), production_batches.status)"
+        )
+    return f"COALESCE(EXCLUDED.{column}, production_batches.{column})"
+
+
+def _merge_sql(update_columns: List[str], returning: bool = False) -> str:
+    """Upsert из промежуточной таблицы.
+
+    returning - строки с новыми значениями для журнала аудита, иначе количество вставленных и обновленных партий.
+    """
+    insert_columns = ", ".join(COLUMNS)
+    # Статус по умолчанию - только для новых партий
+    select_columns = ", ".join(
+        f"COALESCE(status, '{DEFAULT_STATUS}')" if column == "status" else column for column in COLUMNS
+    )
+    assignments = ", ".join(f"{column} = {_merged_value(column)}" for column in update_columns)
+    current = ", ".join(f"production_batches.{column}" for column in update_columns)
+    incoming = ", ".join(_merged_value(column) for column in update_columns)
+    returned = f", production_batches.id, {current}" if returning else ""
+    # Неизмененные партии не переписываются: не растут версия и updated_at, не берутся лишние блокировки
+    upsert = f"""
+            INSERT INTO production_batches ({insert_columns}, created_by)
+            SELECT {select_columns}, :created_by
+            FROM {STAGING_TABLE}
+            ORDER BY batch_number
+            ON CONFLICT (batch_number) DO UPDATE SET {assignments}
+            WHERE ({current}) IS DISTINCT FROM ({incoming})
+            RETURNING (xmax = 0) AS inserted{returned}
+    """
+    if returning:
+        return upsert
+    return f"""
+        WITH merged AS ({upsert})
+        SELECT
+            count(*) FILTER (WHERE inserted) AS inserted,
+            count(*) FILTER (WHERE NOT inserted) AS updated
+        FROM merged
+    """
+
+
+def _merge(db: Session, spool, update_columns: List[str], created_by: Optional[int]) -> Tuple[int, int]:
+    """COPY подготовленных строк во временную таблицу и upsert в production_batches"""
+    db.execute(text(
+        f"CREATE TEMP TABLE {STAGING_TABLE} ON COMMIT DROP AS "
+        f"SELECT {', '.join(COLUMNS)} FROM production_batches WITH NO DATA"
+    ))
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {STAGING_TABLE} ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT csv)", spool)
+    finally:
+        cursor.close()
+    # Ветка обновления ищет исходный статус партии в промежуточной таблице
+    db.execute(text(f"CREATE UNIQUE INDEX ON {STAGING_TABLE} (batch_number)"))
+    db.execute(text(f"ANALYZE {STAGING_TABLE}"))
+
+    entity = models.ProductionBatch.__tablename__
+    if audit.durability(entity) is None:
+        row = db.execute(text(_merge_sql(update_columns)), {"created_by": created_by}).one()
+        db.commit()
+        return row.inserted, row.updated
+
+    # Прежние значения существующих партий для журнала; строки блокируются до upsert
+    current = ", ".join(f"production_batches.{column}" for column in update_columns)
+    old = {
+        row[0]: dict(zip(update_columns, row[1:]))
+        for row in db.execute(text(
+            f"SELECT production_batches.id, {current} FROM production_batches "
+            f"JOIN {STAGING_TABLE} USING (batch_number) FOR UPDATE OF production_batches"
+        ))
+    }
+    rows = db.execute(text(_merge_sql(update_columns, returning=True)), {"created_by": created_by}).all()
+    # Партия, вставленная параллельно после чтения прежних значений, журналируется с пустыми old
+    unknown = dict.fromkeys(update_columns)
+    entries = [
+        audit.update_entry(entity, row.id, old.get(row.id, unknown), dict(zip(update_columns, row[2:])))
+        for row in rows
+        if not row.inserted
+    ]
+    entries = [entry for entry in entries if entry is not None]
+    audit.before_commit(db, entity, entries)
+    db.commit()
+    audit.after_commit(db, entity, entries)
+    inserted = sum(1 for row in rows if row.inserted)
+    return inserted, len(rows) - inserted
+
+
+def import_batches(db: Session, lines: Iterable[str], import_format: str, created_by: Optional[int]) -> Dict[str, Any]:
+    """Импорт партий из MES с upsert по batch_number.
+
+    Ошибочные строки пропускаются и попадают в отчет (row - номер записи без заголовка),
+    остальные загружаются. Повтор batch_number в файле - ошибка строки, используется первая запись.
+    """
+    lookup = ProductTypeLookup(db)
+    report: Dict[str, Any] = {"total": 0, "inserted": 0, "updated": 0, "unchanged": 0, "failed": 0, "errors": []}
+    seen: Dict[str, int] = {}
+    present: Set[str] = set()
+    records = _csv_records(lines) if import_format == CSV else _ndjson_records(lines)
+
+    with tempfile.SpooledTemporaryFile(
+        max_size=settings.BATCH_IMPORT_SPOOL_MEMORY, mode="w+", encoding="utf-8", newline=""
+    ) as spool:
+        writer = csv.writer(spool)
+        for number, record in enumerate(records, start=1):
+            report["total"] += 1
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                row = _parse_record(record, lookup)
+                if row[0] in seen:
+                    raise ValueError(f"Duplicate batch_number, already in row {seen[row[0]]}")
+            except ValueError as e:
+                report["failed"] += 1
+                if len(report["errors"]) < settings.BATCH_IMPORT_MAX_ERRORS:
+                    batch_number = record.get("batch_number") if isinstance(record, dict) else None
+                    report["errors"].append({
+                        "row": number,
+                        "batch_number": str(batch_number) if batch_number is not None else None,
+                        "error": str(e),
+                    })
+                continue
+            seen[row[0]] = number
+            present.update(record.keys())
+            writer.writerow(row)
+
+        if seen:
+            if "product_type_code" in present:
+                present.add("product_type_id")
+            update_columns = [
+                column for column in COLUMNS[1:] if column in REQUIRED_COLUMNS or column in present
+            ]
+            spool.seek(0)
+            report["inserted"], report["updated"] = _merge(db, spool, update_columns, created_by)
+            report["unchanged"] = len(seen) - report["inserted"] - report["updated"]
+    return report
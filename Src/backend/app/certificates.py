@@ -0,0 +1,242 @@
+import glob
+import logging
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from html import escape
+from typing import Optional, Dict, Any, List
+
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from . import models, crud
+from .config import settings
+from .database import shards, plant_of
+from .utils import fingerprint
+
+logger = logging.getLogger(__name__)
+
+SHIPPED_STATUS = "отгружено"
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=settings.CERTIFICATE_RENDER_WORKERS)
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def collect_certificate_data(db: Session, batch_id: int) -> Dict[str, Any]:
+    batch = db.query(models.ProductionBatch).filter(models.ProductionBatch.id == batch_id).first()
+    product_type = batch.product_type
+
+    inspections = db.execute(
+        select(
+            models.InspectionResult.id,
+            models.InspectionResult.inspection_time,
+            models.InspectionPoint.point_code,
+            models.InspectionPoint.point_name,
+            models.InspectionResult.overall_verdict,
+            models.InspectionResult.status,
+            models.InspectionResult.defect_count,
+            models.InspectionResult.measurement_data
+        )
+        .outerjoin(models.InspectionPoint, models.InspectionResult.inspection_point_id == models.InspectionPoint.id)
+        .where(models.InspectionResult.batch_id == batch_id)
+        .order_by(models.InspectionResult.inspection_time)
+    ).all()
+
+    defects = db.execute(
+        select(
+            models.DefectType.defect_code,
+            models.DefectType.defect_name,
+            models.DefectType.severity_level,
+            func.count(models.DefectDetail.id).label("count"),
+            func.max(models.DefectDetail.severity).label("max_severity"),
+            func.count(models.DefectDetail.repair_date).label("repaired")
+        )
+        .join(models.InspectionResult, models.DefectDetail.inspection_result)
+        .join(models.DefectType, models.DefectDetail.defect_type_id == models.DefectType.id)
+        .where(models.InspectionResult.batch_id == batch_id)
+        .group_by(models.DefectType.defect_code, models.DefectType.defect_name, models.DefectType.severity_level)
+        .order_by(models.DefectType.defect_code)
+    ).all()
+
+    return {
+        "batch": {
+            "id": batch.id,
+            "batch_number": batch.batch_number,
+            "production_date": batch.production_date.isoformat(),
+            "furnace_number": batch.furnace_number,
+            "shift_number": batch.shift_number,
+            "total_weight_kg": str(batch.total_weight_kg) if batch.total_weight_kg is not None else None,
+            "total_length_m": str(batch.total_length_m) if batch.total_length_m is not None else None,
+            "status": batch.status,
+            "quality_rating": batch.quality_rating,
+        },
+        "product_type": {
+            "type_code": product_type.type_code,
+            "type_name": product_type.type_name,
+            "standard": product_type.standard,
+            "material_grade": product_type.material_grade,
+            "thickness_range": product_type.thickness_range,
+            "width_range": product_type.width_range,
+        } if product_type else None,
+        "inspections": [
+            {
+                "id": row.id,
+                "inspection_time": row.inspection_time.isoformat() if row.inspection_time else None,
+                "point": f"{row.point_code} {row.point_name}" if row.point_code else None,
+                "overall_verdict": row.overall_verdict,
+                "status": row.status,
+                "defect_count": row.defect_count,
+                "thickness_mm": (row.measurement_data or {}).get("thickness_mm"),
+                "width_mm": (row.measurement_data or {}).get("width_mm"),
+            }
+            for row in inspections
+        ],
+        "defects": [
+            {
+                "defect_code": row.defect_code,
+                "defect_name": row.defect_name,
+                "severity_level": row.severity_level,
+                "count": row.count,
+                "max_severity": str(row.max_severity) if row.max_severity is not None else None,
+                "repaired": row.repaired,
+            }
+            for row in defects
+        ],
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def _cell(value: Any) -> str:
+    return escape("—" if value is None else str(value))
+
+
+def render_certificate_html(data: Dict[str, Any]) -> str:
+    """Формирует HTML сертификата; выполняется в отдельном процессе"""
+    batch = data["batch"]
+    product_type = data["product_type"] or {}
+    verdicts = Counter(item["overall_verdict"] for item in data["inspections"])
+
+    def rows(items: List[Dict[str, Any]], columns: List[str]) -> str:
+        return "".join(
+            "<tr>" + "".join(f"<td>{_cell(item.get(column))}</td>" for column in columns) + "</tr>"
+            for item in items
+        )
+
+    properties = [
+        ("Номер партии", batch["batch_number"]),
+        ("Вид продукции", f"{product_type.get('type_code', '')} {product_type.get('type_name', '')}".strip() or None),
+        ("Стандарт", product_type.get("standard")),
+        ("Марка стали", product_type.get("material_grade")),
+        ("Диапазон толщин", product_type.get("thickness_range")),
+        ("Диапазон ширины", product_type.get("width_range")),
+        ("Дата производства", batch["production_date"]),
+        ("Печь", batch["furnace_number"]),
+        ("Смена", batch["shift_number"]),
+        ("Масса, кг", batch["total_weight_kg"]),
+        ("Длина, м", batch["total_length_m"]),
+        ("Оценка качества", batch["quality_rating"]),
+    ]
+
+    return f"""<!DOCTYPE html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<title>Сертификат качества {_cell(batch["batch_number"])}</title>
+<style>
+body {{ font-family: Arial, sans-serif; margin: 2rem; }}
+table {{ border-collapse: collapse; width: 100%; margin-bottom: 1.5rem; }}
+th, td {{ border: 1px solid #999; padding: 0.3rem 0.5rem; text-align: left; }}
+th {{ background: #eee; }}
+</style>
+</head>
+<body>
+<h1>Сертификат качества № {_cell(batch["batch_number"])}</h1>
+<table>{"".join(f"<tr><th>{escape(name)}</th><td>{_cell(value)}</td></tr>" for name, value in properties)}</table>
+<h2>Итоги контроля</h2>
+<table>
+<tr><th>Всего результатов контроля</th><td>{len(data["inspections"])}</td></tr>
+{"".join(f"<tr><th>{_cell(verdict)}</th><td>{count}</td></tr>" for verdict, count in sorted(verdicts.items(), key=lambda item: str(item[0])))}
+</table>
+<h2>Результаты контроля</h2>
+<table>
+<tr><th>ID</th><th>Время</th><th>Контрольная точка</th><th>Вердикт</th><th>Статус</th><th>Дефектов</th><th>Толщина, мм</th><th>Ширина, мм</th></tr>
+{rows(data["inspections"], ["id", "inspection_time", "point", "overall_verdict", "status", "defect_count", "thickness_mm", "width_mm"])}
+</table>
+<h2>Дефекты</h2>
+<table>
+<tr><th>Код</th><th>Наименование</th><th>Критичность</th><th>Количество</th><th>Макс. тяжесть</th><th>Устранено</th></tr>
+{rows(data["defects"], ["defect_code", "defect_name", "severity_level", "count", "max_severity", "repaired"])}
+</table>
+<p>Сформирован: {_cell(data["generated_at"])}</p>
+</body>
+</html>
+"""
+
+
+def _write_atomic(path: str, content: str) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def get_certificate(db: Session, batch_id: int) -> Optional[Dict[str, Optional[str]]]:
+    """Возвращает путь к сертификату и его ETag, формируя его только если данные изменились.
+
+    Для неотгруженной партии сертификат не формируется, возвращается только статус.
+    """
+    version = crud.get_batch_version(db, batch_id)
+    if version is None:
+        return None
+    if version["status"] != SHIPPED_STATUS:
+        return {"path": None, "etag": None, "status": version["status"]}
+
+    etag = fingerprint(version)
+    # id партии уникален только внутри завода
+    prefix = f"{plant_of(db)}_batch_{batch_id}_"
+    os.makedirs(settings.CERTIFICATE_DIR, exist_ok=True)
+    path = os.path.join(settings.CERTIFICATE_DIR, f"{prefix}{etag}.html")
+
+    if not os.path.exists(path):
+        data = collect_certificate_data(db, batch_id)
+        content = _get_pool().submit(render_certificate_html, data).result(timeout=settings.CERTIFICATE_RENDER_TIMEOUT)
+        _write_atomic(path, content)
+        # Устаревшие версии сертификата этой партии больше не нужны
+        for old_path in glob.glob(os.path.join(settings.CERTIFICATE_DIR, f"{prefix}*.html")):
+            if old_path != path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    return {"path": path, "etag": etag, "status": version["status"]}
+
+
+def warm_certificate(plant: str, batch_id: int) -> None:
+    """Заранее формирует сертификат при отгрузке партии"""
+    db = shards.session(plant, "reporting")
+    try:
+        get_certificate(db, batch_id)
+    except Exception:
+        logger.exception("Certificate generation failed for batch %s of plant %s", batch_id, plant)
+    finally:
+        db.close()
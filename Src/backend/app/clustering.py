@@ -0,0 +1,165 @@
+import math
+from collections import defaultdict
+from typing import Optional, List, Dict, Any, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from . import models
+
+
+class SpatialClusterIndex:
+    """Инкрементальная кластеризация дефектов по расстоянию связи.
+
+    Точки раскладываются по сетке с шагом link_distance / sqrt(2): все точки одной
+    ячейки гарантированно связаны, поэтому при добавлении точки достаточно проверить
+    соседние ячейки в радиусе двух шагов и пропустить те, что уже входят в тот же
+    кластер. Связные группы ведутся через union-find; добавление стоит O(1) в среднем,
+    построение по n точкам - O(n) вместо O(n^2) попарного сравнения.
+    """
+
+    _OFFSETS = [(dx, dy) for dx in range(-2, 3) for dy in range(-2, 3)
+                if (dx, dy) != (0, 0) and abs(dx) + abs(dy) < 4]
+
+    def __init__(self, link_distance: float):
+        if link_distance <= 0:
+            raise ValueError("link_distance must be positive")
+        self.link_distance = link_distance
+        self._link_sq = link_distance * link_distance
+        self._cell_size = link_distance / math.sqrt(2)
+        self._cells: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        self._parent: List[int] = []
+        self._size: List[int] = []
+        self.points: List[Tuple[float, float]] = []
+        self.payloads: List[Dict[str, Any]] = []
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        return math.floor(x / self._cell_size), math.floor(y / self._cell_size)
+
+    def _find(self, i: int) -> int:
+        parent = self._parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    def _union(self, a: int, b: int) -> None:
+        ra, rb = self._find(a), self._find(b)
+        if ra == rb:
+            return
+        if self._size[ra] < self._size[rb]:
+            ra, rb = rb, ra
+        self._parent[rb] = ra
+        self._size[ra] += self._size[rb]
+
+    def add(self, x: float, y: float, payload: Optional[Dict[str, Any]] = None) -> int:
+        index = len(self.points)
+        self.points.append((x, y))
+        self.payloads.append(payload or {})
+        self._parent.append(index)
+        self._size.append(1)
+
+        cx, cy = self._cell(x, y)
+        own = self._cells[(cx, cy)]
+        if own:
+            self._union(index, own[0])
+        own.append(index)
+
+        for dx, dy in self._OFFSETS:
+            members = self._cells.get((cx + dx, cy + dy))
+            if not members or self._find(members[0]) == self._find(index):
+                continue
+            for other in members:
+                ox, oy = self.points[other]
+                if (ox - x) ** 2 + (oy - y) ** 2 <= self._link_sq:
+                    self._union(index, other)
+                    break
+        return index
+
+    def labels(self) -> List[int]:
+        return [self._find(i) for i in range(len(self.points))]
+
+    def clusters(self) -> List[Dict[str, Any]]:
+        groups: Dict[int, List[int]] = defaultdict(list)
+        for i, root in enumerate(self.labels()):
+            groups[root].append(i)
+
+        result = []
+        for members in sorted(groups.values(), key=len, reverse=True):
+            xs = [self.points[i][0] for i in members]
+            ys = [self.points[i][1] for i in members]
+            severities = [self.payloads[i]["severity"] for i in members
+                          if self.payloads[i].get("severity") is not None]
+            result.append({
+                "cluster_id": len(result) + 1,
+                "defect_count": len(members),
+                "defect_ids": [self.payloads[i].get("id") for i in members],
+                "defect_type_ids": sorted({self.payloads[i].get("defect_type_id") for i in members} - {None}),
+                "x_min": min(xs),
+                "y_min": min(ys),
+                "x_max": max(xs),
+                "y_max": max(ys),
+                "max_severity": max(severities) if severities else None,
+                "total_severity": sum(severities) if severities else None,
+                "mean_severity": sum(severities) / len(severities) if severities else None,
+            })
+        return result
+
+
+def fetch_defect_points(
+    db: Session,
+    inspection_id: Optional[int] = None,
+    batch_id: Optional[int] = None
+) -> List[Any]:
+    x_mm = models.DefectDetail.defect_location["x_mm"].as_float()
+    y_mm = models.DefectDetail.defect_location["y_mm"].as_float()
+
+    stmt = (
+        select(
+            models.DefectDetail.id,
+            models.DefectDetail.defect_type_id,
+            models.DefectDetail.severity,
+            x_mm.label("x_mm"),
+            y_mm.label("y_mm")
+        )
+        .where(x_mm.isnot(None), y_mm.isnot(None))
+        .order_by(models.DefectDetail.id)
+    )
+
+    if inspection_id:
+        stmt = stmt.where(models.DefectDetail.inspection_result_id == inspection_id)
+    if batch_id:
+        stmt = stmt.join(
+            models.InspectionResult, models.DefectDetail.inspection_result
+        ).where(models.InspectionResult.batch_id == batch_id)
+
+    return db.execute(stmt).all()
+
+
+def cluster_defects(
+    db: Session,
+    link_distance: float,
+    inspection_id: Optional[int] = None,
+    batch_id: Optional[int] = None
+) -> Dict[str, Any]:
+    """Группирует соседние дефекты результата контроля или партии в кластеры"""
+    index = SpatialClusterIndex(link_distance)
+    for row in fetch_defect_points(db, inspection_id=inspection_id, batch_id=batch_id):
+        index.add(row.x_mm, row.y_mm, {
+            "id": row.id,
+            "defect_type_id": row.defect_type_id,
+            "severity": float(row.severity) if row.severity is not None else None,
+        })
+
+    clusters = index.clusters()
+    return {
+        "link_distance_mm": link_distance,
+        "defect_count": len(index),
+        "cluster_count": len(clusters),
+        "clusters": clusters,
+    }
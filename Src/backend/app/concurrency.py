@@ -0,0 +1,31 @@
+import re
+from typing import Optional
+
+from fastapi import Header, HTTPException, status
+
+# Сильный ETag записи - номер ее версии в кавычках
+_ENTITY_TAG = re.compile(r'^"(\d+)"$')
+
+
+def etag(version: int) -> str:
+    return '"%d"' % version
+
+
+def expected_version(if_match: Optional[str] = Header(None)) -> Optional[int]:
+    """Версия записи из If-Match; None - условие не задано или "*" (любая версия)"""
+    if if_match is None or if_match.strip() == "*":
+        return None
+    match = _ENTITY_TAG.match(if_match.strip())
+    if match is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="If-Match must contain a single entity tag returned in ETag"
+        )
+    return int(match.group(1))
+
+
+def precondition_failed(entity: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_412_PRECONDITION_FAILED,
+        detail=f"{entity} was modified by another request"
+    )
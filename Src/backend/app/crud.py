@@ -1,14 +1,142 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
-from typing import Optional, List, Dict, Any
+from sqlalchemy import and_, or_, select, insert, update, delete, func, true, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DataError, IntegrityError
+from typing import Optional, List, Dict, Any, Callable, Set
 from datetime import datetime
+import heapq
+import itertools
 import logging
 
-from . import models, schemas, auth
+from . import models, schemas, auth, verdict, anomaly, fieldsets, tracing, audit
+from .database import fan_out
 
 logger = logging.getLogger(__name__)
 
 
+class VersionConflict(Exception):
+    """Версия записи не совпала с ожидаемой (If-Match): запись изменил другой запрос"""
+
+
+def _conflict_or_missing(db: Session, model, key, expected_version: Optional[int]) -> None:
+    # Строка не затронута: при заданной версии отличаем конфликт от отсутствия записи
+    db.rollback()
+    if expected_version is not None and db.query(model.id).filter(key).first() is not None:
+        raise VersionConflict()
+
+
+def _commit(
+    db: Session,
+    entity: str,
+    entries: List[Optional[Dict[str, Any]]],
+    cascaded: Optional[Dict[str, List[Dict[str, Any]]]] = None
+) -> None:
+    # Записи аудита: transactional - в этой же транзакции, остальные - в буфер после commit
+    groups = {entity: [entry for entry in entries if entry is not None], **(cascaded or {})}
+    for name, group in groups.items():
+        audit.before_commit(db, name, group)
+    db.commit()
+    for name, group in groups.items():
+        audit.after_commit(db, name, group)
+
+
+def _delete_dependents(db: Session, model, criteria: list) -> Dict[str, List[Dict[str, Any]]]:
+    """Удаляет журналируемые зависимые строки, которые иначе удалил бы каскад БД без записей аудита.
+
+    Родительские строки блокируются заранее, чтобы к ним не добавились новые зависимые.
+    Возвращает записи аудита по таблицам.
+    """
+    inspections = models.InspectionResult.__table__
+    defects = models.DefectDetail.__table__
+    if model is models.ProductionBatch:
+        parent = inspections.c.batch_id
+    elif model is models.InspectionResult:
+        parent = inspections.c.id
+    else:
+        return {}
+    audit_inspections = model is models.ProductionBatch and audit.durability(inspections.name) is not None
+    audit_defects = audit.durability(defects.name) is not None
+    if not (audit_inspections or audit_defects):
+        return {}
+    ids = db.scalars(select(model.id).where(*criteria).with_for_update()).all()
+    if not ids:
+        return {}
+
+    cascaded = {}
+    if audit_defects:
+        rows = db.execute(
+            delete(defects)
+            .where(tuple_(defects.c.inspection_result_id, defects.c.inspection_time).in_(
+                select(inspections.c.id, inspections.c.inspection_time).where(parent.in_(ids))
+            ))
+            .returning(*defects.c)
+        ).all()
+        cascaded[defects.name] = [audit.delete_entry(defects.name, dict(row._mapping)) for row in rows]
+    if audit_inspections:
+        rows = db.execute(delete(inspections).where(parent.in_(ids)).returning(*inspections.c)).all()
+        cascaded[inspections.name] = [audit.delete_entry(inspections.name, dict(row._mapping)) for row in rows]
+    return cascaded
+
+
+def _update_returning(db: Session, model, key, values: Dict[str, Any], expected_version: Optional[int] = None):
+    """UPDATE ... RETURNING: изменение и чтение записи за один запрос.
+
+    updated_at и version выставляют триггеры БД. None - запись не найдена.
+    Для журналируемых таблиц прежние значения изменяемых колонок возвращает тот же UPDATE.
+    """
+    table = model.__table__
+    criteria = [key]
+    if expected_version is not None:
+        criteria.append(model.version == expected_version)
+    old = None
+    if values:
+        # Ключи схем совпадают с именами колонок таблицы (атрибут модели может называться иначе)
+        statement = update(model).where(*criteria).values({table.c[name]: value for name, value in values.items()})
+        if audit.durability(table.name):
+            # UPDATE ... FROM (SELECT ... FOR UPDATE): подзапрос видит строку до изменения
+            old = select(table.c.id, *(table.c[name] for name in values)).where(key).with_for_update().subquery("old")
+            statement = statement.where(table.c.id == old.c.id).returning(model, *(old.c[name] for name in values))
+        else:
+            statement = statement.returning(model)
+        result = db.execute(statement.execution_options(synchronize_session=False, populate_existing=True)).first()
+        row = result[0] if result is not None else None
+    else:
+        row = db.query(model).filter(*criteria).first()
+    if row is None:
+        _conflict_or_missing(db, model, key, expected_version)
+        return None
+    entries = []
+    if old is not None:
+        entries.append(audit.update_entry(table.name, row.id, dict(zip(values, result[1:])), audit.column_values(row, values)))
+    _commit(db, table.name, entries)
+    return row
+
+
+def _delete_returning(db: Session, model, key, expected_version: Optional[int] = None) -> bool:
+    """DELETE ... RETURNING без предварительной загрузки; зависимые строки удаляет каскад БД.
+
+    Для журналируемых таблиц RETURNING отдает удаленную строку целиком для снимка в журнале,
+    журналируемые зависимые строки удаляются до каскада со своими снимками.
+    """
+    table = model.__table__
+    criteria = [key]
+    if expected_version is not None:
+        criteria.append(model.version == expected_version)
+    audited = audit.durability(table.name) is not None
+    cascaded = _delete_dependents(db, model, criteria)
+    deleted = db.execute(
+        delete(model)
+        .where(*criteria)
+        .returning(*(table.c if audited else [table.c.id]))
+        .execution_options(synchronize_session=False)
+    ).first()
+    if deleted is None:
+        _conflict_or_missing(db, model, key, expected_version)
+        return False
+    _commit(db, table.name, [audit.delete_entry(table.name, dict(deleted._mapping))] if audited else [], cascaded)
+    return True
+
+
 def get_user(db: Session, user_id: int) -> Optional[models.User]:
     return db.query(models.User).filter(models.User.id == user_id).first()
 
@@ -42,30 +170,14 @@ def create_user(db: Session, user: schemas.UserCreate) -> models.User:
 
 
 def update_user(db: Session, user_id: int, user_update: schemas.UserUpdate) -> Optional[models.User]:
-    db_user = get_user(db, user_id)
-    if db_user:
-        update_data = user_update.model_dump(exclude_unset=True)
-        
-        if "password" in update_data:
-            update_data["hashed_password"] = auth.get_password_hash(update_data.pop("password"))
-        
-        for field, value in update_data.items():
-            setattr(db_user, field, value)
-        
-        db_user.updated_at = datetime.utcnow()
-        db.commit()
-        db.refresh(db_user)
-    
-    return db_user
+    update_data = user_update.model_dump(exclude_unset=True)
+    if "password" in update_data:
+        update_data["hashed_password"] = auth.get_password_hash(update_data.pop("password"))
+    return _update_returning(db, models.User, models.User.id == user_id, update_data)
 
 
 def delete_user(db: Session, user_id: int) -> bool:
-    db_user = get_user(db, user_id)
-    if db_user:
-        db.delete(db_user)
-        db.commit()
-        return True
-    return False
+    return _delete_returning(db, models.User, models.User.id == user_id)
 
 
 def get_role(db: Session, role_id: int) -> Optional[models.Role]:
@@ -93,25 +205,11 @@ def create_role(db: Session, role: schemas.RoleCreate) -> models.Role:
 
 
 def update_role(db: Session, role_id: int, role_update: schemas.RoleUpdate) -> Optional[models.Role]:
-    db_role = get_role(db, role_id)
-    if db_role:
-        update_data = role_update.model_dump(exclude_unset=True)
-        for field, value in update_data.items():
-            setattr(db_role, field, value)
-        
-        db.commit()
-        db.refresh(db_role)
-    
-    return db_role
+    return _update_returning(db, models.Role, models.Role.id == role_id, role_update.model_dump(exclude_unset=True))
 
 
 def delete_role(db: Session, role_id: int) -> bool:
-    db_role = get_role(db, role_id)
-    if db_role:
-        db.delete(db_role)
-        db.commit()
-        return True
-    return False
+    return _delete_returning(db, models.Role, models.Role.id == role_id)
 
 
 def get_product_type(db: Session, type_id: int) -> Optional[models.ProductType]:
@@ -122,33 +220,40 @@ def get_product_types(db: Session, skip: int = 0, limit: int = 100) -> List[mode
     return db.query(models.ProductType).offset(skip).limit(limit).all()
 
 
+def list_product_types(db: Session, projection: fieldsets.Projection, skip: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+    return projection.fetch(db, [], skip=skip, limit=limit)
+
+
 def create_product_type(db: Session, product_type: schemas.ProductTypeCreate) -> models.ProductType:
     db_product_type = models.ProductType(**product_type.model_dump())
     db.add(db_product_type)
     db.commit()
     db.refresh(db_product_type)
+    verdict.invalidate_rules()
     return db_product_type
 
 
-def update_product_type(db: Session, type_id: int, product_type_update: schemas.ProductTypeUpdate) -> Optional[models.ProductType]:
-    db_product_type = get_product_type(db, type_id)
+def update_product_type(
+    db: Session,
+    type_id: int,
+    product_type_update: schemas.ProductTypeUpdate,
+    expected_version: Optional[int] = None
+) -> Optional[models.ProductType]:
+    db_product_type = _update_returning(
+        db,
+        models.ProductType,
+        models.ProductType.id == type_id,
+        product_type_update.model_dump(exclude_unset=True),
+        expected_version=expected_version
+    )
     if db_product_type:
-        update_data = product_type_update.model_dump(exclude_unset=True)
-        for field, value in update_data.items():
-            setattr(db_product_type, field, value)
-        
-        db_product_type.updated_at = datetime.utcnow()
-        db.commit()
-        db.refresh(db_product_type)
-    
+        verdict.invalidate_rules()
     return db_product_type
 
 
-def delete_product_type(db: Session, type_id: int) -> bool:
-    db_product_type = get_product_type(db, type_id)
-    if db_product_type:
-        db.delete(db_product_type)
-        db.commit()
+def delete_product_type(db: Session, type_id: int, expected_version: Optional[int] = None) -> bool:
+    if _delete_returning(db, models.ProductType, models.ProductType.id == type_id, expected_version=expected_version):
+        verdict.invalidate_rules()
         return True
     return False
 
@@ -157,10 +262,91 @@ def get_batch(db: Session, batch_id: int) -> Optional[models.ProductionBatch]:
     return db.query(models.ProductionBatch).filter(models.ProductionBatch.id == batch_id).first()
 
 
+def get_batch_version(db: Session, batch_id: int) -> Optional[Dict[str, Any]]:
+    """Отпечаток состояния партии и ее данных контроля одним запросом.
+
+    Меняется при любом изменении партии, вида продукции, результатов контроля, дефектов,
+    а также типов дефектов и точек контроля, попавших в данные партии.
+    """
+    ir = models.InspectionResult
+    dd = models.DefectDetail
+    batches = models.ProductionBatch
+    # Сумма версий меняется и при правках в пределах одной транзакции, когда updated_at совпадает
+    inspections = (
+        select(
+            func.count(ir.id).label("inspections"),
+            func.max(ir.updated_at).label("inspections_updated"),
+            func.sum(ir.version).label("inspections_version"),
+            func.max(models.InspectionPoint.updated_at).label("inspection_points_updated")
+        )
+        .outerjoin(models.InspectionPoint, ir.inspection_point_id == models.InspectionPoint.id)
+        .where(ir.batch_id == batches.id)
+        .lateral("inspections")
+    )
+    defects = (
+        select(
+            func.count(dd.id).label("defects"),
+            func.max(dd.updated_at).label("defects_updated"),
+            func.max(models.DefectType.updated_at).label("defect_types_updated"),
+            func.sum(models.DefectType.version).label("defect_types_version")
+        )
+        .join(ir, dd.inspection_result)
+        .outerjoin(models.DefectType, dd.defect_type_id == models.DefectType.id)
+        .where(ir.batch_id == batches.id)
+        .lateral("defects")
+    )
+
+    row = db.execute(
+        select(
+            batches.status,
+            batches.updated_at,
+            batches.version,
+            models.ProductType.updated_at.label("product_type_updated"),
+            models.ProductType.version.label("product_type_version"),
+            inspections,
+            defects
+        )
+        .select_from(batches)
+        .outerjoin(models.ProductType, batches.product_type_id == models.ProductType.id)
+        .join(inspections, true())
+        .join(defects, true())
+        .where(batches.id == batch_id)
+    ).first()
+    if row is None:
+        return None
+    return {key: (value.isoformat() if isinstance(value, datetime) else value) for key, value in row._mapping.items()}
+
+
 def get_batch_by_number(db: Session, batch_number: str) -> Optional[models.ProductionBatch]:
     return db.query(models.ProductionBatch).filter(models.ProductionBatch.batch_number == batch_number).first()
 
 
+def _merge_pages(
+    pages: Dict[str, List[Dict[str, Any]]],
+    key: Callable[[Dict[str, Any]], Any],
+    skip: int,
+    limit: int
+) -> List[Dict[str, Any]]:
+    # Каждый завод отдал первые skip + limit строк в порядке key: слияние дает общую страницу
+    return list(itertools.islice(heapq.merge(*pages.values(), key=key), skip, skip + limit))
+
+
+def _batch_criteria(
+    status: Optional[str] = None,
+    product_type_id: Optional[int] = None,
+    batch_number: Optional[str] = None
+) -> list:
+    criteria = []
+    if batch_number:
+        # Поиск по началу номера партии (индекс idx_batch_number)
+        criteria.append(models.ProductionBatch.batch_number.startswith(batch_number, autoescape=True))
+    if status:
+        criteria.append(models.ProductionBatch.status == status)
+    if product_type_id:
+        criteria.append(models.ProductionBatch.product_type_id == product_type_id)
+    return criteria
+
+
 def get_batches(
     db: Session,
     skip: int = 0,
@@ -168,16 +354,40 @@ def get_batches(
     status: Optional[str] = None,
     product_type_id: Optional[int] = None
 ) -> List[models.ProductionBatch]:
-    query = db.query(models.ProductionBatch)
-    
-    if status:
-        query = query.filter(models.ProductionBatch.status == status)
-    if product_type_id:
-        query = query.filter(models.ProductionBatch.product_type_id == product_type_id)
-    
+    query = db.query(models.ProductionBatch).filter(*_batch_criteria(status, product_type_id))
     return query.offset(skip).limit(limit).all()
 
 
+def list_batches(
+    db: Session,
+    projection: fieldsets.Projection,
+    skip: int = 0,
+    limit: int = 100,
+    status: Optional[str] = None,
+    product_type_id: Optional[int] = None,
+    batch_number: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Страница партий для ответа API: только колонки проекции, без ORM-объектов"""
+    return projection.fetch(db, _batch_criteria(status, product_type_id, batch_number), skip=skip, limit=limit)
+
+
+def list_batches_across_plants(
+    sessions: Dict[str, Session],
+    projection: fieldsets.Projection,
+    skip: int = 0,
+    limit: int = 100,
+    status: Optional[str] = None,
+    product_type_id: Optional[int] = None,
+    batch_number: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Страница партий нескольких заводов: базы опрашиваются параллельно, порядок - (id, завод)"""
+    criteria = _batch_criteria(status, product_type_id, batch_number)
+    pages = fan_out(sessions, lambda db: projection.fetch(
+        db, criteria, skip=0, limit=skip + limit, order_by=[models.ProductionBatch.id]
+    ))
+    return _merge_pages(pages, lambda row: (row["id"], row["plant_code"]), skip, limit)
+
+
 def create_batch(db: Session, batch: schemas.ProductionBatchCreate) -> models.ProductionBatch:
     db_batch = models.ProductionBatch(**batch.model_dump())
     db.add(db_batch)
@@ -186,77 +396,539 @@ def create_batch(db: Session, batch: schemas.ProductionBatchCreate) -> models.Pr
     return db_batch
 
 
-def update_batch(db: Session, batch_id: int, batch_update: schemas.ProductionBatchUpdate) -> Optional[models.ProductionBatch]:
-    db_batch = get_batch(db, batch_id)
-    if db_batch:
-        update_data = batch_update.model_dump(exclude_unset=True)
-        for field, value in update_data.items():
-            setattr(db_batch, field, value)
-        
-        db_batch.updated_at = datetime.utcnow()
-        db.commit()
-        db.refresh(db_batch)
-    
-    return db_batch
+def update_batch(
+    db: Session,
+    batch_id: int,
+    batch_update: schemas.ProductionBatchUpdate,
+    expected_version: Optional[int] = None
+) -> Optional[models.ProductionBatch]:
+    return _update_returning(
+        db,
+        models.ProductionBatch,
+        models.ProductionBatch.id == batch_id,
+        batch_update.model_dump(exclude_unset=True),
+        expected_version=expected_version
+    )
 
 
-def delete_batch(db: Session, batch_id: int) -> bool:
-    db_batch = get_batch(db, batch_id)
-    if db_batch:
-        db.delete(db_batch)
-        db.commit()
-        return True
-    return False
+def delete_batch(db: Session, batch_id: int, expected_version: Optional[int] = None) -> bool:
+    return _delete_returning(db, models.ProductionBatch, models.ProductionBatch.id == batch_id, expected_version=expected_version)
+
+
+def _batch_selection_criteria(selection: schemas.BatchSelection) -> list:
+    batches = models.ProductionBatch
+    criteria = []
+    if selection.ids is not None:
+        criteria.append(batches.id.in_(selection.ids))
+    if selection.status is not None:
+        criteria.append(batches.status == selection.status)
+    if selection.product_type_id is not None:
+        criteria.append(batches.product_type_id == selection.product_type_id)
+    if selection.production_date_from is not None:
+        criteria.append(batches.production_date >= selection.production_date_from)
+    if selection.production_date_to is not None:
+        criteria.append(batches.production_date <= selection.production_date_to)
+    if selection.furnace_number is not None:
+        criteria.append(batches.furnace_number == selection.furnace_number)
+    # Пустой список условий - UPDATE/DELETE без WHERE по всем партиям завода
+    if not criteria:
+        raise ValueError("Selection must contain ids or at least one filter")
+    return criteria
+
+
+def bulk_update_batches(db: Session, selection: schemas.BatchSelection, values: Dict[str, Any]) -> List[int]:
+    """Массовое изменение партий одним UPDATE ... RETURNING; возвращает id измененных"""
+    table = models.ProductionBatch.__table__
+    criteria = _batch_selection_criteria(selection)
+    statement = update(table).values({table.c[name]: value for name, value in values.items()})
+    audited = audit.durability(table.name) is not None
+    if audited:
+        old = select(table.c.id, *(table.c[name] for name in values)).where(*criteria).with_for_update().subquery("old")
+        statement = statement.where(table.c.id == old.c.id).returning(
+            table.c.id, *(table.c[name] for name in values), *(old.c[name] for name in values)
+        )
+    else:
+        statement = statement.where(*criteria).returning(table.c.id)
+    rows = db.execute(statement).all()
+    entries = []
+    if audited:
+        size = len(values)
+        entries = [
+            audit.update_entry(table.name, row[0], dict(zip(values, row[1 + size:])), dict(zip(values, row[1:1 + size])))
+            for row in rows
+        ]
+    _commit(db, table.name, entries)
+    return sorted(row[0] for row in rows)
+
+
+def bulk_delete_batches(db: Session, selection: schemas.BatchSelection) -> List[int]:
+    """Массовое удаление партий одним DELETE ... RETURNING; результаты контроля удаляет каскад БД
+
+    Журналируемые результаты контроля и дефекты удаляются заранее, чтобы попасть в журнал.
+    """
+    table = models.ProductionBatch.__table__
+    audited = audit.durability(table.name) is not None
+    criteria = _batch_selection_criteria(selection)
+    cascaded = _delete_dependents(db, models.ProductionBatch, criteria)
+    rows = db.execute(
+        delete(table)
+        .where(*criteria)
+        .returning(*(table.c if audited else [table.c.id]))
+    ).all()
+    _commit(db, table.name, [audit.delete_entry(table.name, dict(row._mapping)) for row in rows] if audited else [], cascaded)
+    return sorted(row.id for row in rows)
+
+
+def _apply_verdict(db_inspection: models.InspectionResult, result: verdict.Verdict) -> None:
+    # Если в measurement_data нечего проверять, оставляем значения клиента
+    if result.overall_verdict is None:
+        return
+    db_inspection.overall_verdict = result.overall_verdict
+    db_inspection.is_defect_detected = result.is_defect_detected
+    db_inspection.status = result.status
+
 
 def create_inspection_result(db: Session, inspection: schemas.InspectionResultCreate) -> models.InspectionResult:
     db_inspection = models.InspectionResult(**inspection.model_dump())
+    
+    product_type_id = db.query(models.ProductionBatch.product_type_id).filter(
+        models.ProductionBatch.id == inspection.batch_id
+    ).scalar()
+    rules = verdict.get_rules(db)
+    _apply_verdict(db_inspection, rules.evaluate(product_type_id, inspection.measurement_data))
+    
+    # Состояние детектора обновляется только после успешного commit
+    observation = None
+    readings = inspection.measurement_data.get(anomaly.SENSOR_READINGS_KEY)
+    if readings is not None:
+        observation = anomaly.detector.check(inspection.inspection_point_id, readings)
+        report = observation.report if observation else None
+        if report:
+            db_inspection.measurement_data = {**inspection.measurement_data, "anomaly": report.as_dict()}
+            db.add(models.AnomalyAlert(
+                inspection_result=db_inspection,
+                inspection_point_id=inspection.inspection_point_id,
+                detectors=report.detectors,
+                flagged_count=len(report.flagged_indices),
+                details=report.details
+            ))
+    
     db.add(db_inspection)
     db.commit()
+    if observation:
+        observation.apply()
     db.refresh(db_inspection)
     return db_inspection
 
 
+def _inspection_criteria(
+    batch_id: Optional[int] = None,
+    verdict: Optional[str] = None,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None
+) -> list:
+    criteria = []
+    if batch_id:
+        criteria.append(models.InspectionResult.batch_id == batch_id)
+    if verdict:
+        criteria.append(models.InspectionResult.overall_verdict == verdict)
+    # Ограничение по inspection_time позволяет планировщику отсечь лишние секции
+    if time_from:
+        criteria.append(models.InspectionResult.inspection_time >= time_from)
+    if time_to:
+        criteria.append(models.InspectionResult.inspection_time < time_to)
+    return criteria
+
+
+def query_inspection_results(
+    db: Session,
+    batch_id: Optional[int] = None,
+    verdict: Optional[str] = None,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None
+):
+    return db.query(models.InspectionResult).filter(*_inspection_criteria(batch_id, verdict, time_from, time_to))
+
+
 def get_inspection_results(
     db: Session,
     skip: int = 0,
     limit: int = 100,
     batch_id: Optional[int] = None,
-    verdict: Optional[str] = None
+    verdict: Optional[str] = None,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None
 ) -> List[models.InspectionResult]:
-    query = db.query(models.InspectionResult)
+    query = query_inspection_results(db, batch_id=batch_id, verdict=verdict, time_from=time_from, time_to=time_to)
+    return query.offset(skip).limit(limit).all()
+
+
+def list_inspection_results(
+    db: Session,
+    projection: fieldsets.Projection,
+    skip: int = 0,
+    limit: int = 100,
+    batch_id: Optional[int] = None,
+    verdict: Optional[str] = None,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None
+) -> List[Dict[str, Any]]:
+    """Страница результатов контроля для ответа API: только колонки проекции, без ORM-объектов"""
+    criteria = _inspection_criteria(batch_id, verdict, time_from, time_to)
+    return projection.fetch(db, criteria, skip=skip, limit=limit)
+
+
+def list_inspection_results_across_plants(
+    sessions: Dict[str, Session],
+    projection: fieldsets.Projection,
+    skip: int = 0,
+    limit: int = 100,
+    batch_id: Optional[int] = None,
+    verdict: Optional[str] = None,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None
+) -> List[Dict[str, Any]]:
+    """Страница результатов контроля нескольких заводов в порядке (inspection_time, id, завод)"""
+    criteria = _inspection_criteria(batch_id, verdict, time_from, time_to)
+    inspection = models.InspectionResult
+    pages = fan_out(sessions, lambda db: projection.fetch(
+        db, criteria, skip=0, limit=skip + limit, order_by=[inspection.inspection_time, inspection.id]
+    ))
+    return _merge_pages(pages, lambda row: (row["inspection_time"], row["id"], row["plant_code"]), skip, limit)
+
+
+def plant_statistics(
+    db: Session,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None
+) -> Dict[str, Any]:
+    """Сводка завода базы db за период: партии по статусам, результаты контроля и дефекты"""
+    batch = models.ProductionBatch
+    batch_criteria = []
+    if time_from:
+        batch_criteria.append(batch.production_date >= time_from.date())
+    if time_to:
+        batch_criteria.append(batch.production_date <= time_to.date())
+    by_status = dict(db.execute(
+        select(batch.status, func.count()).where(*batch_criteria).group_by(batch.status)
+    ).tuples().all())
+
+    inspection = models.InspectionResult
+    inspections, with_defects, nonconforming, defects = db.execute(
+        select(
+            func.count(),
+            func.count().filter(inspection.is_defect_detected.is_(True)),
+            func.count().filter(inspection.overall_verdict == verdict.VERDICT_FAIL),
+            func.coalesce(func.sum(inspection.defect_count), 0)
+        ).where(*_inspection_criteria(time_from=time_from, time_to=time_to))
+    ).one()
+    return {
+        "batches": sum(by_status.values()),
+        "batches_by_status": {status or "": count for status, count in by_status.items()},
+        "inspections": inspections,
+        "inspections_with_defects": with_defects,
+        "nonconforming_inspections": nonconforming,
+        "defects": int(defects),
+    }
+
+
+def _statistics_entry(plant_code: str, stats: Dict[str, Any]) -> Dict[str, Any]:
+    rate = stats["inspections_with_defects"] / stats["inspections"] if stats["inspections"] else 0.0
+    return {"plant_code": plant_code, **stats, "defect_rate": rate}
+
+
+def plant_statistics_report(
+    sessions: Dict[str, Session],
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None
+) -> Dict[str, Any]:
+    """Сводка по выбранным заводам: базы опрашиваются параллельно, итог - сумма по заводам"""
+    results = fan_out(sessions, lambda db: plant_statistics(db, time_from=time_from, time_to=time_to))
+    total: Dict[str, Any] = {
+        "batches": 0, "batches_by_status": {}, "inspections": 0,
+        "inspections_with_defects": 0, "nonconforming_inspections": 0, "defects": 0,
+    }
+    for stats in results.values():
+        for name, value in stats.items():
+            if name == "batches_by_status":
+                for status, count in value.items():
+                    total[name][status] = total[name].get(status, 0) + count
+            else:
+                total[name] += value
+    return {
+        "time_from": time_from,
+        "time_to": time_to,
+        "plants": [_statistics_entry(plant, stats) for plant, stats in results.items()],
+        "total": _statistics_entry("all", total),
+    }
+
+
+def count_inspection_results(
+    db: Session,
+    batch_id: Optional[int] = None,
+    verdict: Optional[str] = None,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None
+) -> int:
+    query = query_inspection_results(db, batch_id=batch_id, verdict=verdict, time_from=time_from, time_to=time_to)
+    return query.count()
+
+def reevaluate_inspection_results(
+    db: Session,
+    batch_id: Optional[int] = None,
+    status: Optional[str] = None,
+    limit: int = 10000
+) -> int:
+    """Пересчитывает вердикты пакета результатов контроля одним векторизованным проходом"""
+    query = db.query(
+        models.InspectionResult.id,
+        models.InspectionResult.inspection_time,
+        models.ProductionBatch.product_type_id,
+        models.InspectionResult.measurement_data,
+        # Прежние значения - для журнала аудита, без отдельного запроса
+        models.InspectionResult.overall_verdict,
+        models.InspectionResult.is_defect_detected,
+        models.InspectionResult.status
+    ).join(models.ProductionBatch, models.InspectionResult.batch_id == models.ProductionBatch.id)
     
     if batch_id:
         query = query.filter(models.InspectionResult.batch_id == batch_id)
-    if verdict:
-        query = query.filter(models.InspectionResult.overall_verdict == verdict)
+    if status:
+        query = query.filter(models.InspectionResult.status == status)
     
-    return query.offset(skip).limit(limit).all()
+    rows = query.order_by(models.InspectionResult.id).limit(limit).all()
+    if not rows:
+        return 0
+    
+    rules = verdict.get_rules(db)
+    results = rules.evaluate_bulk([row.product_type_id for row in rows], [row.measurement_data for row in rows])
+    
+    mappings = [
+        {
+            "id": row.id,
+            "inspection_time": row.inspection_time,
+            "overall_verdict": result.overall_verdict,
+            "is_defect_detected": result.is_defect_detected,
+            "status": result.status,
+        }
+        for row, result in zip(rows, results)
+        if result.overall_verdict is not None
+    ]
+    if mappings:
+        db.bulk_update_mappings(models.InspectionResult, mappings)
+        entries = []
+        if audit.durability(models.InspectionResult.__tablename__):
+            columns = ("overall_verdict", "is_defect_detected", "status")
+            entries = [
+                audit.update_entry(
+                    models.InspectionResult.__tablename__,
+                    row.id,
+                    {column: getattr(row, column) for column in columns},
+                    {column: getattr(result, column) for column in columns}
+                )
+                for row, result in zip(rows, results)
+                if result.overall_verdict is not None
+            ]
+        _commit(db, models.InspectionResult.__tablename__, entries)
+    return len(mappings)
+
+
+def get_anomaly_alerts(
+    db: Session,
+    skip: int = 0,
+    limit: int = 100,
+    inspection_point_id: Optional[int] = None
+) -> List[models.AnomalyAlert]:
+    query = db.query(models.AnomalyAlert)
+    
+    if inspection_point_id:
+        query = query.filter(models.AnomalyAlert.inspection_point_id == inspection_point_id)
+    
+    return query.order_by(models.AnomalyAlert.id.desc()).offset(skip).limit(limit).all()
+
 
 def get_inspection_result(db: Session, inspection_id: int) -> Optional[models.InspectionResult]:
     return db.query(models.InspectionResult).filter(models.InspectionResult.id == inspection_id).first()
 
 
-def update_inspection_result(db: Session, inspection_id: int, inspection_update: schemas.InspectionResultUpdate) -> Optional[models.InspectionResult]:
-    db_inspection = get_inspection_result(db, inspection_id)
-    if db_inspection:
-        update_data = inspection_update.model_dump(exclude_unset=True)
-        for field, value in update_data.items():
-            setattr(db_inspection, field, value)
-        
-        db_inspection.updated_at = datetime.utcnow()
-        db.commit()
-        db.refresh(db_inspection)
-    
-    return db_inspection
+def update_inspection_result(
+    db: Session,
+    inspection_id: int,
+    inspection_update: schemas.InspectionResultUpdate,
+    expected_version: Optional[int] = None
+) -> Optional[models.InspectionResult]:
+    return _update_returning(
+        db,
+        models.InspectionResult,
+        models.InspectionResult.id == inspection_id,
+        inspection_update.model_dump(exclude_unset=True),
+        expected_version=expected_version
+    )
 
 
-def delete_inspection_result(db: Session, inspection_id: int) -> bool:
-    db_inspection = get_inspection_result(db, inspection_id)
-    if db_inspection:
-        db.delete(db_inspection)
-        db.commit()
-        return True
-    return False
+def delete_inspection_result(db: Session, inspection_id: int, expected_version: Optional[int] = None) -> bool:
+    return _delete_returning(
+        db,
+        models.InspectionResult,
+        models.InspectionResult.id == inspection_id,
+        expected_version=expected_version
+    )
+
+
+def _existing_ids(db: Session, model, ids) -> set:
+    ids = {value for value in ids if value is not None}
+    if not ids:
+        return set()
+    return set(db.scalars(select(model.id).where(model.id.in_(ids))))
+
+
+def _insert_edge_records(
+    db: Session,
+    records: List[Dict[str, Any]],
+    rows: List[Dict[str, Any]],
+    alerts: Dict[str, Dict[str, Any]]
+) -> Set[str]:
+    """Вставляет записи пакета; возвращает edge_id действительно вставленных (не повторов)"""
+    inspections = models.InspectionResult.__table__
+    inserted = set(db.scalars(
+        pg_insert(inspections)
+        .on_conflict_do_nothing(index_elements=["edge_id", "inspection_time"])
+        .returning(inspections.c.edge_id),
+        rows
+    ))
+    
+    # id принятых строк (и вставленных ранее) - для ссылок дефектов; диапазон времени отсекает секции
+    times = [record["inspection_time"] for record in records]
+    ids = dict(db.execute(
+        select(inspections.c.edge_id, inspections.c.id).where(
+            inspections.c.edge_id.in_([record["edge_id"] for record in records]),
+            inspections.c.inspection_time.between(min(times), max(times))
+        )
+    ).all())
+    defects = [
+        dict(defect, inspection_result_id=ids[record["edge_id"]], inspection_time=record["inspection_time"])
+        for record in records
+        for defect in record["defects"]
+    ]
+    if defects:
+        # defect_count результата увеличивает триггер только для действительно вставленных дефектов
+        db.execute(
+            pg_insert(models.DefectDetail.__table__).on_conflict_do_nothing(index_elements=["edge_id", "inspection_time"]),
+            defects
+        )
+    # Тревоги только для впервые вставленных результатов: повторная пересылка их не дублирует
+    anomaly_alerts = [
+        dict(alerts[record["edge_id"]], inspection_result_id=ids[record["edge_id"]], inspection_time=record["inspection_time"])
+        for record in records
+        if record["edge_id"] in inserted and record["edge_id"] in alerts
+    ]
+    if anomaly_alerts:
+        db.execute(insert(models.AnomalyAlert.__table__), anomaly_alerts)
+    return inserted
+
+
+def _insert_edge_records_bisect(
+    db: Session,
+    records: List[Dict[str, Any]],
+    rows: List[Dict[str, Any]],
+    alerts: Dict[str, Dict[str, Any]],
+    rejected: Dict[str, str]
+) -> Set[str]:
+    """Вставка в точке сохранения; при нарушении ограничения пакет делится пополам, пока не
+    останется одна запись - она отклоняется, остальные принимаются"""
+    try:
+        with db.begin_nested():
+            return _insert_edge_records(db, records, rows, alerts)
+    except (IntegrityError, DataError) as e:
+        if len(records) == 1:
+            rejected[records[0]["edge_id"]] = f"Rejected by central database: {str(e.orig).splitlines()[0]}"
+            return set()
+        middle = len(records) // 2
+        return (
+            _insert_edge_records_bisect(db, records[:middle], rows[:middle], alerts, rejected)
+            | _insert_edge_records_bisect(db, records[middle:], rows[middle:], alerts, rejected)
+        )
+
+
+def forward_edge_inspections(db: Session, records: List[Dict[str, Any]]) -> Dict[str, str]:
+    """Принимает пакет результатов контроля с линейного узла одной транзакцией.
+
+    records - строки inspection_results с edge_id и списком строк defect_details в "defects".
+    INSERT ... ON CONFLICT DO NOTHING по (edge_id, inspection_time): повторная пересылка пакета
+    после обрыва связи ничего не меняет. Вердикт вычисляется по спецификациям центральной базы,
+    как при создании через API, sensor_readings проверяет детектор выбросов в порядке inspection_time.
+    Возвращает отклоненные записи: edge_id -> причина; запись, нарушающая ограничения центральной
+    базы, отклоняется, не блокируя очередь узла.
+    """
+    batches = dict(db.execute(
+        select(models.ProductionBatch.id, models.ProductionBatch.product_type_id)
+        .where(models.ProductionBatch.id.in_({record["batch_id"] for record in records}))
+    ).all())
+    points = _existing_ids(db, models.InspectionPoint, (record["inspection_point_id"] for record in records))
+    defect_types = _existing_ids(
+        db, models.DefectType, (defect["defect_type_id"] for record in records for defect in record["defects"])
+    )
+    
+    rejected = {}
+    accepted = []
+    for record in records:
+        unknown_types = sorted({defect["defect_type_id"] for defect in record["defects"]} - defect_types)
+        if record["batch_id"] not in batches:
+            rejected[record["edge_id"]] = f"Unknown batch_id: {record['batch_id']}"
+        elif record["inspection_point_id"] is not None and record["inspection_point_id"] not in points:
+            rejected[record["edge_id"]] = f"Unknown inspection_point_id: {record['inspection_point_id']}"
+        elif unknown_types:
+            rejected[record["edge_id"]] = f"Unknown defect_type_id: {', '.join(map(str, unknown_types))}"
+        else:
+            accepted.append(record)
+    if not accepted:
+        return rejected
+    
+    results = verdict.get_rules(db).evaluate_bulk(
+        [batches[record["batch_id"]] for record in accepted],
+        [record["measurement_data"] for record in accepted]
+    )
+    rows = []
+    for record, result in zip(accepted, results):
+        row = {column: value for column, value in record.items() if column != "defects"}
+        if result.overall_verdict is not None:
+            row.update(
+                overall_verdict=result.overall_verdict,
+                is_defect_detected=result.is_defect_detected,
+                status=result.status
+            )
+        rows.append(row)
+    
+    # Детектор видит показания точки по порядку; состояние меняется только после commit
+    observations = {}
+    alerts = {}
+    previous = {}
+    for index in sorted(range(len(accepted)), key=lambda index: accepted[index]["inspection_time"]):
+        record, row = accepted[index], rows[index]
+        readings = (record["measurement_data"] or {}).get(anomaly.SENSOR_READINGS_KEY)
+        if readings is None:
+            continue
+        point = record["inspection_point_id"]
+        observation = anomaly.detector.check(point, readings, previous.get(point))
+        if observation is None:
+            continue
+        previous[point] = observations[record["edge_id"]] = observation
+        report = observation.report
+        if report:
+            row["measurement_data"] = {**record["measurement_data"], "anomaly": report.as_dict()}
+            alerts[record["edge_id"]] = {
+                "inspection_point_id": point,
+                "detectors": report.detectors,
+                "flagged_count": len(report.flagged_indices),
+                "details": report.details,
+            }
+    
+    inserted = _insert_edge_records_bisect(db, accepted, rows, alerts, rejected)
+    db.commit()
+    for edge_id, observation in observations.items():
+        if edge_id in inserted:
+            observation.apply()
+    return rejected
 
 
 def get_defect_type(db: Session, defect_type_id: int) -> Optional[models.DefectType]:
@@ -272,26 +944,34 @@ def create_defect_type(db: Session, defect_type: schemas.DefectTypeCreate) -> mo
     db.add(db_defect_type)
     db.commit()
     db.refresh(db_defect_type)
+    verdict.invalidate_rules()
     return db_defect_type
 
 
-def update_defect_type(db: Session, defect_type_id: int, defect_type_update: schemas.DefectTypeUpdate) -> Optional[models.DefectType]:
-    db_defect_type = get_defect_type(db, defect_type_id)
+def update_defect_type(
+    db: Session,
+    defect_type_id: int,
+    defect_type_update: schemas.DefectTypeUpdate,
+    expected_version: Optional[int] = None
+) -> Optional[models.DefectType]:
+    db_defect_type = _update_returning(
+        db,
+        models.DefectType,
+        models.DefectType.id == defect_type_id,
+        defect_type_update.model_dump(exclude_unset=True),
+        expected_version=expected_version
+    )
     if db_defect_type:
-        update_data = defect_type_update.model_dump(exclude_unset=True)
-        for field, value in update_data.items():
-            setattr(db_defect_type, field, value)
-        
-        db.commit()
-        db.refresh(db_defect_type)
-    
+        verdict.invalidate_rules()
     return db_defect_type
 
 
-def delete_defect_type(db: Session, defect_type_id: int) -> bool:
-    db_defect_type = get_defect_type(db, defect_type_id)
-    if db_defect_type:
-        db.delete(db_defect_type)
-        db.commit()
+def delete_defect_type(db: Session, defect_type_id: int, expected_version: Optional[int] = None) -> bool:
+    if _delete_returning(db, models.DefectType, models.DefectType.id == defect_type_id, expected_version=expected_version):
+        verdict.invalidate_rules()
         return True
-    return False
\ No newline at end of file
+    return False
+
+
+# Каждая функция crud - спан в трассе запроса
+tracing.instrument_module(globals(), "crud")
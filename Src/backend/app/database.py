@@ -1,23 +1,207 @@
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi import HTTPException, Request, status
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 from .config import settings
+from .utils import json_dumps
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKLOAD = "interactive"
+DEFAULT_PLANT = settings.DEFAULT_PLANT
+
+# Выбор завода запроса: заголовок X-Plant или ?plant=; несколько через запятую или all
+PLANT_HEADER = "x-plant"
+PLANT_QUERY = "plant"
+ALL_PLANTS = ("all", "*")
+
+
+class ShardUnavailable(Exception):
+    """База завода не ответила при чтении по нескольким заводам"""
+
+    def __init__(self, plant: str):
+        super().__init__(f"Plant {plant} is unavailable")
+        self.plant = plant
+
+
+def _create_engine(url: str, plant: str, limits: Dict[str, int]) -> Engine:
+    return create_engine(
+        url,
+        pool_pre_ping=True,
+        pool_recycle=300,
+        pool_size=limits["pool_size"],
+        max_overflow=limits["max_overflow"],
+        json_serializer=json_dumps,
+        # Код завода виден в контексте выполнения: им заполняется plant_code новых строк
+        execution_options={"plant": plant},
+        echo=False
+    )
+
+
+class ShardRouter:
+    """Завод -> своя база: engine и отдельный пул соединений на каждый класс нагрузки.
 
-engine = create_engine(
-    settings.DATABASE_URL,
-    pool_pre_ping=True,
-    pool_recycle=300,
-    echo=False 
-)
+    Строки производственных таблиц лежат в базе своего завода, id уникальны только в ней;
+    пользователи, роли, задачи и журнал аудита - в центральной базе (завод DEFAULT_PLANT).
+    """
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    def __init__(self, urls: Dict[str, str], workload_classes: Dict[str, Dict[str, int]]):
+        if DEFAULT_PLANT not in urls:
+            raise RuntimeError(f"DEFAULT_PLANT {DEFAULT_PLANT!r} is missing in PLANTS")
+        # Отдельный пул соединений на каждый класс нагрузки: отчеты не могут занять
+        # соединения, зарезервированные за приемом результатов контроля
+        self.engines = {
+            plant: {name: _create_engine(url, plant, limits) for name, limits in workload_classes.items()}
+            for plant, url in urls.items()
+        }
+        # Сессия запроса живет недолго, поэтому объекты не устаревают после commit: записи,
+        # возвращенные UPDATE ... RETURNING, не перечитываются повторным SELECT
+        self.session_factories = {
+            plant: {
+                name: sessionmaker(
+                    autocommit=False, autoflush=False, expire_on_commit=False, bind=class_engine, info={"plant": plant}
+                )
+                for name, class_engine in plant_engines.items()
+            }
+            for plant, plant_engines in self.engines.items()
+        }
+
+    @property
+    def plants(self) -> List[str]:
+        return list(self.engines)
+
+    def engine(self, plant: str, workload: str = DEFAULT_WORKLOAD) -> Engine:
+        return self.engines[plant][workload]
+
+    def session(self, plant: str, workload: str = DEFAULT_WORKLOAD) -> Session:
+        return self.session_factories[plant][workload]()
+
+    def all_engines(self) -> List[Engine]:
+        return [class_engine for plant_engines in self.engines.values() for class_engine in plant_engines.values()]
+
+
+# Без PLANTS - один завод в DATABASE_URL
+shards = ShardRouter(settings.PLANTS or {DEFAULT_PLANT: settings.DATABASE_URL}, settings.WORKLOAD_CLASSES)
+
+# Центральная база
+engines = shards.engines[DEFAULT_PLANT]
+engine = engines[DEFAULT_WORKLOAD]
+session_factories = shards.session_factories[DEFAULT_PLANT]
+SessionLocal = session_factories[DEFAULT_WORKLOAD]
+# Для фоновых задач, обслуживания и отчетов вне запросов
+ReportingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engines["reporting"], info={"plant": DEFAULT_PLANT})
 
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
+def plant_of(db: Session) -> str:
+    """Завод, к базе которого привязана сессия"""
+    return db.info.get("plant", DEFAULT_PLANT)
+
+
+def current_plant(context) -> str:
+    """Значение plant_code по умолчанию: завод, в базу которого пишется строка"""
+    return context.execution_options.get("plant", DEFAULT_PLANT)
+
+
+def get_db(request: Request):
+    # Класс нагрузки запроса проставляет WorkloadMiddleware
+    db = session_factories[request.scope.get("workload", DEFAULT_WORKLOAD)]()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+def get_plants(request: Request) -> List[str]:
+    """Заводы, выбранные запросом; без выбора - DEFAULT_PLANT"""
+    value = request.headers.get(PLANT_HEADER) or request.query_params.get(PLANT_QUERY)
+    if not value:
+        return [DEFAULT_PLANT]
+    if value.strip().lower() in ALL_PLANTS:
+        return shards.plants
+    plants = list(dict.fromkeys(plant.strip() for plant in value.split(",") if plant.strip()))
+    unknown = [plant for plant in plants if plant not in shards.engines]
+    if unknown or not plants:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown plant: {', '.join(unknown) or value}. Allowed: {', '.join(shards.plants)}"
+        )
+    return plants
+
+
+def get_plant_db(request: Request):
+    """Сессия базы выбранного завода (производственные данные)"""
+    plants = get_plants(request)
+    if len(plants) != 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Select a single plant for this request"
+        )
+    db = shards.session(plants[0], request.scope.get("workload", DEFAULT_WORKLOAD))
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_plant_sessions(request: Request):
+    """Сессии всех выбранных заводов для чтения с параллельным опросом баз (fan_out)"""
+    workload = request.scope.get("workload", DEFAULT_WORKLOAD)
+    sessions = {plant: shards.session(plant, workload) for plant in get_plants(request)}
+    try:
+        yield sessions
+    finally:
+        for db in sessions.values():
+            db.close()
+
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=settings.SHARD_FANOUT_WORKERS, thread_name_prefix="shard-fanout")
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def fan_out(sessions: Dict[str, Session], fn: Callable[[Session], Any]) -> Dict[str, Any]:
+    """Выполняет fn в сессии каждого завода параллельно; результаты в порядке заводов.
+
+    Контекст запроса (трассировка, профилирование, автор для аудита) копируется в потоки.
+    Ошибка любого завода - ShardUnavailable после завершения остальных: сессии не закрываются
+    под работающим потоком.
+    """
+    if len(sessions) == 1:
+        plant, db = next(iter(sessions.items()))
+        return {plant: fn(db)}
+    pool = _get_pool()
+    futures = {plant: pool.submit(contextvars.copy_context().run, fn, db) for plant, db in sessions.items()}
+    wait(futures.values())
+    results = {}
+    for plant, future in futures.items():
+        error = future.exception()
+        if error is not None:
+            logger.error("Fan-out read failed for plant %s", plant, exc_info=error)
+            raise ShardUnavailable(plant) from error
+        results[plant] = future.result()
+    return results
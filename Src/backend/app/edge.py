@@ -0,0 +1,515 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import Column, DateTime, Integer, JSON, MetaData, String, Table, Text, create_engine, delete, event, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker
+
+from . import models, schemas, crud, tracing
+from .config import settings
+from .database import SessionLocal, shards
+from .utils import json_dumps
+
+logger = logging.getLogger(__name__)
+
+# Очередь на пересылку - те же таблицы inspection_results и defect_details, что в центральной базе
+EDGE_TABLES = [models.InspectionResult.__table__, models.DefectDetail.__table__]
+
+# Колонки, которые пересылаются в центральную базу. defect_count не пересылается:
+# его увеличивает триггер центральной базы при вставке дефектов
+INSPECTION_COLUMNS = (
+    "edge_id", "batch_id", "inspection_point_id", "inspection_time", "plant_code", "inspector_id",
+    "inspector_name", "measurement_data", "is_defect_detected", "overall_verdict", "status", "notes",
+)
+DEFECT_COLUMNS = ("edge_id", "defect_type_id", "defect_location", "severity", "size_mm", "image_path")
+
+# Служебные таблицы, которые есть только на узле
+edge_metadata = MetaData()
+
+# Записи, которые центральная база не примет (неизвестная партия, тип дефекта): убираются из очереди,
+# чтобы не блокировать пересылку остальных
+rejected_records = Table(
+    "edge_rejected",
+    edge_metadata,
+    Column("edge_id", String(36), primary_key=True),
+    Column("reason", Text, nullable=False),
+    Column("payload", JSON, nullable=False),
+    Column("rejected_at", DateTime(timezone=True), nullable=False),
+)
+
+# Переданные в центральную базу записи за EDGE_FORWARDED_RETENTION: повтор запроса с тем же edge_id
+# после пересылки не создает новую запись (со своим inspection_time это был бы дубль в центральной базе)
+forwarded_records = Table(
+    "edge_forwarded",
+    edge_metadata,
+    Column("edge_id", String(36), primary_key=True),
+    Column("local_id", Integer, nullable=False),
+    Column("inspection_time", DateTime(timezone=True), nullable=False),
+    Column("batch_id", Integer, nullable=False),
+    Column("defect_count", Integer, nullable=False),
+    Column("forwarded_at", DateTime(timezone=True), nullable=False, index=True),
+)
+
+# Пользователи, прошедшие проверку по центральной базе: без связи токен проверяется по этой копии
+cached_principals = Table(
+    "edge_principals",
+    edge_metadata,
+    Column("username", String(100), primary_key=True),
+    Column("user_id", Integer, nullable=False),
+    Column("full_name", String(200)),
+    Column("permissions", JSON, nullable=False),
+    Column("cached_at", DateTime(timezone=True), nullable=False),
+)
+
+
+@dataclass(frozen=True)
+class Principal:
+    id: int
+    username: str
+    full_name: Optional[str]
+    permissions: Dict[str, Any]
+
+
+def _utc(value: datetime) -> datetime:
+    # SQLite хранит время без зоны; на узле оно всегда в UTC
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+def _configure_sqlite(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    # WAL: чтение очереди пересылкой не блокирует запись. synchronous=NORMAL - commit без fsync
+    # каждой транзакции; при отключении питания теряются последние транзакции, но не целостность базы
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+class EdgeStore:
+    """Встроенная база линейного узла (SQLite): результаты контроля записываются без сети.
+
+    Записанные результаты и есть очередь: после подтверждения центральной базой они удаляются.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.engine = None
+        self.Session = None
+        # id в составном ключе SQLite не генерирует: выдаются max + 1 под блокировкой
+        self._write_lock = threading.Lock()
+        self._principals: Dict[str, Principal] = {}
+
+    def open(self) -> None:
+        if self.engine is not None:
+            return
+        path = self.url.split("sqlite:///", 1)[-1]
+        if self.url.startswith("sqlite:///") and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        engine = create_engine(
+            self.url,
+            connect_args={"check_same_thread": False, "timeout": 30},
+            json_serializer=json_dumps,
+            # plant_code новых строк - завод, в базу которого они будут пересланы
+            execution_options={"plant": settings.EDGE_PLANT},
+        )
+        event.listen(engine, "connect", _configure_sqlite)
+        models.Base.metadata.create_all(engine, tables=EDGE_TABLES)
+        edge_metadata.create_all(engine)
+        self.Session = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+        self.engine = engine
+
+    def close(self) -> None:
+        if self.engine is not None:
+            self.engine.dispose()
+            self.engine = None
+
+    def record(self, inspection: schemas.EdgeInspectionCreate) -> Tuple[models.InspectionResult, bool]:
+        """Записывает результат с дефектами одной локальной транзакцией; False - edge_id уже был записан"""
+        edge_id = str(inspection.edge_id or uuid.uuid4())
+        inspection_time = _utc(inspection.inspection_time or datetime.now(timezone.utc))
+        values = inspection.model_dump(exclude={"edge_id", "inspection_time", "defects"})
+        with self._write_lock, self.Session() as db:
+            existing = db.query(models.InspectionResult).filter(models.InspectionResult.edge_id == edge_id).first()
+            if existing is not None:
+                return existing, False
+            forwarded = db.execute(select(forwarded_records).where(forwarded_records.c.edge_id == edge_id)).first()
+            if forwarded is not None:
+                return models.InspectionResult(
+                    id=forwarded.local_id,
+                    edge_id=edge_id,
+                    inspection_time=_utc(forwarded.inspection_time),
+                    batch_id=forwarded.batch_id,
+                    defect_count=forwarded.defect_count
+                ), False
+
+            inspection_id = db.scalar(select(func.coalesce(func.max(models.InspectionResult.id), 0) + 1))
+            db_inspection = models.InspectionResult(
+                id=inspection_id,
+                edge_id=edge_id,
+                inspection_time=inspection_time,
+                is_defect_detected=bool(inspection.defects),
+                defect_count=len(inspection.defects),
+                created_at=datetime.now(timezone.utc),
+                **values
+            )
+            db.add(db_inspection)
+            defect_id = db.scalar(select(func.coalesce(func.max(models.DefectDetail.id), 0)))
+            for number, defect in enumerate(inspection.defects, start=1):
+                db.add(models.DefectDetail(
+                    id=defect_id + number,
+                    edge_id=str(defect.edge_id or uuid.uuid4()),
+                    inspection_result_id=inspection_id,
+                    inspection_time=inspection_time,
+                    **defect.model_dump(exclude={"edge_id"})
+                ))
+            db.commit()
+            return db_inspection, True
+
+    def pending(self, limit: int) -> List[Dict[str, Any]]:
+        """Самые старые записи очереди в порядке записи, с дефектами в "defects" """
+        inspections = models.InspectionResult.__table__
+        defects = models.DefectDetail.__table__
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(inspections.c.id, *(inspections.c[column] for column in INSPECTION_COLUMNS))
+                .order_by(inspections.c.id)
+                .limit(limit)
+            ).all()
+            if not rows:
+                return []
+            defect_rows = conn.execute(
+                select(defects.c.inspection_result_id, *(defects.c[column] for column in DEFECT_COLUMNS))
+                .where(defects.c.inspection_result_id.in_([row.id for row in rows]))
+                .order_by(defects.c.id)
+            ).all()
+
+        by_inspection: Dict[int, List[Dict[str, Any]]] = {}
+        for row in defect_rows:
+            by_inspection.setdefault(row.inspection_result_id, []).append({column: row._mapping[column] for column in DEFECT_COLUMNS})
+        records = []
+        for row in rows:
+            record = {column: row._mapping[column] for column in INSPECTION_COLUMNS}
+            record["inspection_time"] = _utc(record["inspection_time"])
+            record["local_id"] = row.id
+            record["defects"] = by_inspection.get(row.id, [])
+            records.append(record)
+        return records
+
+    def complete(self, records: List[Dict[str, Any]], rejected: Dict[str, str]) -> None:
+        """Убирает из очереди принятые центральной базой записи; отклоненные переносит в edge_rejected"""
+        ids = [record["local_id"] for record in records]
+        now = datetime.now(timezone.utc)
+        forwarded = [
+            {
+                "edge_id": record["edge_id"],
+                "local_id": record["local_id"],
+                "inspection_time": record["inspection_time"],
+                "batch_id": record["batch_id"],
+                "defect_count": len(record["defects"]),
+                "forwarded_at": now,
+            }
+            for record in records
+            if record["edge_id"] not in rejected
+        ]
+        with self._write_lock, self.engine.begin() as conn:
+            if forwarded:
+                conn.execute(sqlite_insert(forwarded_records).on_conflict_do_nothing(), forwarded)
+            conn.execute(delete(forwarded_records).where(
+                forwarded_records.c.forwarded_at < now - timedelta(seconds=settings.EDGE_FORWARDED_RETENTION)
+            ))
+            if rejected:
+                conn.execute(
+                    sqlite_insert(rejected_records).on_conflict_do_nothing(),
+                    [
+                        {
+                            "edge_id": record["edge_id"],
+                            "reason": rejected[record["edge_id"]],
+                            "payload": jsonable_encoder({k: v for k, v in record.items() if k != "local_id"}),
+                            "rejected_at": now,
+                        }
+                        for record in records
+                        if record["edge_id"] in rejected
+                    ]
+                )
+            conn.execute(delete(models.DefectDetail.__table__).where(models.DefectDetail.__table__.c.inspection_result_id.in_(ids)))
+            conn.execute(delete(models.InspectionResult.__table__).where(models.InspectionResult.__table__.c.id.in_(ids)))
+
+    def backlog(self) -> Tuple[int, Optional[datetime]]:
+        """Размер очереди и время записи самого старого результата в ней"""
+        inspections = models.InspectionResult.__table__
+        with self.engine.connect() as conn:
+            count, oldest = conn.execute(select(func.count(), func.min(inspections.c.created_at))).one()
+        return count, _utc(oldest) if oldest is not None else None
+
+    def rejected(self, skip: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(rejected_records).order_by(rejected_records.c.rejected_at.desc()).offset(skip).limit(limit)
+            ).all()
+        return [dict(row._mapping, rejected_at=_utc(row.rejected_at)) for row in rows]
+
+    def rejected_count(self) -> int:
+        with self.engine.connect() as conn:
+            return conn.scalar(select(func.count()).select_from(rejected_records))
+
+    def requeue(self, edge_ids: Optional[List[str]] = None) -> int:
+        """Возвращает отклоненные записи в очередь пересылки (все или edge_ids), например после того,
+        как в центральной базе завели недостающую партию. edge_id и inspection_time сохраняются,
+        поэтому повторная пересылка не создает дублей. Возвращает число возвращенных записей.
+        """
+        inspections = models.InspectionResult.__table__
+        defects = models.DefectDetail.__table__
+        query = select(rejected_records.c.edge_id, rejected_records.c.payload)
+        if edge_ids is not None:
+            query = query.where(rejected_records.c.edge_id.in_(edge_ids))
+        now = datetime.now(timezone.utc)
+        with self._write_lock, self.engine.begin() as conn:
+            rows = conn.execute(query.order_by(rejected_records.c.rejected_at)).all()
+            if not rows:
+                return 0
+            inspection_id = conn.scalar(select(func.coalesce(func.max(inspections.c.id), 0)))
+            defect_id = conn.scalar(select(func.coalesce(func.max(defects.c.id), 0)))
+            inspection_rows = []
+            defect_rows = []
+            for row in rows:
+                payload = row.payload
+                inspection_id += 1
+                inspection_time = _utc(datetime.fromisoformat(payload["inspection_time"]))
+                inspection_rows.append(dict(
+                    {column: payload.get(column) for column in INSPECTION_COLUMNS},
+                    id=inspection_id,
+                    inspection_time=inspection_time,
+                    defect_count=len(payload["defects"]),
+                    created_at=now
+                ))
+                for defect in payload["defects"]:
+                    defect_id += 1
+                    defect_rows.append(dict(
+                        {column: defect.get(column) for column in DEFECT_COLUMNS},
+                        id=defect_id,
+                        inspection_result_id=inspection_id,
+                        inspection_time=inspection_time
+                    ))
+            conn.execute(inspections.insert(), inspection_rows)
+            if defect_rows:
+                conn.execute(defects.insert(), defect_rows)
+            conn.execute(delete(rejected_records).where(rejected_records.c.edge_id.in_([row.edge_id for row in rows])))
+        return len(rows)
+
+    def remember_principal(self, principal: Principal) -> None:
+        if self._principals.get(principal.username) == principal:
+            return
+        values = {
+            "username": principal.username,
+            "user_id": principal.id,
+            "full_name": principal.full_name,
+            "permissions": principal.permissions,
+            "cached_at": datetime.now(timezone.utc),
+        }
+        statement = sqlite_insert(cached_principals).values(values)
+        with self.engine.begin() as conn:
+            conn.execute(statement.on_conflict_do_update(index_elements=["username"], set_=values))
+        self._principals[principal.username] = principal
+
+    def cached_principal(self, username: str) -> Optional[Principal]:
+        principal = self._principals.get(username)
+        if principal is not None:
+            return principal
+        with self.engine.connect() as conn:
+            row = conn.execute(select(cached_principals).where(cached_principals.c.username == username)).first()
+        if row is None:
+            return None
+        principal = Principal(row.user_id, row.username, row.full_name, row.permissions)
+        self._principals[username] = principal
+        return principal
+
+
+class RateWindow:
+    """Число событий за последние EDGE_RATE_WINDOW секунд"""
+
+    def __init__(self):
+        self._events: Deque[Tuple[float, int, float]] = deque()
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float) -> None:
+        while self._events and self._events[0][0] < now - settings.EDGE_RATE_WINDOW:
+            self._events.popleft()
+
+    def add(self, count: int, busy: float = 0.0) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._events.append((now, count, busy))
+            self._prune(now)
+
+    def rates(self, since: float) -> Tuple[float, float]:
+        """События в секунду за окно (или с запуска, если он был позже) и в секунду занятого времени"""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            count = sum(event[1] for event in self._events)
+            busy = sum(event[2] for event in self._events)
+        span = min(settings.EDGE_RATE_WINDOW, now - since)
+        return (count / span if span > 0 else 0.0), (count / busy if busy > 0 else 0.0)
+
+
+class Forwarder:
+    """Фоновая пересылка очереди узла в базу завода EDGE_PLANT пакетами по EDGE_FORWARD_BATCH_SIZE.
+
+    Пока очередь не пуста, пакеты идут подряд; при недоступной центральной базе попытки
+    повторяются с растущей паузой до EDGE_RETRY_MAX_BACKOFF. Пакет удаляется из очереди только
+    после commit в центральной базе, а повторная пересылка идемпотентна - после обрыва связи
+    или перезапуска пересылка продолжается с первой неподтвержденной записи.
+    """
+
+    def __init__(self, store: EdgeStore):
+        self.store = store
+        self._stop_event = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._started_at = time.monotonic()
+        self.recorded = RateWindow()
+        self.drained = RateWindow()
+        self.connected = False
+        self.forwarded = 0
+        self.failures = 0
+        self.last_forward_at: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+    def forward_batch(self) -> int:
+        """Пересылает один пакет; возвращает число записей, убранных из очереди"""
+        records = self.store.pending(settings.EDGE_FORWARD_BATCH_SIZE)
+        started = time.monotonic()
+        db = shards.session(settings.EDGE_PLANT, "ingestion")
+        try:
+            if not records:
+                # Очередь пуста: проверяем связь, чтобы connected отражал доступность центральной базы
+                db.execute(select(1))
+                return 0
+            rejected = crud.forward_edge_inspections(
+                db, [{k: v for k, v in record.items() if k != "local_id"} for record in records]
+            )
+        finally:
+            db.close()
+        self.store.complete(records, rejected)
+        if rejected:
+            logger.warning("Central DB rejected %s edge inspections, moved to edge_rejected", len(rejected))
+        self.drained.add(len(records), time.monotonic() - started)
+        self.forwarded += len(records) - len(rejected)
+        self.last_forward_at = datetime.now(timezone.utc)
+        return len(records)
+
+    def _run(self) -> None:
+        backoff = 0.0
+        while not self._stop_event.is_set():
+            try:
+                count = self.forward_batch()
+            except Exception as e:
+                self.connected = False
+                self.failures += 1
+                self.last_error = str(e).splitlines()[0] if str(e) else type(e).__name__
+                backoff = min(max(backoff * 2, settings.EDGE_FORWARD_INTERVAL), settings.EDGE_RETRY_MAX_BACKOFF)
+                logger.warning("Edge forward failed, retry in %.1fs: %s", backoff, self.last_error)
+                self._sleep(backoff)
+                continue
+            self.connected = True
+            self.last_error = None
+            backoff = 0.0
+            if count < settings.EDGE_FORWARD_BATCH_SIZE:
+                self._sleep(settings.EDGE_FORWARD_INTERVAL)
+
+    def _sleep(self, seconds: float) -> None:
+        self._wake.wait(seconds)
+        self._wake.clear()
+
+    def wake(self) -> None:
+        """Пересылка без ожидания интервала или паузы после ошибки"""
+        self._wake.set()
+
+    def start(self) -> None:
+        if not settings.EDGE_MODE or (self._thread is not None and self._thread.is_alive()):
+            return
+        self.store.open()
+        self._stop_event.clear()
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="edge-forwarder", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        # Очередь хранится в SQLite: неотправленное будет переслано после перезапуска
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.store.close()
+
+    def status(self) -> Dict[str, Any]:
+        backlog, oldest = self.store.backlog()
+        record_rate, _ = self.recorded.rates(self._started_at)
+        drain_rate, throughput = self.drained.rates(self._started_at)
+        if backlog == 0:
+            eta = 0.0
+        elif self.connected and throughput > record_rate:
+            eta = backlog / (throughput - record_rate)
+        else:
+            eta = None
+        return {
+            "plant_code": settings.EDGE_PLANT,
+            "connected": self.connected,
+            "backlog": backlog,
+            "oldest_pending_at": oldest,
+            "forwarded": self.forwarded,
+            "rejected": self.store.rejected_count(),
+            "failures": self.failures,
+            "last_forward_at": self.last_forward_at,
+            "last_error": self.last_error,
+            "record_rate": round(record_rate, 3),
+            "drain_rate": round(drain_rate, 3),
+            "forward_throughput": round(throughput, 3),
+            "drain_eta_seconds": round(eta, 1) if eta is not None else None,
+        }
+
+
+store = EdgeStore(settings.EDGE_DATABASE_URL)
+forwarder = Forwarder(store)
+
+
+def record_inspection(inspection: schemas.EdgeInspectionCreate) -> Tuple[models.InspectionResult, bool]:
+    db_inspection, created = store.record(inspection)
+    if created:
+        forwarder.recorded.add(1)
+    return db_inspection, created
+
+
+def authenticate(username: str) -> Optional[Principal]:
+    """Пользователь токена: по центральной базе, а без связи с ней - по копии на узле"""
+    if forwarder.connected:
+        db = SessionLocal()
+        try:
+            user = crud.get_user_by_username(db, username=username)
+            principal = None
+            if user is not None and user.is_active:
+                principal = Principal(
+                    user.id, user.username, user.full_name, dict(user.role.permissions or {}) if user.role else {}
+                )
+        except DBAPIError:
+            logger.warning("Central DB is unavailable, using cached principal for %s", username)
+        else:
+            if principal is None:
+                return None
+            store.remember_principal(principal)
+            return principal
+        finally:
+            db.close()
+    # Ожидание соединения с недоступной базой не задерживает запись результатов
+    return store.cached_principal(username)
+
+
+tracing.instrument_module(globals(), "edge")
@@ -0,0 +1,228 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional, Dict, Tuple, List, Any, Type
+
+from fastapi import Response
+from pydantic import BaseModel, TypeAdapter, AliasChoices, create_model
+from pydantic.fields import FieldInfo
+from sqlalchemy import inspect, select
+from sqlalchemy.orm import Session, aliased
+
+from . import models, schemas, wire
+
+
+@dataclass(frozen=True)
+class Resource:
+    model: Any
+    schema: Type[BaseModel]
+    # Вложенный объект схемы -> имя ресурса, на который он ссылается
+    relations: Dict[str, str]
+    # Поля, которые возвращаются всегда (первичный ключ; для производственных данных и завод)
+    required: Tuple[str, ...] = ("id",)
+
+    @property
+    def scalar_fields(self) -> List[str]:
+        return [name for name in self.schema.model_fields if name not in self.relations]
+
+    def column(self, field: str):
+        # Поле схемы сопоставляется с атрибутом модели по имени колонки таблицы
+        for prop in inspect(self.model).column_attrs:
+            if prop.columns[0].name == field:
+                return getattr(self.model, prop.key)
+        raise KeyError(field)
+
+
+RESOURCES = {
+    "product_types": Resource(models.ProductType, schemas.ProductType, {}),
+    "defect_types": Resource(models.DefectType, schemas.DefectType, {}),
+    "inspection_points": Resource(models.InspectionPoint, schemas.InspectionPoint, {}),
+    "batches": Resource(
+        models.ProductionBatch,
+        schemas.ProductionBatch,
+        {"product_type": "product_types"},
+        required=("id", "plant_code")
+    ),
+    "inspections": Resource(
+        models.InspectionResult,
+        schemas.InspectionResult,
+        {"batch": "batches"},
+        required=("id", "inspection_time", "plant_code")
+    ),
+    "defects": Resource(
+        models.DefectDetail,
+        schemas.BatchDefect,
+        {"defect_type": "defect_types"},
+        required=("id", "inspection_time", "plant_code")
+    ),
+}
+
+
+@dataclass(frozen=True)
+class Projection:
+    resource: str
+    fields: Tuple[str, ...]
+    expand: Tuple[str, ...]
+
+    def statement(self):
+        """SELECT только нужных колонок; вложенные объекты - LEFT JOIN по связям модели"""
+        resource = RESOURCES[self.resource]
+        columns = [resource.column(field) for field in self.fields]
+        joins = []
+        entities = {"": (resource, resource.model)}
+        # Пути отсортированы, поэтому родитель присоединяется раньше вложенного объекта
+        for path in self.expand:
+            parent_path, _, relation = path.rpartition(".")
+            parent, parent_entity = entities[parent_path]
+            related = RESOURCES[parent.relations[relation]]
+            entity = aliased(related.model, name=path.replace(".", "_"))
+            joins.append(getattr(parent_entity, relation).of_type(entity))
+            entities[path] = (related, entity)
+            columns.extend(getattr(entity, related.column(field).key) for field in related.scalar_fields)
+        statement = select(*columns).select_from(resource.model)
+        for join in joins:
+            statement = statement.outerjoin(join)
+        return statement
+
+    def fetch(
+        self,
+        db: Session,
+        criteria: list,
+        skip: int = 0,
+        limit: int = 100,
+        order_by: Optional[list] = None
+    ) -> List[Dict[str, Any]]:
+        """Страница строк без ORM-объектов и identity map: кортежи сразу раскладываются в словари"""
+        fields, nested = _row_layout(self)
+        size = len(fields)
+        statement = self.statement().where(*criteria)
+        if order_by:
+            statement = statement.order_by(*order_by)
+        rows = db.execute(statement.offset(skip).limit(limit)).tuples()
+        if not nested:
+            return [dict(zip(fields, row)) for row in rows]
+
+        result = []
+        for row in rows:
+            item = dict(zip(fields, row[:size]))
+            nodes = {"": item}
+            for path, parent_path, relation, names, start, key in nested:
+                parent = nodes.get(parent_path)
+                if parent is None:
+                    continue
+                # Пустой первичный ключ - связанной строки нет
+                child = dict(zip(names, row[start:start + len(names)])) if row[start + key] is not None else None
+                parent[relation] = nodes[path] = child
+            result.append(item)
+        return result
+
+    def response_model(self) -> Type[BaseModel]:
+        return _projection_model(self.resource, self.fields, _expand_tree(self.expand))
+
+    def dump(self, rows: List[Any]) -> List[Dict[str, Any]]:
+        adapter = _list_adapter(self.response_model())
+        return adapter.dump_python(adapter.validate_python(rows, from_attributes=True), mode="json")
+
+    def render(self, rows: List[Any]) -> Response:
+        """Ответ проекции в формате из Accept (JSON, MessagePack, Arrow IPC), как у полных списков"""
+        return wire.NegotiatedResponse(self.dump(rows))
+
+
+@lru_cache(maxsize=256)
+def _row_layout(projection: Projection) -> Tuple[Tuple[str, ...], Tuple[Any, ...]]:
+    """Раскладка колонок statement(): поля ресурса и (путь, родитель, связь, поля, начало, индекс id)"""
+    resource = RESOURCES[projection.resource]
+    resources = {"": resource}
+    start = len(projection.fields)
+    nested = []
+    for path in projection.expand:
+        parent_path, _, relation = path.rpartition(".")
+        related = RESOURCES[resources[parent_path].relations[relation]]
+        resources[path] = related
+        names = tuple(related.scalar_fields)
+        nested.append((path, parent_path, relation, names, start, names.index("id")))
+        start += len(names)
+    return projection.fields, tuple(nested)
+
+
+def _relation_paths(resource: Resource) -> List[str]:
+    paths = []
+    for relation, target in resource.relations.items():
+        paths.append(relation)
+        paths.extend(f"{relation}.{path}" for path in _relation_paths(RESOURCES[target]))
+    return paths
+
+
+def full(resource_name: str) -> Projection:
+    """Проекция полной схемы ресурса: все поля и все вложенные объекты"""
+    resource = RESOURCES[resource_name]
+    return Projection(resource_name, tuple(resource.scalar_fields), tuple(sorted(_relation_paths(resource))))
+
+
+def _expand_tree(paths: Tuple[str, ...]) -> Tuple[Tuple[str, Any], ...]:
+    tree: Dict[str, Any] = {}
+    for path in paths:
+        node = tree
+        for relation in path.split("."):
+            node = node.setdefault(relation, {})
+
+    def freeze(node: Dict[str, Any]) -> Tuple[Tuple[str, Any], ...]:
+        return tuple(sorted((name, freeze(child)) for name, child in node.items()))
+
+    return freeze(tree)
+
+
+@lru_cache(maxsize=256)
+def _projection_model(resource_name: str, fields: Tuple[str, ...], expand: Tuple[Tuple[str, Any], ...]) -> Type[BaseModel]:
+    resource = RESOURCES[resource_name]
+    definitions: Dict[str, Any] = {}
+    for field in fields:
+        info = resource.schema.model_fields[field]
+        key = resource.column(field).key
+        if key != field:
+            # Атрибут модели назван иначе, чем колонка (например, зарезервированное имя)
+            info = FieldInfo.merge_field_infos(info, validation_alias=AliasChoices(key, field))
+        definitions[field] = (info.annotation, info)
+    for relation, children in expand:
+        related = RESOURCES[resource.relations[relation]]
+        nested = _projection_model(resource.relations[relation], tuple(related.scalar_fields), children)
+        definitions[relation] = (Optional[nested], None)
+    return create_model(f"{resource.schema.__name__}Projection", __base__=schemas.BaseSchema, **definitions)
+
+
+@lru_cache(maxsize=256)
+def _list_adapter(model: Type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(List[model])
+
+
+def _split(value: Optional[str]) -> List[str]:
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+
+def parse(resource_name: str, fields: Optional[str], expand: Optional[str]) -> Optional[Projection]:
+    """Разбирает ?fields= и ?expand=; None, если ни один не задан (полный ответ).
+
+    Неизвестные поля и связи дают ValueError.
+    """
+    if fields is None and expand is None:
+        return None
+    resource = RESOURCES[resource_name]
+
+    requested = _split(fields) or resource.scalar_fields
+    unknown = [field for field in requested if field not in resource.scalar_fields]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(resource.scalar_fields)}")
+    wanted = set(requested) | set(resource.required)
+    selected = tuple(field for field in resource.scalar_fields if field in wanted)
+
+    paths = []
+    for path in _split(expand):
+        current = resource
+        for relation in path.split("."):
+            if relation not in current.relations:
+                raise ValueError(f"Unknown expansion: {path}")
+            current = RESOURCES[current.relations[relation]]
+        # Вложенный объект присоединяется через родителя, поэтому родитель тоже раскрывается
+        parts = path.split(".")
+        paths.extend(".".join(parts[:depth]) for depth in range(1, len(parts) + 1))
+
+    return Projection(resource_name, selected, tuple(sorted(set(paths))))
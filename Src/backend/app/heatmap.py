@@ -0,0 +1,127 @@
+from datetime import datetime
+from typing import Optional, Tuple, Dict, Any
+
+import numpy as np
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from . import models
+from .config import settings
+from .database import plant_of
+from .utils import TTLCache
+
+_cache = TTLCache(maxsize=settings.HEATMAP_CACHE_SIZE, ttl=settings.HEATMAP_CACHE_TTL)
+
+
+def fetch_defect_coordinates(
+    db: Session,
+    product_type_id: Optional[int] = None,
+    defect_type_id: Optional[int] = None,
+    furnace_number: Optional[str] = None,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Выбирает координаты дефектов одним запросом в виде двух массивов x_mm и y_mm"""
+    x_mm = models.DefectDetail.defect_location["x_mm"].as_float()
+    y_mm = models.DefectDetail.defect_location["y_mm"].as_float()
+
+    stmt = (
+        select(func.array_agg(x_mm), func.array_agg(y_mm))
+        .select_from(models.DefectDetail)
+        .join(models.InspectionResult, models.DefectDetail.inspection_result)
+        .where(x_mm.isnot(None), y_mm.isnot(None))
+    )
+
+    if product_type_id or furnace_number:
+        stmt = stmt.join(models.ProductionBatch, models.InspectionResult.batch_id == models.ProductionBatch.id)
+    if product_type_id:
+        stmt = stmt.where(models.ProductionBatch.product_type_id == product_type_id)
+    if furnace_number:
+        stmt = stmt.where(models.ProductionBatch.furnace_number == furnace_number)
+    if defect_type_id:
+        stmt = stmt.where(models.DefectDetail.defect_type_id == defect_type_id)
+    # Фильтр по ключу секционирования defect_details отсекает лишние месяцы
+    if time_from:
+        stmt = stmt.where(models.DefectDetail.inspection_time >= time_from)
+    if time_to:
+        stmt = stmt.where(models.DefectDetail.inspection_time < time_to)
+
+    xs, ys = db.execute(stmt).one()
+    return np.asarray(xs or [], dtype=float), np.asarray(ys or [], dtype=float)
+
+
+def _bin_index(values: np.ndarray, value_range: Tuple[float, float], bins: int) -> np.ndarray:
+    """Номер ячейки для каждого значения; -1 для значений вне диапазона"""
+    low, high = value_range
+    index = np.floor((values - low) * (bins / (high - low))).astype(np.int64)
+    # Правая граница диапазона включается в последнюю ячейку, как в np.histogram; значения
+    # чуть меньше high из-за округления тоже дают bins
+    np.minimum(index, bins - 1, out=index)
+    index[(values < low) | (values > high)] = -1
+    return index
+
+
+def build_heatmap(
+    xs: np.ndarray,
+    ys: np.ndarray,
+    bins_x: int,
+    bins_y: int,
+    x_range: Optional[Tuple[float, float]] = None,
+    y_range: Optional[Tuple[float, float]] = None
+) -> Dict[str, Any]:
+    if x_range is None:
+        x_range = (float(xs.min()), float(xs.max())) if xs.size else (0.0, 1.0)
+    if y_range is None:
+        y_range = (float(ys.min()), float(ys.max())) if ys.size else (0.0, 1.0)
+    # histogram2d не принимает вырожденный диапазон
+    if x_range[0] == x_range[1]:
+        x_range = (x_range[0] - 0.5, x_range[1] + 0.5)
+    if y_range[0] == y_range[1]:
+        y_range = (y_range[0] - 0.5, y_range[1] + 0.5)
+
+    # Равномерная сетка: индекс ячейки считается напрямую, без бинарного поиска histogram2d
+    ix = _bin_index(xs, x_range, bins_x)
+    iy = _bin_index(ys, y_range, bins_y)
+    inside = (ix >= 0) & (iy >= 0)
+    counts = np.bincount(ix[inside] * bins_y + iy[inside], minlength=bins_x * bins_y).reshape(bins_x, bins_y)
+    x_edges = np.linspace(x_range[0], x_range[1], bins_x + 1)
+    y_edges = np.linspace(y_range[0], y_range[1], bins_y + 1)
+
+    return {
+        "bins_x": bins_x,
+        "bins_y": bins_y,
+        "x_edges": x_edges.tolist(),
+        "y_edges": y_edges.tolist(),
+        "counts": counts.tolist(),
+        "total": int(counts.sum()),
+        "max_count": int(counts.max()) if counts.size else 0,
+    }
+
+
+def defect_heatmap(
+    db: Session,
+    product_type_id: Optional[int] = None,
+    defect_type_id: Optional[int] = None,
+    furnace_number: Optional[str] = None,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None,
+    bins_x: int = 50,
+    bins_y: int = 50,
+    x_range: Optional[Tuple[float, float]] = None,
+    y_range: Optional[Tuple[float, float]] = None
+) -> Dict[str, Any]:
+    """Тепловая карта расположения дефектов, кэшируется по набору фильтров"""
+    key = (plant_of(db), product_type_id, defect_type_id, furnace_number, time_from, time_to, bins_x, bins_y, x_range, y_range)
+
+    def compute():
+        xs, ys = fetch_defect_coordinates(
+            db,
+            product_type_id=product_type_id,
+            defect_type_id=defect_type_id,
+            furnace_number=furnace_number,
+            time_from=time_from,
+            time_to=time_to
+        )
+        return build_heatmap(xs, ys, bins_x, bins_y, x_range=x_range, y_range=y_range)
+
+    return _cache.get_or_set(key, compute)
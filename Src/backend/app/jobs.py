@@ -0,0 +1,484 @@
+import csv
+import glob
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, Callable
+
+from sqlalchemy import delete, or_, update
+from sqlalchemy.orm import Session
+
+from . import models
+from .config import settings
+from .database import ReportingSessionLocal
+from .utils import as_utc
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+FINISHED_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED, STATUS_CANCELLED)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobContext:
+    """Контекст выполнения задачи: параметры, сессия БД, прогресс и отмена"""
+
+    def __init__(self, runner: "JobRunner", job_id: int, params: Dict[str, Any], db: Session):
+        self.runner = runner
+        self.job_id = job_id
+        self.params = params
+        self.db = db
+        self._last_report = 0.0
+
+    def result_path(self, extension: str) -> str:
+        os.makedirs(settings.JOBS_RESULT_DIR, exist_ok=True)
+        return os.path.join(settings.JOBS_RESULT_DIR, f"job_{self.job_id}.{extension}")
+
+    def check_cancelled(self) -> None:
+        if self.runner.is_cancel_requested(self.job_id):
+            raise JobCancelled()
+
+    def report_progress(self, progress: float, message: Optional[str] = None) -> None:
+        """Сохраняет прогресс не чаще раза в JOBS_PROGRESS_INTERVAL секунд и проверяет отмену"""
+        self.check_cancelled()
+        now = time.monotonic()
+        if now - self._last_report < settings.JOBS_PROGRESS_INTERVAL and progress < 1.0:
+            return
+        self._last_report = now
+        self.runner.update(self.job_id, progress=min(max(progress, 0.0), 1.0), message=message)
+        # Отмена могла прийти в другой процесс API: флаг берется из БД
+        if self.runner.cancel_requested_in_db(self.job_id):
+            raise JobCancelled()
+
+
+# Реестр обработчиков: имя типа задачи -> (функция, нужны ли права администратора)
+_handlers: Dict[str, Dict[str, Any]] = {}
+
+
+def job_handler(job_type: str, admin_only: bool = False):
+    def decorator(func: Callable[[JobContext], Dict[str, Any]]):
+        _handlers[job_type] = {"func": func, "admin_only": admin_only}
+        return func
+    return decorator
+
+
+def get_handler(job_type: str) -> Optional[Dict[str, Any]]:
+    return _handlers.get(job_type)
+
+
+def job_types() -> Dict[str, bool]:
+    return {name: handler["admin_only"] for name, handler in _handlers.items()}
+
+
+class JobRunner:
+    """Ограниченный пул фоновых потоков с очередью по приоритету.
+
+    Записи задач хранятся в таблице jobs, поэтому после перезапуска незавершенные
+    задачи снова ставятся в очередь. Выполняемые задачи раз в JOBS_HEARTBEAT_INTERVAL
+    отмечают heartbeat_at; задачи без отметки дольше JOBS_HEARTBEAT_TIMEOUT считаются
+    брошенными (процесс упал) и возвращаются в очередь.
+    """
+
+    def __init__(self, workers: int, max_queued: int):
+        self.workers = workers
+        self.max_queued = max_queued
+        self._queue: "queue.PriorityQueue" = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._cancelled = set()
+        self._active = set()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._heartbeat_thread = None
+        self._stop_event = threading.Event()
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        self._stop_event.clear()
+        self._recover()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        for _ in self._threads:
+            self._queue.put((float("inf"), next(self._sequence), None))
+        self._threads = []
+
+    def _recover(self) -> None:
+        """Ставит в очередь ожидающие задачи и задачи, брошенные упавшими процессами.
+
+        Задачи с живым heartbeat выполняет другой процесс API и не трогаются.
+        """
+        db = ReportingSessionLocal()
+        try:
+            queued = db.query(models.Job.id, models.Job.priority).filter(
+                models.Job.status == STATUS_QUEUED
+            ).order_by(models.Job.id).all()
+            for job_id, priority in queued:
+                self._queue.put((-(priority or 0), next(self._sequence), job_id))
+        except Exception:
+            logger.exception("Failed to recover pending jobs")
+            db.rollback()
+        finally:
+            db.close()
+        self._requeue_stale()
+
+    def _requeue_stale(self) -> None:
+        job = models.Job
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=settings.JOBS_HEARTBEAT_TIMEOUT)
+        db = ReportingSessionLocal()
+        try:
+            # Условие на heartbeat повторяется в UPDATE: задача могла ожить между чтением и записью
+            stale = db.execute(
+                update(job)
+                .where(
+                    job.status == STATUS_RUNNING,
+                    or_(job.heartbeat_at < cutoff, job.heartbeat_at.is_(None) & (job.started_at < cutoff))
+                )
+                .values(status=STATUS_QUEUED, progress=0.0, heartbeat_at=None)
+                .returning(job.id, job.priority)
+                .execution_options(synchronize_session=False)
+            ).all()
+            db.commit()
+        except Exception:
+            logger.exception("Failed to recover stale jobs")
+            db.rollback()
+            return
+        finally:
+            db.close()
+        for job_id, priority in sorted(stale):
+            logger.warning("Job %s lost its worker, queued again", job_id)
+            self._queue.put((-(priority or 0), next(self._sequence), job_id))
+
+    def _heartbeat_loop(self) -> None:
+        while not self._stop_event.wait(settings.JOBS_HEARTBEAT_INTERVAL):
+            with self._lock:
+                active = list(self._active)
+            if active:
+                try:
+                    self.update_many(active, heartbeat_at=datetime.now(timezone.utc))
+                except Exception:
+                    logger.exception("Failed to update job heartbeats")
+            self._requeue_stale()
+
+    def submit(self, db: Session, job_type: str, params: Dict[str, Any], priority: int, created_by: Optional[int]) -> models.Job:
+        if self._queue.qsize() >= self.max_queued:
+            raise QueueFull()
+        job = models.Job(
+            job_type=job_type,
+            params=params,
+            priority=priority,
+            status=STATUS_QUEUED,
+            progress=0.0,
+            created_by=created_by
+        )
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        self._queue.put((-priority, next(self._sequence), job.id))
+        return job
+
+    def cancel(self, db: Session, job: models.Job) -> models.Job:
+        if job.status in FINISHED_STATUSES:
+            return job
+        with self._lock:
+            self._cancelled.add(job.id)
+        job.cancel_requested = True
+        if job.status == STATUS_QUEUED:
+            job.status = STATUS_CANCELLED
+            job.finished_at = datetime.now(timezone.utc)
+        db.commit()
+        db.refresh(job)
+        return job
+
+    def is_cancel_requested(self, job_id: int) -> bool:
+        with self._lock:
+            return job_id in self._cancelled
+
+    def cancel_requested_in_db(self, job_id: int) -> bool:
+        db = ReportingSessionLocal()
+        try:
+            return bool(db.query(models.Job.cancel_requested).filter(models.Job.id == job_id).scalar())
+        finally:
+            db.close()
+
+    def update(self, job_id: int, **fields) -> None:
+        self.update_many([job_id], **fields)
+
+    def update_many(self, job_ids, **fields) -> None:
+        db = ReportingSessionLocal()
+        try:
+            db.query(models.Job).filter(models.Job.id.in_(job_ids)).update(fields, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def _work(self) -> None:
+        while not self._stop_event.is_set():
+            _, _, job_id = self._queue.get()
+            if job_id is None:
+                break
+            try:
+                self._run(job_id)
+            except Exception:
+                logger.exception("Job %s crashed", job_id)
+            finally:
+                with self._lock:
+                    self._cancelled.discard(job_id)
+                    self._active.discard(job_id)
+
+    def _claim(self, db: Session, job_id: int):
+        """Переводит задачу в running одним условным UPDATE; None - задачу уже взял другой обработчик или отменили"""
+        job = models.Job
+        now = datetime.now(timezone.utc)
+        claimed = db.execute(
+            update(job)
+            .where(job.id == job_id, job.status == STATUS_QUEUED, job.cancel_requested.isnot(True))
+            .values(status=STATUS_RUNNING, started_at=now, heartbeat_at=now)
+            .returning(job.job_type, job.params)
+            .execution_options(synchronize_session=False)
+        ).first()
+        db.commit()
+        return claimed
+
+    def _run(self, job_id: int) -> None:
+        db = ReportingSessionLocal()
+        try:
+            # Одну задачу могут поставить в очередь несколько процессов API: выполняет тот, кто взял ее первым
+            claimed = self._claim(db, job_id)
+            if claimed is None:
+                return
+            with self._lock:
+                self._active.add(job_id)
+            handler = get_handler(claimed.job_type)
+            if handler is None:
+                self.update(
+                    job_id,
+                    status=STATUS_FAILED,
+                    error=f"Unknown job type: {claimed.job_type}",
+                    finished_at=datetime.now(timezone.utc)
+                )
+                return
+
+            context = JobContext(self, job_id, claimed.params or {}, db)
+            try:
+                result = handler["func"](context)
+            except JobCancelled:
+                db.rollback()
+                self.update(job_id, status=STATUS_CANCELLED, finished_at=datetime.now(timezone.utc))
+                return
+            except Exception as e:
+                logger.exception("Job %s failed", job_id)
+                db.rollback()
+                self.update(job_id, status=STATUS_FAILED, error=str(e), finished_at=datetime.now(timezone.utc))
+                return
+
+            self.update(
+                job_id,
+                status=STATUS_SUCCEEDED,
+                progress=1.0,
+                result_path=result.get("path"),
+                result_content_type=result.get("content_type"),
+                message=result.get("message"),
+                finished_at=datetime.now(timezone.utc)
+            )
+        finally:
+            db.close()
+
+
+runner = JobRunner(workers=settings.JOBS_WORKERS, max_queued=settings.JOBS_MAX_QUEUED)
+
+
+def purge_finished_jobs(db: Session, older_than_days: int = settings.JOBS_RETENTION_DAYS) -> int:
+    """Удаляет завершенные задачи старше older_than_days вместе с файлами результатов"""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    job_ids = db.execute(
+        delete(models.Job)
+        .where(models.Job.status.in_(FINISHED_STATUSES), models.Job.finished_at < cutoff)
+        .returning(models.Job.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    db.commit()
+    # Файлы удаляются после commit: запись задачи не ссылается на уже удаленный файл.
+    # По маске находятся и недописанные файлы упавших и отмененных задач
+    for job_id in job_ids:
+        for path in glob.glob(os.path.join(settings.JOBS_RESULT_DIR, f"job_{job_id}.*")):
+            try:
+                os.remove(path)
+            except OSError:
+                logger.warning("Failed to remove result file %s", path, exc_info=True)
+    return len(job_ids)
+
+
+def _write_json(context: JobContext, payload: Any) -> Dict[str, Any]:
+    path = context.result_path("json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, default=str)
+    return {"path": path, "content_type": "application/json"}
+
+
+def _param_datetime(params: Dict[str, Any], name: str) -> Optional[datetime]:
+    value = params.get(name)
+    # Время без зоны считается UTC: иначе сравнение с границей по умолчанию падает с TypeError
+    return as_utc(datetime.fromisoformat(value)) if value else None
+
+
+# Колонки выгрузки результатов контроля и их типы в Arrow
+EXPORT_COLUMNS = (
+    ("id", "int32"),
+    ("batch_id", "int32"),
+    ("inspection_point_id", "int32"),
+    ("inspection_time", "timestamp"),
+    ("inspector_name", "string"),
+    ("overall_verdict", "string"),
+    ("status", "string"),
+    ("is_defect_detected", "bool"),
+    ("defect_count", "int32"),
+    ("measurement_data", "string"),
+)
+
+
+def _export_value(row: models.InspectionResult, column: str) -> Any:
+    value = getattr(row, column)
+    return json.dumps(value, ensure_ascii=False) if column == "measurement_data" else value
+
+
+def _write_inspections_csv(path: str, rows, on_chunk: Callable[[int], None]) -> None:
+    columns = [name for name, _ in EXPORT_COLUMNS]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for written, row in enumerate(rows, start=1):
+            writer.writerow([_export_value(row, column) for column in columns])
+            if written % settings.JOBS_EXPORT_CHUNK_SIZE == 0:
+                on_chunk(written)
+
+
+def _write_inspections_arrow(path: str, rows, on_chunk: Callable[[int], None]) -> None:
+    """Arrow IPC stream: по одному record batch на порцию выгрузки"""
+    import pyarrow as pa
+
+    types = {"int32": pa.int32(), "timestamp": pa.timestamp("us", tz="UTC"), "string": pa.string(), "bool": pa.bool_()}
+    schema = pa.schema([(name, types[kind]) for name, kind in EXPORT_COLUMNS])
+
+    def flush(chunk):
+        writer.write_batch(pa.RecordBatch.from_pylist(chunk, schema=schema))
+
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_stream(sink, schema) as writer:
+        chunk = []
+        for written, row in enumerate(rows, start=1):
+            chunk.append({name: _export_value(row, name) for name, _ in EXPORT_COLUMNS})
+            if written % settings.JOBS_EXPORT_CHUNK_SIZE == 0:
+                flush(chunk)
+                chunk = []
+                on_chunk(written)
+        if chunk:
+            flush(chunk)
+
+
+@job_handler("inspections_export")
+def export_inspections(context: JobContext) -> Dict[str, Any]:
+    """Выгрузка результатов контроля порциями: CSV или Arrow IPC (params.format = "arrow")"""
+    from .crud import query_inspection_results, count_inspection_results
+
+    filters = {
+        "batch_id": context.params.get("batch_id"),
+        "verdict": context.params.get("verdict"),
+        "time_from": _param_datetime(context.params, "time_from"),
+        "time_to": _param_datetime(context.params, "time_to"),
+    }
+    total = count_inspection_results(context.db, **filters) or 1
+    query = query_inspection_results(context.db, **filters).order_by(models.InspectionResult.id)
+
+    def on_chunk(written: int) -> None:
+        context.report_progress(written / total, f"{written} rows")
+        context.db.expunge_all()
+
+    rows = query.yield_per(settings.JOBS_EXPORT_CHUNK_SIZE)
+    if context.params.get("format") == "arrow":
+        path = context.result_path("arrows")
+        _write_inspections_arrow(path, rows, on_chunk)
+        content_type = "application/vnd.apache.arrow.stream"
+    else:
+        path = context.result_path("csv")
+        _write_inspections_csv(path, rows, on_chunk)
+        content_type = "text/csv"
+
+    return {"path": path, "content_type": content_type, "message": f"{total} rows"}
+
+
+@job_handler("line_flow")
+def line_flow_report(context: JobContext) -> Dict[str, Any]:
+    from .line_flow import compute_line_flow
+
+    time_to = _param_datetime(context.params, "time_to") or datetime.now(timezone.utc)
+    time_from = _param_datetime(context.params, "time_from") or datetime.fromtimestamp(0, timezone.utc)
+    result = compute_line_flow(context.db, time_from, time_to, batch_id=context.params.get("batch_id"))
+    return _write_json(context, result)
+
+
+@job_handler("defect_heatmap")
+def defect_heatmap_report(context: JobContext) -> Dict[str, Any]:
+    from .heatmap import fetch_defect_coordinates, build_heatmap
+
+    xs, ys = fetch_defect_coordinates(
+        context.db,
+        product_type_id=context.params.get("product_type_id"),
+        defect_type_id=context.params.get("defect_type_id"),
+        furnace_number=context.params.get("furnace_number"),
+        time_from=_param_datetime(context.params, "time_from"),
+        time_to=_param_datetime(context.params, "time_to")
+    )
+    context.report_progress(0.5, f"{xs.size} defects")
+    result = build_heatmap(xs, ys, int(context.params.get("bins_x", 50)), int(context.params.get("bins_y", 50)))
+    return _write_json(context, result)
+
+
+@job_handler("archive", admin_only=True)
+def archive_report(context: JobContext) -> Dict[str, Any]:
+    from .archive import archive_closed_batches, count_archivable
+
+    older_than_days = int(context.params.get("older_than_days", settings.ARCHIVE_AFTER_DAYS))
+    # Прогресс - доля партий, которые подходили под архивацию при запуске
+    total = count_archivable(context.db, older_than_days)
+    totals = {}
+    chunk = 0
+    # Порции по одной, чтобы между ними можно было отменить задачу
+    while True:
+        context.check_cancelled()
+        done = archive_closed_batches(
+            context.db,
+            older_than_days=older_than_days,
+            max_chunks=1
+        )
+        if not done["production_batches"]:
+            break
+        for name, count in done.items():
+            totals[name] = totals.get(name, 0) + count
+        chunk += 1
+        context.report_progress(
+            min(totals["production_batches"] / total, 0.99) if total else 0.0,
+            f"{chunk} chunks, {totals['production_batches']} of {total} batches"
+        )
+    return _write_json(context, totals)
@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, List
+
+from sqlalchemy import select, func, extract, desc
+from sqlalchemy.orm import Session
+
+from . import models
+from .config import settings
+from .database import plant_of
+from .utils import TTLCache, as_utc
+
+_cache = TTLCache(maxsize=settings.FLOW_CACHE_SIZE, ttl=settings.FLOW_CACHE_TTL)
+
+
+def _steps_subquery(time_from: datetime, time_to: datetime, batch_id: Optional[int] = None):
+    """Переходы между контрольными точками: для каждого результата - предыдущая точка партии и время в пути.
+
+    LAG считается по строкам с запасом FLOW_LOOKBACK_HOURS до начала окна, чтобы первый шаг партии
+    в окне получил настоящую предыдущую точку; в результат попадают только шаги внутри окна.
+    """
+    ir = models.InspectionResult
+    window = {"partition_by": ir.batch_id, "order_by": (ir.inspection_time, ir.id)}
+
+    stmt = (
+        select(
+            ir.batch_id,
+            ir.inspection_point_id,
+            ir.inspection_time,
+            func.lag(ir.inspection_point_id).over(**window).label("from_point_id"),
+            extract("epoch", ir.inspection_time - func.lag(ir.inspection_time).over(**window)).label("dwell_seconds")
+        )
+        .where(
+            ir.inspection_point_id.isnot(None),
+            ir.inspection_time >= time_from - timedelta(hours=settings.FLOW_LOOKBACK_HOURS),
+            ir.inspection_time < time_to
+        )
+    )
+    if batch_id:
+        stmt = stmt.where(ir.batch_id == batch_id)
+    lagged = stmt.subquery("lagged")
+    return select(lagged).where(lagged.c.inspection_time >= time_from).subquery("steps")
+
+
+def _transitions(db: Session, steps) -> List[Dict[str, Any]]:
+    dwell = steps.c.dwell_seconds
+    stmt = (
+        select(
+            steps.c.from_point_id,
+            steps.c.inspection_point_id.label("to_point_id"),
+            func.count().label("count"),
+            func.avg(dwell).label("avg_seconds"),
+            func.percentile_cont(0.5).within_group(dwell).label("median_seconds"),
+            func.percentile_cont(0.95).within_group(dwell).label("p95_seconds"),
+            func.max(dwell).label("max_seconds")
+        )
+        .where(steps.c.from_point_id.isnot(None))
+        .group_by(steps.c.from_point_id, steps.c.inspection_point_id)
+        .order_by(desc("avg_seconds"))
+    )
+    return [dict(row._mapping) for row in db.execute(stmt)]
+
+
+def _points(db: Session, steps) -> List[Dict[str, Any]]:
+    avg_wait = func.avg(steps.c.dwell_seconds)
+    stmt = (
+        select(
+            steps.c.inspection_point_id,
+            func.count().label("inspections"),
+            avg_wait.label("avg_wait_seconds"),
+            func.rank().over(order_by=avg_wait.desc().nulls_last()).label("bottleneck_rank")
+        )
+        .group_by(steps.c.inspection_point_id)
+        .order_by("bottleneck_rank")
+    )
+    return [dict(row._mapping) for row in db.execute(stmt)]
+
+
+def _batch_steps(db: Session, steps) -> List[Dict[str, Any]]:
+    stmt = select(steps).order_by(steps.c.inspection_time)
+    return [dict(row._mapping) for row in db.execute(stmt)]
+
+
+def compute_line_flow(
+    db: Session,
+    time_from: datetime,
+    time_to: datetime,
+    batch_id: Optional[int] = None
+) -> Dict[str, Any]:
+    steps = _steps_subquery(time_from, time_to, batch_id=batch_id)
+
+    codes = dict(db.query(models.InspectionPoint.id, models.InspectionPoint.point_code).all())
+    hours = max((time_to - time_from).total_seconds() / 3600.0, 1e-9)
+
+    transitions = _transitions(db, steps)
+    for item in transitions:
+        item["from_point_code"] = codes.get(item["from_point_id"])
+        item["to_point_code"] = codes.get(item["to_point_id"])
+
+    points = _points(db, steps)
+    for item in points:
+        item["point_code"] = codes.get(item["inspection_point_id"])
+        item["throughput_per_hour"] = item["inspections"] / hours
+
+    result = {
+        "time_from": time_from,
+        "time_to": time_to,
+        "batch_id": batch_id,
+        "transitions": transitions,
+        "points": points,
+        "batch_steps": None,
+    }
+    if batch_id:
+        batch_steps = _batch_steps(db, steps)
+        for item in batch_steps:
+            item["point_code"] = codes.get(item["inspection_point_id"])
+        result["batch_steps"] = batch_steps
+    return result
+
+
+def line_flow(
+    db: Session,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None,
+    batch_id: Optional[int] = None
+) -> Dict[str, Any]:
+    """Аналитика прохождения партий через контрольные точки, кэшируется по временному окну"""
+    time_from, time_to = as_utc(time_from), as_utc(time_to)
+    if time_to is None:
+        # Округление до минуты, чтобы запросы без явного окна попадали в кэш
+        time_to = datetime.now(timezone.utc).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    if time_from is None:
+        time_from = time_to - timedelta(hours=settings.FLOW_DEFAULT_WINDOW_HOURS)
+
+    key = (plant_of(db), time_from, time_to, batch_id)
+    return _cache.get_or_set(key, lambda: compute_line_flow(db, time_from, time_to, batch_id=batch_id))
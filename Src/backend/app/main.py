@@ -3,12 +3,23 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from typing import List
+import logging
 
-from . import models, schemas, crud, auth
-from .database import engine, get_db
+from . import models, schemas, crud, auth, partitions, jobs, certificates, ratelimit, workload, wire, profiling, tracing, audit, database, edge, similarity
+from .database import get_db, shards, DEFAULT_WORKLOAD
 from .config import settings
 
-models.Base.metadata.create_all(bind=engine)
+logger = logging.getLogger(__name__)
+
+# Схема создается в базе каждого завода
+for plant in shards.plants:
+    try:
+        models.Base.metadata.create_all(bind=shards.engine(plant, DEFAULT_WORKLOAD))
+    except Exception:
+        # Линейный узел запускается и без связи с центральной базой: результаты пишутся локально
+        if not settings.EDGE_MODE:
+            raise
+        logger.warning("Database of plant %s is unavailable at startup", plant, exc_info=True)
 
 app = FastAPI(
     title="Metal Quality Control API",
@@ -19,6 +30,15 @@ app = FastAPI(
     openapi_url="/api/openapi.json"
 )
 
+# Порядок: CORS -> трассировка -> ограничение частоты -> допуск по классам нагрузки -> профилирование -> распаковка тела -> приложение;
+# добавленный позже middleware выполняется раньше
+app.add_middleware(wire.DecompressionMiddleware)
+if settings.PROFILING_ENABLED:
+    app.add_middleware(profiling.ProfilingMiddleware)
+app.add_middleware(workload.WorkloadMiddleware)
+app.add_middleware(ratelimit.RateLimitMiddleware)
+app.add_middleware(tracing.TracingMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost", "http://frontend", settings.FRONTEND_URL],
@@ -30,6 +50,7 @@ app.add_middleware(
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/token")
 
 
+@tracing.traced("auth.get_current_user")
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
     db: Session = Depends(get_db)
@@ -48,10 +69,12 @@ async def get_current_user(
     if not user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     
+    # Автор изменений для журнала аудита
+    audit.set_actor(user.id, user.username)
     return user
 
 
-from .routers import users, roles, product_types, batches, inspections, defects, auth as auth_router
+from .routers import users, roles, product_types, batches, inspections, defects, analytics, maintenance, sync as sync_router, jobs as jobs_router, auth as auth_router, edge as edge_router
 
 app.include_router(auth_router.router, prefix="/api/auth", tags=["Authentication"])
 app.include_router(users.router, prefix="/api/users", tags=["Users"], dependencies=[Depends(get_current_user)])
@@ -60,6 +83,38 @@ app.include_router(product_types.router, prefix="/api/product-types", tags=["Pro
 app.include_router(batches.router, prefix="/api/batches", tags=["Batches"], dependencies=[Depends(get_current_user)])
 app.include_router(inspections.router, prefix="/api/inspections", tags=["Inspections"], dependencies=[Depends(get_current_user)])
 app.include_router(defects.router, prefix="/api/defects", tags=["Defects"], dependencies=[Depends(get_current_user)])
+app.include_router(analytics.router, prefix="/api/analytics", tags=["Analytics"], dependencies=[Depends(get_current_user)])
+app.include_router(maintenance.router, prefix="/api/maintenance", tags=["Maintenance"], dependencies=[Depends(get_current_user)])
+app.include_router(sync_router.router, prefix="/api/sync", tags=["Sync"], dependencies=[Depends(get_current_user)])
+app.include_router(jobs_router.router, prefix="/api/jobs", tags=["Jobs"], dependencies=[Depends(get_current_user)])
+if settings.EDGE_MODE:
+    # Пользователь проверяется в самом роутере: без связи с центральной базой - по копии на узле
+    app.include_router(edge_router.router, prefix="/api/edge", tags=["Edge"])
+
+
+@app.on_event("startup")
+def start_background_tasks():
+    workload.configure_threadpool()
+    partitions.start_maintenance()
+    jobs.runner.start()
+    profiling.start_continuous()
+    tracing.exporter.start()
+    audit.writer.start()
+    edge.forwarder.start()
+    similarity.start_indexing()
+
+
+@app.on_event("shutdown")
+def stop_background_tasks():
+    partitions.stop_maintenance()
+    jobs.runner.stop()
+    certificates.shutdown_pool()
+    database.shutdown_pool()
+    profiling.stop_continuous()
+    tracing.exporter.stop()
+    audit.writer.stop()
+    edge.forwarder.stop()
+    similarity.stop_indexing()
 
 
 @app.get("/")
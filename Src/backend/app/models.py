@@ -1,7 +1,7 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Numeric, Date, JSON
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, ForeignKeyConstraint, Text, Numeric, Float, Date, JSON, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
-from .database import Base
+from .database import Base, current_plant
 
 
 class Role(Base):
@@ -33,12 +33,13 @@ class User(Base):
     
     # Связи
     role = relationship("Role", back_populates="users")
-    batches_created = relationship("ProductionBatch", foreign_keys="[ProductionBatch.created_by]", back_populates="creator")
-    inspections = relationship("InspectionResult", back_populates="inspector")
 
 
 class ProductType(Base):
     __tablename__ = "product_types"
+    __table_args__ = (
+        Index("idx_product_types_updated", "updated_at", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     type_code = Column(String(50), unique=True, nullable=False)
@@ -48,19 +49,26 @@ class ProductType(Base):
     width_range = Column(String(100))
     material_grade = Column(String(100))
     description = Column(Text)
-    created_by = Column(Integer, ForeignKey("users.id"))
+    # Без внешнего ключа: пользователи в центральной базе, строка - в базе завода
+    created_by = Column(Integer)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    # Версия строки для If-Match, увеличивается триггером БД при каждом UPDATE
+    version = Column(Integer, nullable=False, server_default="1")
     
     # Связи
     batches = relationship("ProductionBatch", back_populates="product_type")
-    creator = relationship("User", foreign_keys=[created_by])
 
 
 class ProductionBatch(Base):
     __tablename__ = "production_batches"
+    __table_args__ = (
+        Index("idx_batch_updated", "updated_at", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
+    # Завод (шард): заполняется кодом завода базы, в которую пишется строка
+    plant_code = Column(String(20), nullable=False, default=current_plant)
     batch_number = Column(String(100), unique=True, nullable=False, index=True)
     product_type_id = Column(Integer, ForeignKey("product_types.id", ondelete="RESTRICT"), nullable=False)
     production_date = Column(Date, nullable=False)
@@ -71,18 +79,23 @@ class ProductionBatch(Base):
     status = Column(String(50), default="в производстве")
     quality_rating = Column(Integer)
     metadata = Column(JSON)
-    created_by = Column(Integer, ForeignKey("users.id"))
+    # Без внешнего ключа: пользователи в центральной базе, строка - в базе завода
+    created_by = Column(Integer)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    # Версия строки для If-Match, увеличивается триггером БД при каждом UPDATE
+    version = Column(Integer, nullable=False, server_default="1")
     
     # Связи
     product_type = relationship("ProductType", back_populates="batches")
-    creator = relationship("User", foreign_keys=[created_by])
     inspection_results = relationship("InspectionResult", back_populates="batch", cascade="all, delete-orphan")
 
 
 class DefectType(Base):
     __tablename__ = "defect_types"
+    __table_args__ = (
+        Index("idx_defect_types_updated", "updated_at", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     defect_code = Column(String(50), unique=True, nullable=False)
@@ -92,16 +105,22 @@ class DefectType(Base):
     description = Column(Text)
     measurement_unit = Column(String(50))
     threshold_value = Column(Numeric(10, 4))
-    created_by = Column(Integer, ForeignKey("users.id"))
+    # Без внешнего ключа: пользователи в центральной базе, строка - в базе завода
+    created_by = Column(Integer)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    # Версия строки для If-Match, увеличивается триггером БД при каждом UPDATE
+    version = Column(Integer, nullable=False, server_default="1")
     
     # Связи
     defect_details = relationship("DefectDetail", back_populates="defect_type")
-    creator = relationship("User", foreign_keys=[created_by])
 
 
 class InspectionPoint(Base):
     __tablename__ = "inspection_points"
+    __table_args__ = (
+        Index("idx_inspection_points_updated", "updated_at", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     point_name = Column(String(200), nullable=False)
@@ -111,16 +130,32 @@ class InspectionPoint(Base):
     location_in_line = Column(String(100))
     coordinates = Column(JSON)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
 
 class InspectionResult(Base):
     __tablename__ = "inspection_results"
+    __table_args__ = (
+        # Прохождение партии по контрольным точкам (аналитика потока)
+        Index("idx_inspection_flow", "batch_id", "inspection_time", "inspection_point_id"),
+        # Поток за период по всем партиям: окно по времени без обращения к таблице
+        Index("idx_inspection_flow_time", "inspection_time", postgresql_include=["batch_id", "inspection_point_id", "id"]),
+        Index("idx_inspection_updated", "updated_at", "id"),
+        # Ключ идемпотентной пересылки с линейных узлов (edge); уникальный индекс включает ключ секционирования
+        Index("uq_inspection_edge", "edge_id", "inspection_time", unique=True),
+        {"postgresql_partition_by": "RANGE (inspection_time)"},
+    )
     
-    id = Column(Integer, primary_key=True, index=True)
+    # Ключ секционирования входит в первичный ключ
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
     batch_id = Column(Integer, ForeignKey("production_batches.id", ondelete="CASCADE"), nullable=False, index=True)
     inspection_point_id = Column(Integer, ForeignKey("inspection_points.id"))
-    inspection_time = Column(DateTime(timezone=True), server_default=func.now())
-    inspector_id = Column(Integer, ForeignKey("users.id"))
+    inspection_time = Column(DateTime(timezone=True), primary_key=True, server_default=func.now())
+    plant_code = Column(String(20), nullable=False, default=current_plant)
+    # UUID записи на линейном узле; NULL для записей, созданных через центральный API
+    edge_id = Column(String(36))
+    # Без внешнего ключа: пользователи в центральной базе, строка - в базе завода
+    inspector_id = Column(Integer)
     inspector_name = Column(String(200))
     measurement_data = Column(JSON, nullable=False)
     is_defect_detected = Column(Boolean, default=False)
@@ -130,19 +165,34 @@ class InspectionResult(Base):
     notes = Column(Text)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    # Версия строки для If-Match, увеличивается триггером БД при каждом UPDATE
+    version = Column(Integer, nullable=False, server_default="1")
     
     # Связи
     batch = relationship("ProductionBatch", back_populates="inspection_results")
     inspection_point = relationship("InspectionPoint")
-    inspector = relationship("User", back_populates="inspections")
     defect_details = relationship("DefectDetail", back_populates="inspection_result", cascade="all, delete-orphan")
+    anomaly_alerts = relationship("AnomalyAlert", back_populates="inspection_result", cascade="all, delete-orphan")
 
 
 class DefectDetail(Base):
     __tablename__ = "defect_details"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["inspection_result_id", "inspection_time"],
+            ["inspection_results.id", "inspection_results.inspection_time"],
+            ondelete="CASCADE"
+        ),
+        Index("idx_defect_updated", "updated_at", "id"),
+        Index("uq_defect_edge", "edge_id", "inspection_time", unique=True),
+        {"postgresql_partition_by": "RANGE (inspection_time)"},
+    )
     
-    id = Column(Integer, primary_key=True, index=True)
-    inspection_result_id = Column(Integer, ForeignKey("inspection_results.id", ondelete="CASCADE"), nullable=False, index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    inspection_result_id = Column(Integer, nullable=False, index=True)
+    inspection_time = Column(DateTime(timezone=True), primary_key=True)
+    plant_code = Column(String(20), nullable=False, default=current_plant)
+    edge_id = Column(String(36))
     defect_type_id = Column(Integer, ForeignKey("defect_types.id"), nullable=False, index=True)
     defect_location = Column(JSON)
     severity = Column(Numeric(5, 2))
@@ -153,7 +203,105 @@ class DefectDetail(Base):
     repair_date = Column(DateTime(timezone=True))
     repair_notes = Column(Text)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
     # Связи
     inspection_result = relationship("InspectionResult", back_populates="defect_details")
-    defect_type = relationship("DefectType", back_populates="defect_details")
\ No newline at end of file
+    defect_type = relationship("DefectType", back_populates="defect_details")
+
+
+class AnomalyAlert(Base):
+    __tablename__ = "anomaly_alerts"
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ["inspection_result_id", "inspection_time"],
+            ["inspection_results.id", "inspection_results.inspection_time"],
+            ondelete="CASCADE"
+        ),
+        {"postgresql_partition_by": "RANGE (inspection_time)"},
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    inspection_result_id = Column(Integer, nullable=False, index=True)
+    inspection_time = Column(DateTime(timezone=True), primary_key=True)
+    plant_code = Column(String(20), nullable=False, default=current_plant)
+    inspection_point_id = Column(Integer, ForeignKey("inspection_points.id"), index=True)
+    detectors = Column(JSON, nullable=False)
+    flagged_count = Column(Integer, nullable=False)
+    details = Column(JSON)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    # Связи
+    inspection_result = relationship("InspectionResult", back_populates="anomaly_alerts")
+    inspection_point = relationship("InspectionPoint")
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    job_type = Column(String(100), nullable=False)
+    params = Column(JSON)
+    priority = Column(Integer, default=0)
+    status = Column(String(50), default="queued", index=True)
+    progress = Column(Float, default=0.0)
+    message = Column(Text)
+    error = Column(Text)
+    cancel_requested = Column(Boolean, default=False)
+    result_path = Column(String(500))
+    result_content_type = Column(String(100))
+    created_by = Column(Integer, ForeignKey("users.id"))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+    heartbeat_at = Column(DateTime(timezone=True))
+    
+    # Связи
+    creator = relationship("User", foreign_keys=[created_by])
+
+
+class DeletedRecord(Base):
+    __tablename__ = "deleted_records"
+    __table_args__ = (
+        Index("idx_deleted_records_entity", "entity", "deleted_at", "id"),
+    )
+    
+    # Заполняется триггерами БД при удалении строк синхронизируемых таблиц
+    id = Column(BigInteger, primary_key=True)
+    entity = Column(String(100), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    reason = Column(String(50), nullable=False, default="deleted")
+    deleted_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class BatchProfileChange(Base):
+    __tablename__ = "batch_profile_changes"
+    __table_args__ = (
+        Index("idx_batch_profile_changes", "changed_at"),
+    )
+    
+    # Заполняется триггерами БД: результат контроля партии удален или перенесен в другую партию
+    id = Column(BigInteger, primary_key=True)
+    batch_id = Column(Integer, nullable=False)
+    changed_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class AuditLog(Base):
+    __tablename__ = "audit_log"
+    __table_args__ = (
+        Index("idx_audit_entity", "entity", "entity_id", "changed_at"),
+        Index("idx_audit_changed_at", "changed_at"),
+        Index("idx_audit_actor", "actor_id", "changed_at"),
+    )
+    
+    # Записи только добавляются (UPDATE/DELETE запрещены триггером БД)
+    id = Column(BigInteger, primary_key=True)
+    entity = Column(String(100), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    action = Column(String(20), nullable=False)
+    changes = Column(JSON, nullable=False)
+    actor_id = Column(Integer)
+    actor = Column(String(50))
+    trace_id = Column(String(32))
+    plant_code = Column(String(20))
+    changed_at = Column(DateTime(timezone=True), nullable=False)
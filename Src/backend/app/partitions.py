@@ -0,0 +1,112 @@
+import logging
+import threading
+from datetime import date
+from typing import List, Dict, Any
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from . import jobs, similarity, sync
+from .config import settings
+from .database import ReportingSessionLocal, shards
+
+logger = logging.getLogger(__name__)
+
+# Таблицы, секционированные по месяцам inspection_time (порядок - от родительской к ссылающимся)
+PARTITIONED_TABLES = ("inspection_results", "defect_details", "anomaly_alerts")
+
+_stop_event = threading.Event()
+_thread = None
+
+
+def create_partitions(db: Session, months_ahead: int = settings.PARTITION_MONTHS_AHEAD) -> int:
+    """Создает недостающие помесячные секции на текущий и months_ahead следующих месяцев"""
+    created = db.execute(text("SELECT create_monthly_partitions(:months)"), {"months": months_ahead}).scalar()
+    db.commit()
+    # Перенос строк из секции по умолчанию и пропущенные месяцы функция сообщает через WARNING
+    connection = db.connection().connection
+    for notice in connection.notices:
+        logger.warning("Partition maintenance: %s", notice.strip())
+    del connection.notices[:]
+    return created or 0
+
+
+def drop_partitions(db: Session, month: date) -> int:
+    """Удаляет секции месяца всех секционированных таблиц (DETACH + DROP)"""
+    month_start = month.replace(day=1)
+    dropped = db.execute(text("SELECT drop_monthly_partitions(:month)"), {"month": month_start}).scalar()
+    db.commit()
+    return dropped or 0
+
+
+def list_partitions(db: Session) -> List[Dict[str, Any]]:
+    rows = db.execute(text("""
+        SELECT parent.relname AS parent_table,
+               child.relname AS partition_name,
+               pg_get_expr(child.relpartbound, child.oid) AS bounds
+        FROM pg_inherits
+        JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+        JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+        WHERE parent.relname = ANY(:tables)
+        ORDER BY parent.relname, child.relname
+    """), {"tables": list(PARTITIONED_TABLES)})
+    return [dict(row._mapping) for row in rows]
+
+
+def _maintain(plant: str) -> None:
+    # Шаги независимы: ошибка создания секций не останавливает очистку
+    steps = (
+        (create_partitions, "Created %s monthly partitions in plant %s"),
+        (sync.purge_deleted_records, "Purged %s deleted records in plant %s"),
+        (similarity.purge_profile_changes, "Purged %s batch profile changes in plant %s"),
+    )
+    db = shards.session(plant, "reporting")
+    try:
+        for step, message in steps:
+            try:
+                count = step(db)
+            except Exception:
+                logger.exception("Partition maintenance step %s failed for plant %s", step.__name__, plant)
+                db.rollback()
+                continue
+            if count:
+                logger.info(message, count, plant)
+    finally:
+        db.close()
+
+
+def _maintain_central() -> None:
+    # Задачи хранятся только в центральной базе
+    db = ReportingSessionLocal()
+    try:
+        count = jobs.purge_finished_jobs(db)
+        if count:
+            logger.info("Purged %s finished jobs", count)
+    except Exception:
+        logger.exception("Job purge failed")
+        db.rollback()
+    finally:
+        db.close()
+
+
+def _maintenance_loop() -> None:
+    while not _stop_event.is_set():
+        # Секции и записи об удалении есть в базе каждого завода
+        for plant in shards.plants:
+            _maintain(plant)
+        _maintain_central()
+        _stop_event.wait(settings.PARTITION_MAINTENANCE_INTERVAL)
+
+
+def start_maintenance() -> None:
+    """Запускает фоновое создание секций наперед"""
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop_event.clear()
+    _thread = threading.Thread(target=_maintenance_loop, name="partition-maintenance", daemon=True)
+    _thread.start()
+
+
+def stop_maintenance() -> None:
+    _stop_event.set()
@@ -0,0 +1,322 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event
+
+from . import models
+from .config import settings
+from .database import shards, SessionLocal
+from .ratelimit import token_claims
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_QUERY = b"profile="
+FORMATS = ("json", "collapsed")
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Листовые функции, в которых потоки ждут работы (пул потоков, event loop)
+_IDLE_FRAMES = {("threading.py", "wait"), ("queue.py", "get"), ("selectors.py", "select")}
+
+# Профиль запроса, в контексте которого выполняется код (копируется и в пул потоков)
+_current: contextvars.ContextVar[Optional["RequestProfile"]] = contextvars.ContextVar("request_profile", default=None)
+
+
+def _frame_label(code) -> str:
+    path = code.co_filename
+    marker = "site-packages" + os.sep
+    if marker in path:
+        path = path.split(marker, 1)[1]
+    elif path.startswith(_APP_DIR):
+        path = "app" + path[len(_APP_DIR):]
+    else:
+        path = os.path.basename(path)
+    return f"{code.co_qualname} ({path}:{code.co_firstlineno})"
+
+
+class Sampler(threading.Thread):
+    """Периодически снимает стеки всех потоков процесса и считает одинаковые стеки.
+
+    Потоки, простаивающие в ожидании работы, и потоки самого профилировщика не учитываются.
+    """
+
+    def __init__(self, interval: float, name: str = "profile-sampler", max_duration: Optional[float] = None):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self.max_duration = max_duration
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        started = time.monotonic()
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            if self.max_duration is not None and time.monotonic() - started > self.max_duration:
+                break
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            sampled = []
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, str(ident))
+                if ident == own or name.startswith("profile-"):
+                    continue
+                leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+                stack = []
+                in_app = False
+                while frame is not None:
+                    in_app = in_app or frame.f_code.co_filename.startswith(_APP_DIR)
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                # Фоновые циклы приложения ждут на threading.Event между итерациями
+                if (leaf in _IDLE_FRAMES and not in_app) or any(label.startswith("Event.wait ") for label in stack[:3]):
+                    continue
+                stack.append(name)
+                sampled.append(tuple(reversed(stack)))
+            with self._lock:
+                self.samples += 1
+                self.stacks.update(sampled)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+    def drain(self) -> Tuple[int, Counter]:
+        """Забирает накопленные стеки и начинает новое окно"""
+        with self._lock:
+            samples, stacks = self.samples, self.stacks
+            self.samples, self.stacks = 0, Counter()
+        return samples, stacks
+
+
+def collapsed(stacks: Counter) -> str:
+    """Стеки в формате collapsed (flamegraph.pl, speedscope): "поток;корень;...;лист число" """
+    return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks.most_common())
+
+
+class RequestProfile:
+    def __init__(self):
+        self.statements: List[Dict[str, Any]] = []
+        self.statement_count = 0
+        self.sql_total = 0.0
+        self.threads = set()
+        self._lock = threading.Lock()
+
+    def add_statement(self, statement: str, duration: float, rows: int, executemany: bool) -> None:
+        thread = threading.current_thread().name
+        with self._lock:
+            self.statement_count += 1
+            self.sql_total += duration
+            self.threads.add(thread)
+            if len(self.statements) < settings.PROFILING_MAX_STATEMENTS:
+                self.statements.append({
+                    "statement": statement,
+                    "duration_ms": round(duration * 1000, 3),
+                    "rows": rows,
+                    "executemany": executemany,
+                    "thread": thread,
+                })
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None and context is not None:
+        context.profile_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current.get()
+    started = getattr(context, "profile_started", None)
+    if profile is not None and started is not None:
+        profile.add_statement(statement, time.perf_counter() - started, cursor.rowcount, executemany)
+
+
+if settings.PROFILING_ENABLED:
+    # Без профилируемого запроса слушатели только проверяют contextvar
+    for _engine in shards.all_engines():
+        event.listen(_engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def requested_format(scope) -> Optional[str]:
+    """Формат профиля из заголовка X-Profile или параметра ?profile=; None - профилирование не запрошено"""
+    value = None
+    for name, header in scope["headers"]:
+        if name == PROFILE_HEADER:
+            value = header.decode("latin-1")
+            break
+    query = scope.get("query_string", b"")
+    if value is None and PROFILE_QUERY in query:
+        for item in query.split(b"&"):
+            if item.startswith(PROFILE_QUERY):
+                value = item[len(PROFILE_QUERY):].decode("latin-1")
+    if value is None:
+        return None
+    value = value.strip().lower()
+    return value if value in FORMATS else "json"
+
+
+def _is_admin(scope) -> bool:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            claims = token_claims(token) if scheme.lower() == "bearer" and token else None
+            if claims is None:
+                return False
+            # Права проверяются по текущей роли в БД, а не по роли из токена
+            with SessionLocal() as db:
+                user = db.get(models.User, claims[0])
+                return bool(user and user.is_active and user.role and user.role.permissions.get("admin"))
+    return False
+
+
+async def _send_json(send, status: int, content: Any) -> None:
+    body = json.dumps(content, ensure_ascii=False).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class ProfilingMiddleware:
+    """ASGI-middleware профилирования отдельного запроса по запросу администратора.
+
+    X-Profile: json | collapsed (или ?profile=) выполняет запрос под семплирующим профилировщиком;
+    вместо тела ответа возвращается профиль: collapsed-стеки и SQL-запросы с длительностью.
+    Без флага запрос проходит без изменений.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        profile_format = requested_format(scope)
+        if profile_format is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await run_in_threadpool(_is_admin, scope):
+            await _send_json(send, 403, {"detail": "Profiling is available only to administrators"})
+            return
+
+        response: Dict[str, Any] = {"status": None, "content_type": None, "bytes": 0}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                for name, value in message.get("headers", []):
+                    if name == b"content-type":
+                        response["content_type"] = value.decode("latin-1")
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+
+        profile = RequestProfile()
+        sampler = Sampler(settings.PROFILING_INTERVAL, max_duration=settings.PROFILING_MAX_DURATION)
+        token = _current.set(profile)
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            duration = time.perf_counter() - started
+            sampler.stop()
+            _current.reset(token)
+
+        stacks = collapsed(sampler.stacks)
+        if profile_format == "collapsed":
+            body = stacks.encode()
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/plain; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"x-profile-status", str(response["status"]).encode()),
+                    (b"x-profile-duration-ms", f"{duration * 1000:.1f}".encode()),
+                    (b"x-profile-sql-ms", f"{profile.sql_total * 1000:.1f}".encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        await _send_json(send, 200, {
+            "method": scope["method"],
+            "path": scope["path"],
+            "response": response,
+            "duration_ms": round(duration * 1000, 3),
+            "sampling_interval_ms": settings.PROFILING_INTERVAL * 1000,
+            "samples": sampler.samples,
+            # Потоки, выполнявшие SQL этого запроса; стеки остальных потоков - параллельная работа процесса
+            "request_threads": sorted(profile.threads),
+            "collapsed": stacks,
+            "sql": {
+                "count": profile.statement_count,
+                "total_ms": round(profile.sql_total * 1000, 3),
+                "statements": profile.statements,
+            },
+        })
+
+
+# Непрерывное профилирование с низкой частотой в ротируемый файл
+_continuous: Optional[Sampler] = None
+_stop_event = threading.Event()
+_writer_thread = None
+
+
+def _continuous_loop(sampler: Sampler, file_logger: logging.Logger) -> None:
+    while not _stop_event.wait(settings.PROFILING_CONTINUOUS_WINDOW):
+        samples, stacks = sampler.drain()
+        if stacks:
+            # Одно окно - одна запись: ротация не разрывает окно между файлами
+            header = f"# {time.strftime('%Y-%m-%dT%H:%M:%S%z')} samples={samples}\n"
+            file_logger.info(header + collapsed(stacks).rstrip("\n"))
+
+
+def start_continuous() -> None:
+    """Запускает фоновое семплирование, если включено PROFILING_CONTINUOUS"""
+    global _continuous, _writer_thread
+    if not settings.PROFILING_CONTINUOUS or (_writer_thread is not None and _writer_thread.is_alive()):
+        return
+    os.makedirs(os.path.dirname(settings.PROFILING_CONTINUOUS_FILE), exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        settings.PROFILING_CONTINUOUS_FILE,
+        maxBytes=settings.PROFILING_CONTINUOUS_MAX_BYTES,
+        backupCount=settings.PROFILING_CONTINUOUS_BACKUPS,
+        encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    file_logger = logging.getLogger(f"{__name__}.continuous")
+    file_logger.handlers = [handler]
+    file_logger.setLevel(logging.INFO)
+    file_logger.propagate = False
+
+    _stop_event.clear()
+    _continuous = Sampler(settings.PROFILING_CONTINUOUS_INTERVAL, name="profile-continuous")
+    _continuous.start()
+    _writer_thread = threading.Thread(
+        target=_continuous_loop, args=(_continuous, file_logger), name="profile-writer", daemon=True
+    )
+    _writer_thread.start()
+    logger.info("Continuous profiling to %s", settings.PROFILING_CONTINUOUS_FILE)
+
+
+def stop_continuous() -> None:
+    _stop_event.set()
+    if _continuous is not None:
+        _continuous.stop()
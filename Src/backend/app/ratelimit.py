@@ -0,0 +1,239 @@
+import ipaddress
+import json
+import logging
+import math
+import threading
+import time
+from functools import lru_cache
+from typing import Optional, Tuple, Dict
+
+from jose import JWTError, jwt
+
+from .config import settings
+from .utils import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Группы маршрутов по префиксу пути; остальные запросы - read или write по методу
+ROUTE_GROUPS = (
+    ("/api/auth/token", "auth"),
+    ("/api/analytics", "reports"),
+    ("/api/jobs", "reports"),
+    ("/api/maintenance", "reports"),
+)
+EXEMPT_PATHS = ("/api/health", "/api/docs", "/api/redoc", "/api/openapi.json")
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+ANONYMOUS_ROLE = "anonymous"
+
+
+def route_group(method: str, path: str) -> Optional[str]:
+    if not path.startswith("/api/") or path.startswith(EXEMPT_PATHS):
+        return None
+    for prefix, group in ROUTE_GROUPS:
+        if path.startswith(prefix):
+            return group
+    return "read" if method in READ_METHODS else "write"
+
+
+def get_limit(role: str, group: str) -> Optional[Tuple[float, float]]:
+    """Возвращает (запросов в секунду, размер пачки) для роли и группы маршрутов"""
+    limits = settings.RATE_LIMITS.get(role, {}).get(group) or settings.RATE_LIMITS.get("default", {}).get(group)
+    if not limits:
+        return None
+    return float(limits[0]), float(limits[1])
+
+
+class MemoryBackend:
+    """Token bucket в памяти процесса"""
+
+    def __init__(self, prune_interval: float = settings.RATE_LIMIT_PRUNE_INTERVAL):
+        self._buckets: Dict[str, Tuple[float, float, float, float]] = {}
+        self._lock = threading.Lock()
+        self._prune_interval = prune_interval
+        self._last_prune = time.monotonic()
+
+    async def hit(self, key: str, rate: float, burst: float) -> float:
+        return self.hit_sync(key, rate, burst)
+
+    def hit_sync(self, key: str, rate: float, burst: float) -> float:
+        """Списывает токен; возвращает 0, если запрос разрешен, иначе через сколько секунд повторить"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_prune >= self._prune_interval:
+                self._prune(now)
+            bucket = self._buckets.get(key)
+            tokens = burst if bucket is None else min(burst, bucket[0] + (now - bucket[1]) * rate)
+            if tokens >= 1.0:
+                self._buckets[key] = (tokens - 1.0, now, rate, burst)
+                return 0.0
+            self._buckets[key] = (tokens, now, rate, burst)
+            return (1.0 - tokens) / rate
+
+    def _prune(self, now: float) -> None:
+        # Полностью восстановившееся ведро ничем не отличается от отсутствующего
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if now - bucket[1] < (bucket[3] - bucket[0]) / bucket[2]
+        }
+        self._last_prune = now
+
+
+_REDIS_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local retry = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(retry)
+"""
+
+
+class RedisBackend:
+    """Общий для всех процессов API token bucket в Redis.
+
+    При недоступности Redis решение принимается по локальному ведру процесса.
+    """
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self._client = redis.from_url(url)
+        self._script = self._client.register_script(_REDIS_SCRIPT)
+        self._fallback = MemoryBackend()
+
+    async def hit(self, key: str, rate: float, burst: float) -> float:
+        try:
+            return float(await self._script(keys=[f"ratelimit:{key}"], args=[rate, burst]))
+        except Exception:
+            logger.warning("Rate limit backend unavailable, using local buckets", exc_info=True)
+            return self._fallback.hit_sync(key, rate, burst)
+
+
+def create_backend():
+    if settings.RATE_LIMIT_BACKEND == "redis":
+        try:
+            return RedisBackend(settings.RATE_LIMIT_REDIS_URL)
+        except ImportError:
+            logger.warning("redis package is not installed, using in-memory rate limiting")
+    return MemoryBackend()
+
+
+# Разобранные токены кэшируются, чтобы не проверять подпись JWT на каждый запрос
+_claims_cache = TTLCache(maxsize=10000, ttl=60.0)
+
+
+def token_claims(token: str) -> Optional[Tuple[int, str]]:
+    claims = _claims_cache.get(token)
+    if claims is None:
+        try:
+            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        except JWTError:
+            return None
+        if payload.get("user_id") is None:
+            return None
+        claims = (payload["user_id"], payload.get("role") or ANONYMOUS_ROLE)
+        _claims_cache.set(token, claims)
+    return claims
+
+
+@lru_cache(maxsize=8)
+def _trusted_networks(proxies: Tuple[str, ...]) -> tuple:
+    return tuple(ipaddress.ip_network(proxy, strict=False) for proxy in proxies)
+
+
+def _is_trusted(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in _trusted_networks(tuple(settings.RATE_LIMIT_TRUSTED_PROXIES)))
+
+
+def client_ip(scope) -> Optional[str]:
+    """IP-адрес клиента; за доверенным прокси - из X-Forwarded-For или X-Real-IP.
+
+    В X-Forwarded-For берется самый правый адрес не из доверенных прокси: левее клиент может записать что угодно.
+    """
+    client = scope.get("client")
+    peer = client[0] if client else None
+    if peer is None or not _is_trusted(peer):
+        return peer
+    headers = dict(scope["headers"])
+    forwarded = headers.get(b"x-forwarded-for")
+    if forwarded:
+        for address in reversed(forwarded.decode("latin-1").split(",")):
+            address = address.strip()
+            if address and not _is_trusted(address):
+                return address
+    real_ip = headers.get(b"x-real-ip")
+    if real_ip:
+        return real_ip.decode("latin-1").strip() or peer
+    return peer
+
+
+def client_identity(scope, group: str) -> Tuple[str, str]:
+    """Ключ клиента и его роль: user_id из JWT, для входа и без токена - IP-адрес"""
+    if group != "auth":
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                scheme, _, token = value.decode("latin-1").partition(" ")
+                if scheme.lower() == "bearer" and token:
+                    claims = token_claims(token)
+                    if claims is not None:
+                        return f"user:{claims[0]}", claims[1]
+                break
+    return f"ip:{client_ip(scope) or 'unknown'}", ANONYMOUS_ROLE
+
+
+class RateLimitMiddleware:
+    """ASGI-middleware ограничения частоты запросов (token bucket на клиента и группу маршрутов)"""
+
+    def __init__(self, app, backend=None):
+        self.app = app
+        self.backend = backend or create_backend()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.RATE_LIMIT_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        group = route_group(scope["method"], scope["path"])
+        if group is None:
+            await self.app(scope, receive, send)
+            return
+
+        key, role = client_identity(scope, group)
+        limit = get_limit(role, group)
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        rate, burst = limit
+        retry_after = await self.backend.hit(f"{key}:{group}", rate, burst)
+        if retry_after <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        body = json.dumps({"detail": "Too many requests"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+                (b"x-ratelimit-limit", f"{rate:g}/s;burst={burst:g}".encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
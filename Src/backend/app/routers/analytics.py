@@ -0,0 +1,146 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy.orm import Session
+from typing import Dict, Optional
+from datetime import datetime
+
+from .. import schemas, crud, heatmap, clustering, line_flow, similarity, tracing
+from ..database import get_plant_db, get_plant_sessions, ShardUnavailable
+from ..auth import get_current_user
+from ..config import settings
+from ..utils import as_utc
+
+router = APIRouter(route_class=tracing.TracedRoute)
+
+
+@router.get("/defect-heatmap", response_model=schemas.DefectHeatmap)
+def read_defect_heatmap(
+    product_type_id: Optional[int] = None,
+    defect_type_id: Optional[int] = None,
+    furnace_number: Optional[str] = None,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None,
+    bins_x: int = Query(50, ge=1, le=500),
+    bins_y: int = Query(50, ge=1, le=500),
+    x_min: Optional[float] = None,
+    x_max: Optional[float] = None,
+    y_min: Optional[float] = None,
+    y_max: Optional[float] = None,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить тепловую карту расположения дефектов"""
+    x_range = (x_min, x_max) if x_min is not None and x_max is not None else None
+    y_range = (y_min, y_max) if y_min is not None and y_max is not None else None
+    
+    if (x_range and x_range[0] > x_range[1]) or (y_range and y_range[0] > y_range[1]):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid coordinate range"
+        )
+    
+    return heatmap.defect_heatmap(
+        db,
+        product_type_id=product_type_id,
+        defect_type_id=defect_type_id,
+        furnace_number=furnace_number,
+        time_from=time_from,
+        time_to=time_to,
+        bins_x=bins_x,
+        bins_y=bins_y,
+        x_range=x_range,
+        y_range=y_range
+    )
+
+
+@router.get("/defect-clusters", response_model=schemas.DefectClusters)
+def read_defect_clusters(
+    inspection_id: Optional[int] = None,
+    batch_id: Optional[int] = None,
+    link_distance_mm: float = Query(settings.CLUSTER_LINK_DISTANCE_MM, gt=0),
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить кластеры соседних дефектов результата контроля или партии"""
+    if not inspection_id and not batch_id:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="inspection_id or batch_id is required"
+        )
+    
+    return clustering.cluster_defects(
+        db,
+        link_distance=link_distance_mm,
+        inspection_id=inspection_id,
+        batch_id=batch_id
+    )
+
+
+@router.get("/line-flow", response_model=schemas.LineFlow)
+def read_line_flow(
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None,
+    batch_id: Optional[int] = None,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить время переходов между контрольными точками, пропускную способность и узкие места"""
+    time_from, time_to = as_utc(time_from), as_utc(time_to)
+    if time_from and time_to and time_from >= time_to:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="time_from must be earlier than time_to"
+        )
+    
+    return line_flow.line_flow(db, time_from=time_from, time_to=time_to, batch_id=batch_id)
+
+
+@router.get("/similar-batches", response_model=schemas.SimilarBatches)
+def read_similar_batches(
+    batch_id: int,
+    k: int = Query(10, ge=1, le=settings.SIMILARITY_MAX_K),
+    product_type_id: Optional[int] = None,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Найти партии с похожим профилем измерений: среднее, разброс и перцентили показателей по точкам контроля
+
+    В ответе печь, дата производства и статус найденных партий - для поиска причин несоответствия
+    """
+    try:
+        result = similarity.find_similar(db, batch_id=batch_id, k=k, product_type_id=product_type_id)
+    except similarity.IndexNotReady:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Similarity index is being built",
+            headers={"Retry-After": str(int(settings.SIMILARITY_REFRESH_INTERVAL))}
+        )
+    if result is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Batch has no measurements"
+        )
+    return result
+
+
+@router.get("/plant-stats", response_model=schemas.PlantStatisticsReport)
+def read_plant_statistics(
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None,
+    sessions: Dict[str, Session] = Depends(get_plant_sessions),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить сводку по заводам: партии по статусам, результаты контроля и дефекты
+
+    X-Plant: all или несколько заводов через запятую - базы заводов опрашиваются параллельно
+    """
+    time_from, time_to = as_utc(time_from), as_utc(time_to)
+    if time_from and time_to and time_from >= time_to:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="time_from must be earlier than time_to"
+        )
+    
+    try:
+        return crud.plant_statistics_report(sessions, time_from=time_from, time_to=time_to)
+    except ShardUnavailable as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
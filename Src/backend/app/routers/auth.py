@@ -3,11 +3,11 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 
-from .. import schemas, crud, auth
+from .. import schemas, crud, auth, tracing
 from ..database import get_db
 from ..config import settings
 
-router = APIRouter()
+router = APIRouter(route_class=tracing.TracedRoute)
 
 
 @router.post("/token", response_model=schemas.Token)
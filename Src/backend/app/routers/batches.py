@@ -1,12 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-from .. import schemas, crud
-from ..database import get_db
+from .. import schemas, crud, archive, certificates, fieldsets, batch_detail, concurrency, batch_import, wire
+from ..database import get_plant_db, get_plant_sessions, plant_of, ShardUnavailable
 from ..auth import get_current_user
 
-router = APIRouter()
+# Тела запросов в MessagePack, ответы в JSON, MessagePack или Arrow IPC по Accept
+router = APIRouter(route_class=wire.WireRoute, default_response_class=wire.NegotiatedResponse)
 
 
 @router.get("/", response_model=List[schemas.ProductionBatch])
@@ -15,24 +18,42 @@ def read_batches(
     limit: int = 100,
     status: Optional[str] = None,
     product_type_id: Optional[int] = None,
-    db: Session = Depends(get_db),
+    batch_number: Optional[str] = None,
+    fields: Optional[str] = None,
+    expand: Optional[str] = None,
+    sessions: Dict[str, Session] = Depends(get_plant_sessions),
     current_user: schemas.User = Depends(get_current_user)
 ):
-    """Получить список производственных партий"""
-    batches = crud.get_batches(
-        db, 
-        skip=skip, 
-        limit=limit, 
-        status=status,
-        product_type_id=product_type_id
-    )
+    """Получить список производственных партий
+
+    batch_number - поиск по началу номера, fields - список полей через запятую,
+    expand - вложенные объекты (product_type). X-Plant: all или несколько заводов через запятую -
+    общий список по заводам в порядке (id, plant_code)
+    """
+    try:
+        projection = fieldsets.parse("batches", fields, expand)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    filters = dict(skip=skip, limit=limit, status=status, product_type_id=product_type_id, batch_number=batch_number)
+    # Список читается без ORM-объектов: только нужные колонки сразу в словари
+    if len(sessions) > 1:
+        try:
+            batches = crud.list_batches_across_plants(sessions, projection or fieldsets.full("batches"), **filters)
+        except ShardUnavailable as e:
+            raise HTTPException(status_code=503, detail=str(e))
+    else:
+        db = next(iter(sessions.values()))
+        batches = crud.list_batches(db, projection or fieldsets.full("batches"), **filters)
+    if projection:
+        return projection.render(batches)
     return batches
 
 
 @router.post("/", response_model=schemas.ProductionBatch, status_code=status.HTTP_201_CREATED)
 def create_batch(
     batch: schemas.ProductionBatchCreate,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
     """Создать новую производственную партию"""
@@ -55,14 +76,131 @@ def create_batch(
     return crud.create_batch(db=db, batch=batch)
 
 
+@router.post("/import", response_model=schemas.BatchImportReport)
+async def import_batches(
+    request: Request,
+    format: Optional[str] = None,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Импортировать партии из MES: CSV с заголовком или NDJSON, upsert по batch_number
+
+    Формат берется из format (csv, ndjson) или Content-Type. Вид продукции задается
+    product_type_code или product_type_id; ошибочные строки возвращаются в errors.
+    """
+    if not (current_user.role and (current_user.role.permissions.get("write") or
+                                   current_user.role.permissions.get("admin"))):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+
+    import_format = batch_import.detect_format(format, request.headers.get("content-type"))
+    if import_format is None:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Upload text/csv or application/x-ndjson"
+        )
+
+    try:
+        return await run_in_threadpool(
+            batch_import.import_batches,
+            db,
+            batch_import.iter_stream_lines(request.stream()),
+            import_format,
+            current_user.id
+        )
+    except batch_import.ImportFormatError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+def _check_selection(selection: schemas.BatchSelection) -> None:
+    # Пустой выбор затронул бы все партии
+    if not selection.model_dump(exclude_none=True):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Selection must contain ids or at least one filter"
+        )
+
+
+@router.post("/bulk-update", response_model=schemas.BulkOperationResult)
+def bulk_update_batches(
+    bulk_update: schemas.ProductionBatchBulkUpdate,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Массово изменить статус и оценку качества партий по списку id или фильтру"""
+    if not (current_user.role and (current_user.role.permissions.get("write") or
+                                   current_user.role.permissions.get("admin"))):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+
+    _check_selection(bulk_update.selection)
+    values = bulk_update.model_dump(exclude_unset=True, exclude={"selection"})
+    # Явный null для quality_rating снимает оценку, а у партии без статуса его не бывает
+    if "status" in values and values["status"] is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="status cannot be null"
+        )
+    if not values:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Nothing to update: set status or quality_rating"
+        )
+    if bulk_update.quality_rating is not None and not 1 <= bulk_update.quality_rating <= 5:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="quality_rating must be between 1 and 5"
+        )
+
+    try:
+        ids = crud.bulk_update_batches(db, selection=bulk_update.selection, values=values)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if bulk_update.status == certificates.SHIPPED_STATUS:
+        for batch_id in ids:
+            background_tasks.add_task(certificates.warm_certificate, plant_of(db), batch_id)
+    return {"affected": len(ids), "ids": ids}
+
+
+@router.post("/bulk-delete", response_model=schemas.BulkOperationResult)
+def bulk_delete_batches(
+    bulk_delete: schemas.ProductionBatchBulkDelete,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Массово удалить партии по списку id или фильтру"""
+    if not (current_user.role and current_user.role.permissions.get("delete")):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+
+    _check_selection(bulk_delete.selection)
+    try:
+        ids = crud.bulk_delete_batches(db, selection=bulk_delete.selection)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return {"affected": len(ids), "ids": ids}
+
+
 @router.get("/{batch_id}", response_model=schemas.ProductionBatch)
 def read_batch(
     batch_id: int,
-    db: Session = Depends(get_db),
+    response: Response,
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
     """Получить партию по ID"""
     db_batch = crud.get_batch(db, batch_id=batch_id)
+    if db_batch is not None:
+        response.headers["ETag"] = concurrency.etag(db_batch.version)
+        return db_batch
+    db_batch = archive.get_archived_batch(db, batch_id=batch_id)
     if db_batch is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -71,14 +209,45 @@ def read_batch(
     return db_batch
 
 
+@router.get("/{batch_id}/full", response_model=schemas.ProductionBatchFull)
+def read_batch_full(
+    batch_id: int,
+    request: Request,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить партию с видом продукции, результатами контроля и дефектами"""
+    result = batch_detail.batch_full(db, batch_id=batch_id)
+    if result is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Batch not found"
+        )
+
+    etag = '"%s"' % result[0]
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(
+        content=result[1],
+        media_type="application/json",
+        headers={"ETag": etag, "Cache-Control": "private, no-cache"}
+    )
+
+
 @router.put("/{batch_id}", response_model=schemas.ProductionBatch)
 def update_batch(
     batch_id: int,
     batch_update: schemas.ProductionBatchUpdate,
-    db: Session = Depends(get_db),
+    background_tasks: BackgroundTasks,
+    response: Response,
+    expected_version: Optional[int] = Depends(concurrency.expected_version),
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
-    """Обновить партию"""
+    """Обновить партию
+
+    If-Match с ETag партии - обновление только при неизменной версии, иначе 412
+    """
     if not (current_user.role and (current_user.role.permissions.get("write") or 
                                    current_user.role.permissions.get("admin"))):
         raise HTTPException(
@@ -86,19 +255,57 @@ def update_batch(
             detail="Not enough permissions"
         )
     
-    db_batch = crud.update_batch(db, batch_id=batch_id, batch_update=batch_update)
+    try:
+        db_batch = crud.update_batch(db, batch_id=batch_id, batch_update=batch_update, expected_version=expected_version)
+    except crud.VersionConflict:
+        raise concurrency.precondition_failed("Batch")
     if db_batch is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Batch not found"
         )
+    response.headers["ETag"] = concurrency.etag(db_batch.version)
+    if batch_update.status == certificates.SHIPPED_STATUS:
+        # Сертификат готовится заранее, чтобы отдел отгрузки получил его без ожидания
+        background_tasks.add_task(certificates.warm_certificate, plant_of(db), db_batch.id)
     return db_batch
 
 
+@router.get("/{batch_id}/certificate")
+def read_batch_certificate(
+    batch_id: int,
+    request: Request,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить сертификат качества отгруженной партии"""
+    certificate = certificates.get_certificate(db, batch_id=batch_id)
+    if certificate is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Batch not found"
+        )
+    if certificate["status"] != certificates.SHIPPED_STATUS:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Certificate is available only for shipped batches"
+        )
+
+    etag = '"%s"' % certificate["etag"]
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return FileResponse(
+        certificate["path"],
+        media_type="text/html; charset=utf-8",
+        headers={"ETag": etag, "Cache-Control": "private, no-cache"}
+    )
+
+
 @router.delete("/{batch_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_batch(
     batch_id: int,
-    db: Session = Depends(get_db),
+    expected_version: Optional[int] = Depends(concurrency.expected_version),
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
     """Удалить партию"""
@@ -108,7 +315,11 @@ def delete_batch(
             detail="Not enough permissions"
         )
     
-    if not crud.delete_batch(db, batch_id=batch_id):
+    try:
+        deleted = crud.delete_batch(db, batch_id=batch_id, expected_version=expected_version)
+    except crud.VersionConflict:
+        raise concurrency.precondition_failed("Batch")
+    if not deleted:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Batch not found"
@@ -0,0 +1,104 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status, Response
+from fastapi.security import OAuth2PasswordBearer
+from typing import List, Optional
+
+from .. import schemas, auth, edge, wire
+
+# Подключается только в режиме линейного узла (EDGE_MODE)
+router = APIRouter(route_class=wire.WireRoute, default_response_class=wire.NegotiatedResponse)
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/token")
+
+
+def get_edge_principal(token: str = Depends(oauth2_scheme)) -> edge.Principal:
+    """Пользователь токена; без связи с центральной базой - по копии на узле"""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    token_data = auth.verify_token(token, credentials_exception)
+    principal = edge.authenticate(token_data.username)
+    if principal is None:
+        raise credentials_exception
+    return principal
+
+
+def _require_admin(principal: edge.Principal) -> None:
+    if not principal.permissions.get("admin"):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+
+
+@router.post("/inspections", response_model=schemas.EdgeInspection, status_code=status.HTTP_201_CREATED)
+def record_inspection(
+    inspection: schemas.EdgeInspectionCreate,
+    response: Response,
+    principal: edge.Principal = Depends(get_edge_principal)
+):
+    """Записать результат контроля с дефектами на узле; пересылка в центральную базу - в фоне
+
+    Повторная отправка с тем же edge_id возвращает ранее записанный результат (200)
+    """
+    if not (principal.permissions.get("write") or principal.permissions.get("admin")):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+    
+    if not inspection.inspector_id:
+        inspection.inspector_id = principal.id
+    
+    if not inspection.inspector_name:
+        inspection.inspector_name = principal.full_name or principal.username
+    
+    db_inspection, created = edge.record_inspection(inspection)
+    if not created:
+        response.status_code = status.HTTP_200_OK
+    return db_inspection
+
+
+@router.get("/status", response_model=schemas.EdgeStatus)
+def read_edge_status(
+    principal: edge.Principal = Depends(get_edge_principal)
+):
+    """Получить состояние узла: очередь на пересылку, связь с центральной базой, скорость разбора очереди"""
+    return edge.forwarder.status()
+
+
+@router.get("/rejected", response_model=List[schemas.EdgeRejected])
+def read_rejected(
+    skip: int = 0,
+    limit: int = 100,
+    principal: edge.Principal = Depends(get_edge_principal)
+):
+    """Получить результаты, которые центральная база не приняла (неизвестная партия, точка контроля, тип дефекта)"""
+    _require_admin(principal)
+    return edge.store.rejected(skip=skip, limit=limit)
+
+
+@router.post("/rejected/requeue", response_model=schemas.EdgeRequeued)
+def requeue_rejected(
+    edge_id: Optional[List[str]] = Query(None),
+    principal: edge.Principal = Depends(get_edge_principal)
+):
+    """Вернуть отклоненные результаты в очередь пересылки (все или перечисленные edge_id),
+    после того как в центральной базе заведены недостающие партии, точки контроля или типы дефектов
+    """
+    _require_admin(principal)
+    requeued = edge.store.requeue(edge_id)
+    if requeued:
+        edge.forwarder.wake()
+    return {"requeued": requeued}
+
+
+@router.post("/forward", response_model=schemas.EdgeStatus)
+def forward_now(
+    principal: edge.Principal = Depends(get_edge_principal)
+):
+    """Начать пересылку сразу, не дожидаясь интервала или паузы после ошибки"""
+    _require_admin(principal)
+    edge.forwarder.wake()
+    return edge.forwarder.status()
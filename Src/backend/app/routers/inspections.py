@@ -1,12 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Response
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import Dict, List, Optional
+from datetime import datetime
 
-from .. import schemas, crud
-from ..database import get_db
+from .. import schemas, crud, archive, fieldsets, concurrency, wire
+from ..database import get_plant_db, get_plant_sessions, ShardUnavailable
 from ..auth import get_current_user
 
-router = APIRouter()
+# Тела запросов в MessagePack, ответы в JSON, MessagePack или Arrow IPC по Accept
+router = APIRouter(route_class=wire.WireRoute, default_response_class=wire.NegotiatedResponse)
 
 
 @router.get("/", response_model=List[schemas.InspectionResult])
@@ -15,24 +17,77 @@ def read_inspections(
     limit: int = 100,
     batch_id: Optional[int] = None,
     verdict: Optional[str] = None,
-    db: Session = Depends(get_db),
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None,
+    fields: Optional[str] = None,
+    expand: Optional[str] = None,
+    sessions: Dict[str, Session] = Depends(get_plant_sessions),
     current_user: schemas.User = Depends(get_current_user)
 ):
-    """Получить список результатов контроля"""
-    inspections = crud.get_inspection_results(
-        db, 
-        skip=skip, 
+    """Получить список результатов контроля
+
+    fields - список полей через запятую, expand - вложенные объекты (batch, batch.product_type).
+    X-Plant: all или несколько заводов через запятую - общий список по заводам в порядке inspection_time
+    """
+    try:
+        projection = fieldsets.parse("inspections", fields, expand)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    if len(sessions) > 1:
+        try:
+            inspections = crud.list_inspection_results_across_plants(
+                sessions,
+                projection or fieldsets.full("inspections"),
+                skip=skip,
+                limit=limit,
+                batch_id=batch_id,
+                verdict=verdict,
+                time_from=time_from,
+                time_to=time_to
+            )
+        except ShardUnavailable as e:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+        return projection.render(inspections) if projection else inspections
+    
+    # Список читается без ORM-объектов: только нужные колонки сразу в словари
+    db = next(iter(sessions.values()))
+    inspections = crud.list_inspection_results(
+        db,
+        projection or fieldsets.full("inspections"),
+        skip=skip,
         limit=limit,
         batch_id=batch_id,
-        verdict=verdict
+        verdict=verdict,
+        time_from=time_from,
+        time_to=time_to
     )
+    
+    # Недостающие строки страницы дочитываются из холодного архива
+    if len(inspections) < limit and archive.has_archive("inspection_results"):
+        archived_skip = 0
+        if skip and not inspections:
+            archived_skip = max(0, skip - crud.count_inspection_results(
+                db, batch_id=batch_id, verdict=verdict, time_from=time_from, time_to=time_to
+            ))
+        inspections = inspections + archive.get_archived_inspections(
+            db,
+            skip=archived_skip,
+            limit=limit - len(inspections),
+            batch_id=batch_id,
+            verdict=verdict,
+            time_from=time_from,
+            time_to=time_to
+        )
+    if projection:
+        return projection.render(inspections)
     return inspections
 
 
 @router.post("/", response_model=schemas.InspectionResult, status_code=status.HTTP_201_CREATED)
 def create_inspection(
     inspection: schemas.InspectionResultCreate,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
     """Создать новый результат контроля"""
@@ -52,10 +107,43 @@ def create_inspection(
     return crud.create_inspection_result(db=db, inspection=inspection)
 
 
+@router.get("/alerts", response_model=List[schemas.AnomalyAlert])
+def read_anomaly_alerts(
+    skip: int = 0,
+    limit: int = 100,
+    inspection_point_id: Optional[int] = None,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить список тревог по выбросам в показаниях датчиков"""
+    return crud.get_anomaly_alerts(db, skip=skip, limit=limit, inspection_point_id=inspection_point_id)
+
+
+@router.post("/reevaluate")
+def reevaluate_inspections(
+    batch_id: Optional[int] = None,
+    status_filter: Optional[str] = None,
+    limit: int = 10000,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Пересчитать вердикты результатов контроля по спецификациям и порогам дефектов"""
+    if not (current_user.role and (current_user.role.permissions.get("write") or 
+                                   current_user.role.permissions.get("admin"))):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+    
+    updated = crud.reevaluate_inspection_results(db, batch_id=batch_id, status=status_filter, limit=limit)
+    return {"updated": updated}
+
+
 @router.get("/{inspection_id}", response_model=schemas.InspectionResult)
 def read_inspection(
     inspection_id: int,
-    db: Session = Depends(get_db),
+    response: Response,
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
     """Получить результат контроля по ID"""
@@ -66,6 +154,7 @@ def read_inspection(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Inspection result not found"
         )
+    response.headers["ETag"] = concurrency.etag(db_inspection.version)
     return db_inspection
 
 
@@ -73,10 +162,15 @@ def read_inspection(
 def update_inspection(
     inspection_id: int,
     inspection_update: schemas.InspectionResultUpdate,
-    db: Session = Depends(get_db),
+    response: Response,
+    expected_version: Optional[int] = Depends(concurrency.expected_version),
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
-    """Обновить результат контроля"""
+    """Обновить результат контроля
+
+    If-Match с ETag результата - обновление только при неизменной версии, иначе 412
+    """
     if not (current_user.role and (current_user.role.permissions.get("write") or 
                                    current_user.role.permissions.get("admin"))):
         raise HTTPException(
@@ -85,19 +179,29 @@ def update_inspection(
         )
     
     from ..crud import update_inspection_result
-    db_inspection = update_inspection_result(db, inspection_id=inspection_id, inspection_update=inspection_update)
+    try:
+        db_inspection = update_inspection_result(
+            db,
+            inspection_id=inspection_id,
+            inspection_update=inspection_update,
+            expected_version=expected_version
+        )
+    except crud.VersionConflict:
+        raise concurrency.precondition_failed("Inspection result")
     if db_inspection is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Inspection result not found"
         )
+    response.headers["ETag"] = concurrency.etag(db_inspection.version)
     return db_inspection
 
 
 @router.delete("/{inspection_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_inspection(
     inspection_id: int,
-    db: Session = Depends(get_db),
+    expected_version: Optional[int] = Depends(concurrency.expected_version),
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
     """Удалить результат контроля"""
@@ -108,7 +212,11 @@ def delete_inspection(
         )
     
     from ..crud import delete_inspection_result
-    if not delete_inspection_result(db, inspection_id=inspection_id):
+    try:
+        deleted = delete_inspection_result(db, inspection_id=inspection_id, expected_version=expected_version)
+    except crud.VersionConflict:
+        raise concurrency.precondition_failed("Inspection result")
+    if not deleted:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Inspection result not found"
@@ -0,0 +1,113 @@
+import os
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import FileResponse
+from sqlalchemy.orm import Session
+from typing import List, Optional
+
+from .. import schemas, models, jobs, tracing
+from ..database import get_db
+from ..auth import get_current_user
+
+router = APIRouter(route_class=tracing.TracedRoute)
+
+
+def _is_admin(current_user: schemas.User) -> bool:
+    return bool(current_user.role and current_user.role.permissions.get("admin"))
+
+
+def _get_own_job(db: Session, job_id: int, current_user: schemas.User) -> models.Job:
+    job = db.query(models.Job).filter(models.Job.id == job_id).first()
+    # Чужие задачи видны только администратору
+    if job is None or (job.created_by != current_user.id and not _is_admin(current_user)):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found"
+        )
+    return job
+
+
+@router.get("/", response_model=List[schemas.Job])
+def read_jobs(
+    skip: int = 0,
+    limit: int = 100,
+    status_filter: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить список фоновых задач"""
+    query = db.query(models.Job)
+    if not _is_admin(current_user):
+        query = query.filter(models.Job.created_by == current_user.id)
+    if status_filter:
+        query = query.filter(models.Job.status == status_filter)
+    return query.order_by(models.Job.id.desc()).offset(skip).limit(limit).all()
+
+
+@router.post("/", response_model=schemas.Job, status_code=status.HTTP_202_ACCEPTED)
+def create_job(
+    job: schemas.JobCreate,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Поставить отчет или выгрузку в очередь фоновых задач"""
+    handler = jobs.get_handler(job.job_type)
+    if handler is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown job type. Available: {', '.join(jobs.job_types())}"
+        )
+    if handler["admin_only"] and not _is_admin(current_user):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+    
+    try:
+        return jobs.runner.submit(db, job.job_type, job.params, job.priority, created_by=current_user.id)
+    except jobs.QueueFull:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Job queue is full",
+            headers={"Retry-After": "30"}
+        )
+
+
+@router.get("/{job_id}", response_model=schemas.Job)
+def read_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить статус и прогресс задачи"""
+    return _get_own_job(db, job_id, current_user)
+
+
+@router.post("/{job_id}/cancel", response_model=schemas.Job)
+def cancel_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Отменить задачу"""
+    job = _get_own_job(db, job_id, current_user)
+    return jobs.runner.cancel(db, job)
+
+
+@router.get("/{job_id}/result")
+def download_job_result(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Скачать результат задачи"""
+    job = _get_own_job(db, job_id, current_user)
+    if job.status != jobs.STATUS_SUCCEEDED or not job.result_path or not os.path.exists(job.result_path):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job result not available"
+        )
+    return FileResponse(
+        job.result_path,
+        media_type=job.result_content_type,
+        filename=os.path.basename(job.result_path)
+    )
@@ -0,0 +1,133 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+from typing import List, Optional
+from datetime import date, datetime
+
+from .. import schemas, partitions, archive, workload, tracing, audit, similarity
+from ..database import get_db, get_plant_db, plant_of
+from ..auth import get_current_user
+from ..config import settings
+
+router = APIRouter(route_class=tracing.TracedRoute)
+
+
+def _require_admin(current_user: schemas.User) -> None:
+    if not (current_user.role and current_user.role.permissions.get("admin")):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
+
+
+@router.get("/workload", response_model=List[schemas.WorkloadClassMetrics])
+def read_workload_metrics(
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить метрики очередей по классам нагрузки"""
+    _require_admin(current_user)
+    return workload.metrics()
+
+
+@router.get("/partitions", response_model=List[schemas.Partition])
+def read_partitions(
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить список помесячных секций в базе завода (X-Plant)"""
+    _require_admin(current_user)
+    return partitions.list_partitions(db)
+
+
+@router.post("/partitions")
+def create_partitions(
+    months_ahead: int = 3,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Создать секции на текущий и следующие месяцы"""
+    _require_admin(current_user)
+    return {"created": partitions.create_partitions(db, months_ahead=months_ahead)}
+
+
+@router.delete("/partitions/{month}")
+def drop_partitions(
+    month: date,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Удалить данные контроля за месяц целиком"""
+    _require_admin(current_user)
+    
+    dropped = partitions.drop_partitions(db, month)
+    if not dropped:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Partition not found"
+        )
+    return {"dropped": dropped}
+
+
+@router.post("/archive")
+def archive_closed_batches(
+    older_than_days: int = settings.ARCHIVE_AFTER_DAYS,
+    max_chunks: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Перенести отгруженные партии старше заданного срока в холодный архив"""
+    _require_admin(current_user)
+    return {"archived": archive.archive_closed_batches(db, older_than_days=older_than_days, max_chunks=max_chunks)}
+
+
+@router.get("/similarity", response_model=List[schemas.SimilarityIndexStats])
+def read_similarity_indexes(
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить состояние индексов похожих партий по заводам"""
+    _require_admin(current_user)
+    return [index.stats() for index in similarity.indexes.values()]
+
+
+@router.post("/similarity/rebuild")
+def rebuild_similarity_index(
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Перестроить индекс похожих партий завода (X-Plant) в фоне: новая нормировка и PCA"""
+    _require_admin(current_user)
+    similarity.request_rebuild(plant_of(db))
+    return {"plant_code": plant_of(db), "scheduled": True}
+
+
+@router.get("/audit", response_model=List[schemas.AuditEntry])
+def read_audit_log(
+    entity: Optional[str] = None,
+    entity_id: Optional[int] = None,
+    actor_id: Optional[int] = None,
+    action: Optional[str] = None,
+    plant_code: Optional[str] = None,
+    time_from: Optional[datetime] = None,
+    time_to: Optional[datetime] = None,
+    skip: int = 0,
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить журнал аудита изменений, новые записи первыми
+
+    entity - имя таблицы (production_batches, inspection_results, ...), action - update или delete,
+    plant_code - завод, в базе которого изменена запись (entity_id уникален только внутри завода)
+    """
+    _require_admin(current_user)
+    return audit.query(
+        db,
+        entity=entity,
+        entity_id=entity_id,
+        actor_id=actor_id,
+        action=action,
+        plant_code=plant_code,
+        time_from=time_from,
+        time_to=time_to,
+        skip=skip,
+        limit=limit
+    )
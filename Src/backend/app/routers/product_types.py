@@ -1,30 +1,47 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Response
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 
-from .. import schemas, crud
-from ..database import get_db
+from .. import schemas, crud, fieldsets, concurrency, tracing
+from ..database import get_plant_db
 from ..auth import get_current_user
 
-router = APIRouter()
+router = APIRouter(route_class=tracing.TracedRoute)
 
 
 @router.get("/", response_model=List[schemas.ProductType])
 def read_product_types(
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db),
+    fields: Optional[str] = None,
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
-    """Получить список типов продукции"""
-    product_types = crud.get_product_types(db, skip=skip, limit=limit)
+    """Получить список типов продукции
+
+    fields - список полей через запятую
+    """
+    try:
+        projection = fieldsets.parse("product_types", fields, None)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    # Список читается без ORM-объектов: только нужные колонки сразу в словари
+    product_types = crud.list_product_types(
+        db,
+        projection or fieldsets.full("product_types"),
+        skip=skip,
+        limit=limit
+    )
+    if projection:
+        return projection.render(product_types)
     return product_types
 
 
 @router.post("/", response_model=schemas.ProductType, status_code=status.HTTP_201_CREATED)
 def create_product_type(
     product_type: schemas.ProductTypeCreate,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
     """Создать новый тип продукции"""
@@ -45,7 +62,8 @@ def create_product_type(
 @router.get("/{type_id}", response_model=schemas.ProductType)
 def read_product_type(
     type_id: int,
-    db: Session = Depends(get_db),
+    response: Response,
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
     """Получить тип продукции по ID"""
@@ -55,6 +73,7 @@ def read_product_type(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Product type not found"
         )
+    response.headers["ETag"] = concurrency.etag(db_product_type.version)
     return db_product_type
 
 
@@ -62,10 +81,15 @@ def read_product_type(
 def update_product_type(
     type_id: int,
     product_type_update: schemas.ProductTypeUpdate,
-    db: Session = Depends(get_db),
+    response: Response,
+    expected_version: Optional[int] = Depends(concurrency.expected_version),
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
-    """Обновить тип продукции"""
+    """Обновить тип продукции
+
+    If-Match с ETag типа продукции - обновление только при неизменной версии, иначе 412
+    """
     if not (current_user.role and (current_user.role.permissions.get("admin") or 
                                    current_user.role.role_name == "quality_manager")):
         raise HTTPException(
@@ -73,19 +97,29 @@ def update_product_type(
             detail="Not enough permissions"
         )
     
-    db_product_type = crud.update_product_type(db, type_id=type_id, product_type_update=product_type_update)
+    try:
+        db_product_type = crud.update_product_type(
+            db,
+            type_id=type_id,
+            product_type_update=product_type_update,
+            expected_version=expected_version
+        )
+    except crud.VersionConflict:
+        raise concurrency.precondition_failed("Product type")
     if db_product_type is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Product type not found"
         )
+    response.headers["ETag"] = concurrency.etag(db_product_type.version)
     return db_product_type
 
 
 @router.delete("/{type_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_product_type(
     type_id: int,
-    db: Session = Depends(get_db),
+    expected_version: Optional[int] = Depends(concurrency.expected_version),
+    db: Session = Depends(get_plant_db),
     current_user: schemas.User = Depends(get_current_user)
 ):
     """Удалить тип продукции"""
@@ -95,7 +129,11 @@ def delete_product_type(
             detail="Not enough permissions"
         )
     
-    if not crud.delete_product_type(db, type_id=type_id):
+    try:
+        deleted = crud.delete_product_type(db, type_id=type_id, expected_version=expected_version)
+    except crud.VersionConflict:
+        raise concurrency.precondition_failed("Product type")
+    if not deleted:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Product type not found"
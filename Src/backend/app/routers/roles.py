@@ -2,11 +2,11 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from typing import List
 
-from .. import schemas, crud
+from .. import schemas, crud, tracing
 from ..database import get_db
 from ..auth import get_current_user
 
-router = APIRouter()
+router = APIRouter(route_class=tracing.TracedRoute)
 
 
 @router.get("/", response_model=List[schemas.Role])
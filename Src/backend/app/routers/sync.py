@@ -0,0 +1,44 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.orm import Session
+from typing import Optional
+from datetime import datetime
+
+from .. import schemas, sync, tracing
+from ..database import get_plant_db
+from ..auth import get_current_user
+from ..config import settings
+
+router = APIRouter(route_class=tracing.TracedRoute)
+
+
+@router.get("/{entity}")
+def read_changes(
+    entity: str,
+    updated_since: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = settings.SYNC_PAGE_SIZE,
+    db: Session = Depends(get_plant_db),
+    current_user: schemas.User = Depends(get_current_user)
+):
+    """Получить изменения и удаления сущности начиная с updated_since или курсора"""
+    if entity not in sync.ENTITIES:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Unknown entity. Allowed: {', '.join(sync.ENTITIES)}"
+        )
+    
+    try:
+        return sync.changes(
+            db,
+            entity,
+            updated_since=updated_since,
+            cursor=cursor,
+            limit=max(1, min(limit, settings.SYNC_MAX_PAGE_SIZE))
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except sync.ResyncRequired:
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="Changes are no longer available for this position, full resync required"
+        )
@@ -1,7 +1,8 @@
-from pydantic import BaseModel, EmailStr, ConfigDict
+from pydantic import BaseModel, EmailStr, ConfigDict, Field
 from typing import Optional, List, Dict, Any
 from datetime import datetime, date
 from decimal import Decimal
+from uuid import UUID
 
 
 class BaseSchema(BaseModel):
@@ -120,8 +121,49 @@ class ProductionBatchUpdate(BaseSchema):
     metadata: Optional[Dict[str, Any]] = None
 
 
+class BatchSelection(BaseSchema):
+    """Партии массовой операции: список id и условия фильтра, объединяемые через И"""
+    ids: Optional[List[int]] = None
+    status: Optional[str] = None
+    product_type_id: Optional[int] = None
+    production_date_from: Optional[date] = None
+    production_date_to: Optional[date] = None
+    furnace_number: Optional[str] = None
+
+
+class ProductionBatchBulkUpdate(BaseSchema):
+    selection: BatchSelection
+    status: Optional[str] = None
+    quality_rating: Optional[int] = None
+
+
+class ProductionBatchBulkDelete(BaseSchema):
+    selection: BatchSelection
+
+
+class BulkOperationResult(BaseSchema):
+    affected: int
+    ids: List[int]
+
+
+class BatchImportError(BaseSchema):
+    row: int
+    batch_number: Optional[str] = None
+    error: str
+
+
+class BatchImportReport(BaseSchema):
+    total: int
+    inserted: int
+    updated: int
+    unchanged: int
+    failed: int
+    errors: List[BatchImportError] = []
+
+
 class ProductionBatch(ProductionBatchBase):
     id: int
+    plant_code: Optional[str] = None
     created_by: Optional[int] = None
     created_at: datetime
     updated_at: datetime
@@ -155,6 +197,8 @@ class InspectionResultUpdate(BaseSchema):
 class InspectionResult(InspectionResultBase):
     id: int
     inspection_time: datetime
+    plant_code: Optional[str] = None
+    edge_id: Optional[str] = None
     is_defect_detected: bool = False
     defect_count: int = 0
     created_at: datetime
@@ -164,6 +208,365 @@ class InspectionResult(InspectionResultBase):
     batch: Optional[ProductionBatch] = None
 
 
+# DefectType schemas
+class DefectTypeBase(BaseSchema):
+    defect_code: str
+    defect_name: str
+    category: Optional[str] = None
+    severity_level: Optional[str] = None
+    description: Optional[str] = None
+    measurement_unit: Optional[str] = None
+    threshold_value: Optional[Decimal] = None
+
+
+class DefectTypeCreate(DefectTypeBase):
+    created_by: Optional[int] = None
+
+
+class DefectTypeUpdate(BaseSchema):
+    defect_name: Optional[str] = None
+    category: Optional[str] = None
+    severity_level: Optional[str] = None
+    description: Optional[str] = None
+    measurement_unit: Optional[str] = None
+    threshold_value: Optional[Decimal] = None
+
+
+class DefectType(DefectTypeBase):
+    id: int
+    created_by: Optional[int] = None
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+
+
+# InspectionPoint schemas
+class InspectionPoint(BaseSchema):
+    id: int
+    point_name: str
+    point_code: str
+    description: Optional[str] = None
+    equipment_type: Optional[str] = None
+    location_in_line: Optional[str] = None
+    coordinates: Optional[Dict[str, Any]] = None
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+
+
+# Batch detail schemas (/api/batches/{id}/full)
+class InspectionPointInfo(BaseSchema):
+    id: int
+    point_code: str
+    point_name: str
+    equipment_type: Optional[str] = None
+    location_in_line: Optional[str] = None
+
+
+class DefectTypeInfo(BaseSchema):
+    id: int
+    defect_code: str
+    defect_name: str
+    category: Optional[str] = None
+    severity_level: Optional[str] = None
+    measurement_unit: Optional[str] = None
+
+
+class BatchDefect(BaseSchema):
+    id: int
+    inspection_result_id: int
+    inspection_time: datetime
+    plant_code: Optional[str] = None
+    edge_id: Optional[str] = None
+    defect_type_id: int
+    defect_location: Optional[Dict[str, Any]] = None
+    severity: Optional[Decimal] = None
+    size_mm: Optional[Decimal] = None
+    image_path: Optional[str] = None
+    is_repaired: Optional[bool] = None
+    repair_method: Optional[str] = None
+    repair_date: Optional[datetime] = None
+    repair_notes: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    defect_type: Optional[DefectTypeInfo] = None
+
+
+class BatchInspection(InspectionResultBase):
+    id: int
+    inspection_time: datetime
+    is_defect_detected: bool = False
+    defect_count: int = 0
+    created_at: datetime
+    updated_at: datetime
+    inspection_point: Optional[InspectionPointInfo] = None
+    defect_details: List[BatchDefect] = []
+
+
+class ProductionBatchFull(ProductionBatch):
+    inspection_results: List[BatchInspection] = []
+
+
+# AnomalyAlert schemas
+class AnomalyAlert(BaseSchema):
+    id: int
+    inspection_result_id: int
+    inspection_point_id: Optional[int] = None
+    detectors: List[str]
+    flagged_count: int
+    details: Optional[Dict[str, Any]] = None
+    created_at: datetime
+
+
+# Analytics schemas
+class DefectHeatmap(BaseModel):
+    bins_x: int
+    bins_y: int
+    x_edges: List[float]
+    y_edges: List[float]
+    counts: List[List[int]]
+    total: int
+    max_count: int
+
+
+class DefectCluster(BaseModel):
+    cluster_id: int
+    defect_count: int
+    defect_ids: List[int]
+    defect_type_ids: List[int]
+    x_min: float
+    y_min: float
+    x_max: float
+    y_max: float
+    max_severity: Optional[float] = None
+    total_severity: Optional[float] = None
+    mean_severity: Optional[float] = None
+
+
+class DefectClusters(BaseModel):
+    link_distance_mm: float
+    defect_count: int
+    cluster_count: int
+    clusters: List[DefectCluster]
+
+
+class LineFlowTransition(BaseModel):
+    from_point_id: int
+    to_point_id: int
+    from_point_code: Optional[str] = None
+    to_point_code: Optional[str] = None
+    count: int
+    avg_seconds: Optional[float] = None
+    median_seconds: Optional[float] = None
+    p95_seconds: Optional[float] = None
+    max_seconds: Optional[float] = None
+
+
+class LineFlowPoint(BaseModel):
+    inspection_point_id: int
+    point_code: Optional[str] = None
+    inspections: int
+    throughput_per_hour: float
+    avg_wait_seconds: Optional[float] = None
+    bottleneck_rank: int
+
+
+class LineFlowStep(BaseModel):
+    batch_id: int
+    inspection_point_id: int
+    point_code: Optional[str] = None
+    inspection_time: datetime
+    from_point_id: Optional[int] = None
+    dwell_seconds: Optional[float] = None
+
+
+class LineFlow(BaseModel):
+    time_from: datetime
+    time_to: datetime
+    batch_id: Optional[int] = None
+    transitions: List[LineFlowTransition]
+    points: List[LineFlowPoint]
+    batch_steps: Optional[List[LineFlowStep]] = None
+
+
+class PlantStatistics(BaseModel):
+    plant_code: str
+    batches: int
+    batches_by_status: Dict[str, int]
+    inspections: int
+    inspections_with_defects: int
+    nonconforming_inspections: int
+    defects: int
+    defect_rate: float  # доля результатов контроля с дефектами
+
+
+class PlantStatisticsReport(BaseModel):
+    time_from: Optional[datetime] = None
+    time_to: Optional[datetime] = None
+    plants: List[PlantStatistics]
+    # Сумма по выбранным заводам (plant_code = "all")
+    total: PlantStatistics
+
+
+# Similar-batch search schemas
+class SimilarBatch(BaseModel):
+    batch_id: int
+    # Евклидово расстояние между нормированными профилями измерений; меньше - ближе
+    distance: float
+    batch_number: str
+    product_type_id: Optional[int] = None
+    furnace_number: Optional[str] = None
+    production_date: Optional[date] = None
+    status: Optional[str] = None
+    quality_rating: Optional[int] = None
+
+
+class SimilarBatches(BaseModel):
+    batch_id: int
+    indexed_batches: int
+    features: int
+    dimensions: int
+    results: List[SimilarBatch]
+
+
+class SimilarityIndexStats(BaseModel):
+    plant_code: str
+    ready: bool
+    batches: int
+    features: int
+    dimensions: int
+    memory_bytes: int
+    built_at: Optional[datetime] = None
+    watermark: Optional[datetime] = None
+
+
+# Job schemas
+class JobCreate(BaseModel):
+    job_type: str
+    params: Dict[str, Any] = {}
+    priority: int = 0
+
+
+class Job(BaseSchema):
+    id: int
+    job_type: str
+    params: Optional[Dict[str, Any]] = None
+    priority: int
+    status: str
+    progress: float
+    message: Optional[str] = None
+    error: Optional[str] = None
+    cancel_requested: bool = False
+    result_content_type: Optional[str] = None
+    created_by: Optional[int] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+
+# Sync schemas
+class DeletedRecord(BaseSchema):
+    id: int
+    entity_id: int
+    reason: str
+    deleted_at: datetime
+
+
+# Audit schemas
+class AuditEntry(BaseSchema):
+    id: Optional[int] = None
+    entity: str
+    entity_id: int
+    action: str
+    # {"колонка": {"old": ..., "new": ...}}; у удаления только old
+    changes: Dict[str, Any]
+    actor_id: Optional[int] = None
+    actor: Optional[str] = None
+    trace_id: Optional[str] = None
+    plant_code: Optional[str] = None
+    changed_at: datetime
+
+
+# Maintenance schemas
+class Partition(BaseModel):
+    parent_table: str
+    partition_name: str
+    bounds: str
+
+
+class WorkloadClassMetrics(BaseModel):
+    name: str
+    concurrency: int
+    in_flight: int
+    waiting: int
+    max_queue: int
+    admitted: int
+    rejected: int
+    avg_wait_ms: float
+    max_wait_ms: float
+    db_pool_size: int
+    db_checked_out: int
+    db_overflow: int
+
+
+# Edge schemas (line-side store-and-forward)
+# Ограничения полей повторяют ограничения центральной базы: запись, принятая узлом,
+# не должна быть отклонена при пересылке
+class EdgeDefectCreate(BaseSchema):
+    edge_id: Optional[UUID] = None
+    defect_type_id: int
+    defect_location: Optional[Dict[str, Any]] = None
+    severity: Optional[Decimal] = Field(None, ge=0, le=10)
+    size_mm: Optional[Decimal] = Field(None, gt=-10**8, lt=10**8)
+    image_path: Optional[str] = Field(None, max_length=500)
+
+
+class EdgeInspectionCreate(InspectionResultCreate):
+    # UUID от клиента: повторная отправка того же результата не создает дубль
+    edge_id: Optional[UUID] = None
+    inspection_time: Optional[datetime] = None
+    inspector_name: Optional[str] = Field(None, max_length=200)
+    overall_verdict: str = Field("соответствует", max_length=50)
+    status: str = Field("обработка", max_length=50)
+    defects: List[EdgeDefectCreate] = []
+
+
+class EdgeInspection(BaseSchema):
+    id: int
+    edge_id: str
+    inspection_time: datetime
+    batch_id: int
+    defect_count: int
+
+
+class EdgeRejected(BaseSchema):
+    edge_id: str
+    reason: str
+    payload: Dict[str, Any]
+    rejected_at: datetime
+
+
+class EdgeRequeued(BaseModel):
+    requeued: int
+
+
+class EdgeStatus(BaseModel):
+    plant_code: str
+    connected: bool
+    backlog: int
+    oldest_pending_at: Optional[datetime] = None
+    forwarded: int
+    rejected: int
+    failures: int
+    last_forward_at: Optional[datetime] = None
+    last_error: Optional[str] = None
+    # Результатов в секунду за окно EDGE_RATE_WINDOW: записано на узле, переслано,
+    # и скорость пересылки за время самих пересылок (с какой скоростью разбирается накопленная очередь)
+    record_rate: float
+    drain_rate: float
+    forward_throughput: float
+    # Оценка времени до опустошения очереди при текущих скоростях; None - очередь не убывает
+    drain_eta_seconds: Optional[float] = None
+
+
 # Token and Authentication schemas
 class Token(BaseModel):
     access_token: str
@@ -0,0 +1,582 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from . import archive, models, sync, tracing
+from .config import settings
+from .database import DEFAULT_PLANT, shards, plant_of
+
+logger = logging.getLogger(__name__)
+
+# Статистики значений показателя в точке контроля: столбцы вектора признаков на каждую пару
+STATS = ("mean", "std") + tuple(f"p{percentile:g}" for percentile in settings.SIMILARITY_PERCENTILES)
+
+# Результаты без точки контроля собираются под этим номером
+NO_POINT = 0
+
+# Регуляризация проекции неполного профиля: компоненты, которые не по чему оценить, стремятся к среднему
+RIDGE = 0.1
+
+ProfileKey = Tuple[int, str]
+
+# Поля найденных партий в ответе: по ним ищется общая причина (печь, дата, статус)
+BATCH_COLUMNS = ("batch_number", "product_type_id", "furnace_number", "production_date", "status", "quality_rating")
+
+
+class IndexNotReady(Exception):
+    """Индекс завода еще строится"""
+
+
+def _numbers(value: Any) -> List[float]:
+    # Скаляры и массивы показаний (sensor_readings); bool в JSON - не измерение
+    if isinstance(value, bool):
+        return []
+    if isinstance(value, (int, float)):
+        return [float(value)]
+    if isinstance(value, list):
+        return [float(item) for item in value if isinstance(item, (int, float)) and not isinstance(item, bool)]
+    return []
+
+
+def profile(inspections: Iterable[Tuple[Optional[int], Optional[Dict[str, Any]]]]) -> Dict[ProfileKey, np.ndarray]:
+    """Профиль партии по ее результатам контроля: (точка, показатель) -> mean, std, перцентили"""
+    values: Dict[ProfileKey, List[float]] = {}
+    for point_id, data in inspections:
+        for metric, value in (data or {}).items():
+            numbers = _numbers(value)
+            if numbers:
+                values.setdefault((point_id or NO_POINT, metric), []).extend(numbers)
+
+    result = {}
+    for key, numbers in values.items():
+        array = np.asarray(numbers, dtype=np.float64)
+        array = array[np.isfinite(array)]
+        if array.size:
+            result[key] = np.concatenate(([array.mean(), array.std()], np.percentile(array, settings.SIMILARITY_PERCENTILES)))
+    return result
+
+
+def _profiles(db: Session, batch_ids: Optional[List[int]] = None) -> Iterable[Tuple[int, Dict[ProfileKey, np.ndarray]]]:
+    """Профили партий потоком, без загрузки всех результатов контроля в память"""
+    ir = models.InspectionResult
+    stmt = select(ir.batch_id, ir.inspection_point_id, ir.measurement_data).order_by(ir.batch_id)
+    if batch_ids is not None:
+        stmt = stmt.where(ir.batch_id.in_(batch_ids))
+    rows = db.execute(stmt.execution_options(yield_per=settings.SIMILARITY_BUILD_CHUNK_SIZE))
+    for batch_id, group in groupby(rows, key=lambda row: row.batch_id):
+        yield batch_id, profile((row.inspection_point_id, row.measurement_data) for row in group)
+
+
+def _archived_profiles() -> Iterable[Tuple[int, Dict[ProfileKey, np.ndarray]]]:
+    """Профили партий из холодного архива (ведется только для DEFAULT_PLANT)"""
+    rows = archive.iter_archived("inspection_results", ["batch_id", "inspection_point_id", "measurement_data"])
+    for batch_id, group in groupby(rows, key=lambda row: row["batch_id"]):
+        yield batch_id, profile((row["inspection_point_id"], row["measurement_data"]) for row in group)
+
+
+def _horizon(db: Session) -> datetime:
+    # Граница инкрементальной синхронизации: строки новее ждут следующего прохода,
+    # чтобы не пропустить еще не закоммиченные транзакции
+    return sync.horizon(db)
+
+
+class FeatureSpace:
+    """Раскладка профиля в вектор: столбцы пар (точка, показатель), нормировка и проекция PCA.
+
+    Фиксируется при полной перестройке индекса; пары, появившиеся позже, учитываются
+    со следующей перестройки.
+    """
+
+    def __init__(self, keys: List[ProfileKey], mean: np.ndarray, scale: np.ndarray, components: Optional[np.ndarray]):
+        self.keys = keys
+        self.slots = {key: slot for slot, key in enumerate(keys)}
+        self.mean = mean
+        self.scale = scale
+        self.components = components
+
+    @property
+    def features(self) -> int:
+        return len(self.keys) * len(STATS)
+
+    @property
+    def dimensions(self) -> int:
+        return self.components.shape[1] if self.components is not None else self.features
+
+    def raw(self, profiles: Dict[ProfileKey, np.ndarray]) -> np.ndarray:
+        row = np.full(self.features, np.nan, dtype=np.float32)
+        for key, stats in profiles.items():
+            slot = self.slots.get(key)
+            if slot is not None:
+                row[slot * len(STATS):(slot + 1) * len(STATS)] = stats
+        return row
+
+    def project(self, raw: np.ndarray) -> np.ndarray:
+        """Векторы индекса для строк сырых признаков (NaN - признака нет).
+
+        Без PCA отсутствующий признак равен среднему по партиям (0 после нормировки). С PCA
+        координаты неполного профиля оцениваются гребневой регрессией только по имеющимся
+        признакам: партию, проверенную не во всех точках, не тянет к "средней" партии.
+        """
+        rows = np.atleast_2d(raw)
+        present = np.isfinite(rows)
+        z = np.where(present, (rows - self.mean) / self.scale, 0.0).astype(np.float32)
+        if self.components is None:
+            return z if raw.ndim == 2 else z[0]
+
+        vectors = z @ self.components
+        partial = np.flatnonzero(~present.all(axis=1))
+        if partial.size:
+            # Строки с одинаковым набором признаков решаются одной системой
+            patterns, inverse = np.unique(present[partial], axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            identity = np.eye(self.components.shape[1], dtype=np.float32)
+            for number, pattern in enumerate(patterns):
+                basis = self.components[pattern]
+                solver = np.linalg.solve(basis.T @ basis + RIDGE * identity, basis.T)
+                members = partial[inverse == number]
+                vectors[members] = z[np.ix_(members, pattern)] @ solver.T
+        return vectors if raw.ndim == 2 else vectors[0]
+
+    def vector(self, profiles: Dict[ProfileKey, np.ndarray]) -> Optional[np.ndarray]:
+        raw = self.raw(profiles)
+        if np.isnan(raw).all():
+            return None
+        return self.project(raw)
+
+    @classmethod
+    def fit(cls, keys: List[ProfileKey], raw: np.ndarray) -> Tuple["FeatureSpace", np.ndarray]:
+        """Нормировка по столбцам и PCA по выборке строк; возвращает пространство и векторы всех строк"""
+        with np.errstate(all="ignore"):
+            mean = np.nanmean(raw, axis=0)
+            std = np.nanstd(raw, axis=0)
+        mean = np.nan_to_num(mean).astype(np.float32)
+        scale = np.where(np.isfinite(std) & (std > 0), std, 1.0).astype(np.float32)
+        space = cls(keys, mean, scale, None)
+        if raw.shape[1] > settings.SIMILARITY_DIMENSIONS and len(raw) > 1:
+            sample = raw
+            if len(raw) > settings.SIMILARITY_PCA_SAMPLE:
+                sample = raw[np.random.default_rng(0).choice(len(raw), settings.SIMILARITY_PCA_SAMPLE, replace=False)]
+            z = space.project(sample)
+            _, _, vt = np.linalg.svd(z - z.mean(axis=0), full_matrices=False)
+            space.components = np.ascontiguousarray(vt[:settings.SIMILARITY_DIMENSIONS].T, dtype=np.float32)
+        return space, np.ascontiguousarray(space.project(raw), dtype=np.float32)
+
+
+class _RawBuilder:
+    """Матрица сырых признаков при полной перестройке: строки и столбцы добавляются по мере чтения"""
+
+    def __init__(self):
+        self.keys: List[ProfileKey] = []
+        self.slots: Dict[ProfileKey, int] = {}
+        self.ids: List[int] = []
+        self.matrix = np.full((1024, 16 * len(STATS)), np.nan, dtype=np.float32)
+
+    def add(self, batch_id: int, profiles: Dict[ProfileKey, np.ndarray]) -> None:
+        if not profiles:
+            return
+        for key in profiles:
+            if key not in self.slots:
+                self.slots[key] = len(self.keys)
+                self.keys.append(key)
+        rows, columns = self.matrix.shape
+        needed = len(self.keys) * len(STATS)
+        if len(self.ids) == rows or needed > columns:
+            grown = np.full((rows * 2 if len(self.ids) == rows else rows, max(columns, needed * 2)), np.nan, dtype=np.float32)
+            grown[:rows, :columns] = self.matrix
+            self.matrix = grown
+        row = self.matrix[len(self.ids)]
+        for key, stats in profiles.items():
+            slot = self.slots[key]
+            row[slot * len(STATS):(slot + 1) * len(STATS)] = stats
+        self.ids.append(batch_id)
+
+    def result(self) -> np.ndarray:
+        return self.matrix[:len(self.ids), :len(self.keys) * len(STATS)]
+
+
+class _Snapshot:
+    """Опубликованное состояние индекса: массивы после публикации не меняются.
+
+    Запрос строит вектор и ищет по одному снимку, поэтому обновление индекса во время
+    поиска не подменяет id найденных строк и не меняет размерность.
+    """
+
+    def __init__(self, space: FeatureSpace, ids: np.ndarray, vectors: np.ndarray, product_types: np.ndarray):
+        self.space = space
+        self.ids = ids
+        self.vectors = vectors
+        self.norms = np.einsum("ij,ij->i", vectors, vectors)
+        self.product_types = product_types
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self.vectors.nbytes + self.ids.nbytes + self.norms.nbytes + self.product_types.nbytes
+
+    def updated(self, removed: Iterable[int], updates: List[Tuple[int, np.ndarray, int]]) -> "_Snapshot":
+        """Новый снимок: строки removed и обновляемых партий убираются, обновления дописываются в конец"""
+        replaced = set(removed) | {batch_id for batch_id, _, _ in updates}
+        keep = ~np.isin(self.ids, np.fromiter(replaced, dtype=np.int64, count=len(replaced)))
+        ids = np.asarray([batch_id for batch_id, _, _ in updates], dtype=np.int64)
+        vectors = np.asarray([vector for _, vector, _ in updates], dtype=np.float32).reshape(len(updates), self.space.dimensions)
+        types = np.asarray([type_id for _, _, type_id in updates], dtype=np.int32)
+        return _Snapshot(
+            self.space,
+            np.concatenate((self.ids[keep], ids)),
+            np.concatenate((self.vectors[keep], vectors)),
+            np.concatenate((self.product_types[keep], types))
+        )
+
+    def query(self, db: Session, batch_id: int) -> Optional[Tuple[np.ndarray, Optional[np.ndarray]]]:
+        """Запрос поиска по профилю партии из базы: (вектор, маска имеющихся признаков).
+
+        Маска None - профиль полный. Для неполного профиля (партия проверена не во всех
+        точках) расстояние считается только по имеющимся признакам.
+        """
+        profiles = dict(_profiles(db, [batch_id])).get(batch_id)
+        if not profiles and plant_of(db) == DEFAULT_PLANT:
+            # Партия могла быть перенесена в архив
+            rows = archive.get_archived_inspections(db, limit=settings.SIMILARITY_BUILD_CHUNK_SIZE, batch_id=batch_id)
+            profiles = profile((row["inspection_point_id"], row["measurement_data"]) for row in rows)
+        raw = self.space.raw(profiles or {})
+        present = np.isfinite(raw)
+        if not present.any():
+            return None
+        if present.all():
+            return self.space.project(raw), None
+        return ((raw[present] - self.space.mean[present]) / self.space.scale[present]).astype(np.float32), present
+
+    def search(
+        self,
+        vector: np.ndarray,
+        k: int,
+        exclude: Optional[int] = None,
+        product_type_id: Optional[int] = None,
+        present: Optional[np.ndarray] = None
+    ) -> List[Tuple[int, float]]:
+        """k ближайших партий: (batch_id, расстояние) по возрастанию расстояния.
+
+        С маской present vector - нормированные имеющиеся признаки; векторы индекса
+        восстанавливаются в этих признаках через базис PCA.
+        """
+        if self.size == 0:
+            return []
+        vectors = self.vectors
+        if present is None:
+            distances = self.norms - 2.0 * (vectors @ vector) + vector @ vector
+        else:
+            # |X B^T - q|^2 = x^T (B^T B) x - 2 x (B^T q) + q q, B - строки базиса имеющихся признаков
+            components = self.space.components
+            basis = components[present] if components is not None else np.eye(len(present), dtype=np.float32)[present]
+            distances = np.einsum("ij,ij->i", vectors @ (basis.T @ basis), vectors) - 2.0 * (vectors @ (basis.T @ vector)) + vector @ vector
+        if exclude is not None:
+            distances[self.ids == exclude] = np.inf
+        if product_type_id is not None:
+            distances[self.product_types != product_type_id] = np.inf
+        k = min(k, self.size)
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top], kind="stable")]
+        return [
+            (int(self.ids[row]), float(np.sqrt(max(distances[row], 0.0))))
+            for row in top
+            if np.isfinite(distances[row])
+        ]
+
+
+class SimilarityIndex:
+    """Индекс профилей партий одного завода: матрица float32 (партии x измерения) в памяти.
+
+    Поиск - точный: квадраты расстояний до всех партий одним умножением матрицы на вектор
+    (|x|^2 заранее посчитаны), k ближайших - argpartition. Обновление по результатам контроля,
+    измененным после watermark, публикует новый снимок; поиск идет по снимку без блокировок.
+    """
+
+    def __init__(self, plant: str):
+        self.plant = plant
+        self.snapshot: Optional[_Snapshot] = None
+        self.watermark: Optional[datetime] = None
+        self.built_at: Optional[datetime] = None
+        self.dirty = False
+        self.rebuild_requested = False
+
+    @property
+    def ready(self) -> bool:
+        return self.snapshot is not None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(settings.SIMILARITY_DIR, f"{self.plant}.npz")
+
+    def build(self, db: Session) -> None:
+        """Полная перестройка: профили всех партий, новая нормировка и PCA"""
+        started = time.monotonic()
+        horizon = _horizon(db)
+        builder = _RawBuilder()
+        for batch_id, profiles in _profiles(db):
+            builder.add(batch_id, profiles)
+        product_types = dict(db.execute(select(models.ProductionBatch.id, models.ProductionBatch.product_type_id)).all())
+        if self.plant == DEFAULT_PLANT:
+            # Архивные партии тоже ищутся: их данные не меняются, поэтому читаются только при перестройке.
+            # Партии, оставшиеся в БД после сбоя архивирования, уже прочитаны из БД
+            live = set(builder.ids)
+            for batch_id, profiles in _archived_profiles():
+                if batch_id not in live:
+                    builder.add(batch_id, profiles)
+            for row in archive.iter_archived("production_batches", ["id", "product_type_id"]):
+                product_types.setdefault(row["id"], row["product_type_id"])
+        if not builder.ids:
+            # Пустое пространство признаков не отличит ни одной партии: индекс остается неготовым (503),
+            # построение повторяется на следующем проходе
+            logger.info("No measurements for similarity index of plant %s yet", self.plant)
+            return
+
+        ids = np.asarray(builder.ids, dtype=np.int64)
+        space, vectors = FeatureSpace.fit(builder.keys, builder.result())
+        types = np.asarray([product_types.get(batch_id) or 0 for batch_id in builder.ids], dtype=np.int32)
+        self.snapshot = _Snapshot(space, ids, vectors, types)
+        self.watermark = horizon
+        self.built_at = datetime.now(timezone.utc)
+        self.rebuild_requested = False
+        self.dirty = True
+        logger.info(
+            "Built similarity index of plant %s: %s batches, %s features -> %s dimensions in %.1fs",
+            self.plant, len(ids), space.features, space.dimensions, time.monotonic() - started
+        )
+
+    def refresh(self, db: Session) -> int:
+        """Пересчитывает профили партий, результаты контроля которых изменились после watermark"""
+        horizon = _horizon(db)
+        snapshot = self.snapshot
+        ir, batch = models.InspectionResult, models.ProductionBatch
+        changed = set(db.scalars(
+            select(ir.batch_id).where(ir.updated_at >= self.watermark, ir.updated_at < horizon).distinct()
+        ))
+        # Смена вида продукции меняет только фильтр; профиль пересчитывается вместе с остальными
+        changed.update(db.scalars(select(batch.id).where(batch.updated_at >= self.watermark, batch.updated_at < horizon)))
+        # Удаленные и перенесенные в другую партию результаты контроля
+        changes = models.BatchProfileChange
+        changed.update(db.scalars(
+            select(changes.batch_id).where(changes.changed_at >= self.watermark, changes.changed_at < horizon).distinct()
+        ))
+        tombstones = db.execute(
+            select(models.DeletedRecord.entity_id, models.DeletedRecord.reason).where(
+                models.DeletedRecord.entity == batch.__tablename__,
+                models.DeletedRecord.deleted_at >= self.watermark
+            )
+        ).all()
+        # Архивированные партии остаются в индексе с прежним профилем
+        deleted = {batch_id for batch_id, reason in tombstones if reason != archive.ARCHIVED_REASON}
+        changed -= {batch_id for batch_id, _ in tombstones}
+
+        updates = []
+        removed = set(deleted)
+        ordered = sorted(changed)
+        for start in range(0, len(ordered), settings.SIMILARITY_BUILD_CHUNK_SIZE):
+            chunk = ordered[start:start + settings.SIMILARITY_BUILD_CHUNK_SIZE]
+            product_types = dict(db.execute(select(batch.id, batch.product_type_id).where(batch.id.in_(chunk))).all())
+            profiles = dict(_profiles(db, chunk))
+            for batch_id in chunk:
+                vector = snapshot.space.vector(profiles.get(batch_id, {}))
+                # Без измерений (или все результаты удалены) партия из индекса убирается
+                if vector is None:
+                    removed.add(batch_id)
+                else:
+                    updates.append((batch_id, vector, product_types.get(batch_id) or 0))
+
+        if updates or removed:
+            self.snapshot = snapshot.updated(removed, updates)
+            self.dirty = True
+        self.watermark = horizon
+        return len(updates) + len(removed)
+
+    def save(self) -> None:
+        """Снимок индекса в .npz (запись во временный файл и rename); при запуске догружается с watermark"""
+        snapshot = self.snapshot
+        if snapshot is None:
+            return
+        space = snapshot.space
+        arrays = {
+            "ids": snapshot.ids,
+            "vectors": snapshot.vectors,
+            "product_types": snapshot.product_types,
+            "mean": space.mean,
+            "scale": space.scale,
+            "components": space.components if space.components is not None else np.zeros((0, 0), dtype=np.float32),
+            "key_points": np.asarray([point for point, _ in space.keys], dtype=np.int64),
+            "key_metrics": np.asarray([metric for _, metric in space.keys], dtype=str),
+            "stats": np.asarray(STATS, dtype=str),
+            "watermark": np.asarray(self.watermark.isoformat()),
+            "built_at": np.asarray(self.built_at.isoformat()),
+        }
+        self.dirty = False
+        os.makedirs(settings.SIMILARITY_DIR, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, self.path)
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                # Другой набор статистик - снимок несовместим, нужна перестройка
+                if tuple(data["stats"]) != STATS:
+                    return False
+                components = data["components"] if data["components"].size else None
+                keys = list(zip(data["key_points"].tolist(), data["key_metrics"].tolist()))
+                space = FeatureSpace(keys, data["mean"], data["scale"], components)
+                if space.dimensions != data["vectors"].shape[1]:
+                    return False
+                self.snapshot = _Snapshot(space, data["ids"], np.ascontiguousarray(data["vectors"]), data["product_types"])
+                self.watermark = datetime.fromisoformat(str(data["watermark"]))
+                self.built_at = datetime.fromisoformat(str(data["built_at"]))
+        except (OSError, KeyError, ValueError):
+            logger.exception("Could not load similarity index %s, rebuilding", self.path)
+            return False
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self.snapshot
+        return {
+            "plant_code": self.plant,
+            "ready": snapshot is not None,
+            "batches": snapshot.size if snapshot else 0,
+            "features": snapshot.space.features if snapshot else 0,
+            "dimensions": snapshot.space.dimensions if snapshot else 0,
+            "memory_bytes": snapshot.memory_bytes if snapshot else 0,
+            "built_at": self.built_at,
+            "watermark": self.watermark,
+        }
+
+
+indexes: Dict[str, SimilarityIndex] = {plant: SimilarityIndex(plant) for plant in shards.plants}
+
+_stop_event = threading.Event()
+_wake = threading.Event()
+_thread = None
+
+
+def find_similar(
+    db: Session,
+    batch_id: int,
+    k: int = 10,
+    product_type_id: Optional[int] = None
+) -> Optional[Dict[str, Any]]:
+    """Партии завода с ближайшими профилями измерений; None - у партии нет измерений"""
+    index = indexes[plant_of(db)]
+    snapshot = index.snapshot
+    if snapshot is None:
+        raise IndexNotReady()
+    query = snapshot.query(db, batch_id)
+    if query is None:
+        return None
+    vector, present = query
+    hits = snapshot.search(vector, k, exclude=batch_id, product_type_id=product_type_id, present=present)
+
+    batch = models.ProductionBatch
+    details = {
+        row.id: row._mapping
+        for row in db.execute(
+            select(batch.id, *(batch.__table__.c[column] for column in BATCH_COLUMNS))
+            .where(batch.id.in_([hit_id for hit_id, _ in hits]))
+        )
+    }
+    results = []
+    for hit_id, distance in hits:
+        row = details.get(hit_id)
+        if row is None:
+            row = archive.get_archived_batch(db, hit_id)
+        # Партия могла быть удалена после последнего обновления индекса
+        if row is not None:
+            results.append({"batch_id": hit_id, "distance": round(distance, 6), **{column: row[column] for column in BATCH_COLUMNS}})
+    return {
+        "batch_id": batch_id,
+        "indexed_batches": snapshot.size,
+        "features": snapshot.space.features,
+        "dimensions": snapshot.space.dimensions,
+        "results": results,
+    }
+
+
+def purge_profile_changes(db: Session) -> int:
+    # Индекс с watermark старше интервала перестройки все равно строится заново
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=2 * settings.SIMILARITY_REBUILD_INTERVAL)
+    result = db.execute(delete(models.BatchProfileChange).where(models.BatchProfileChange.changed_at < cutoff))
+    db.commit()
+    return result.rowcount
+
+
+def request_rebuild(plant: str) -> None:
+    indexes[plant].rebuild_requested = True
+    _wake.set()
+
+
+def _rebuild_due(index: SimilarityIndex) -> bool:
+    return index.rebuild_requested or (
+        index.built_at is not None
+        and datetime.now(timezone.utc) - index.built_at > timedelta(seconds=settings.SIMILARITY_REBUILD_INTERVAL)
+    )
+
+
+def _maintain(index: SimilarityIndex) -> None:
+    db = shards.session(index.plant, "reporting")
+    try:
+        if (not index.ready and not index.load()) or _rebuild_due(index):
+            index.build(db)
+            # Снимок - после перестройки и при остановке; изменения после снимка догружаются с watermark
+            index.save()
+        else:
+            index.refresh(db)
+    except Exception:
+        logger.exception("Similarity index maintenance failed for plant %s", index.plant)
+        db.rollback()
+    finally:
+        db.close()
+
+
+def _indexing_loop() -> None:
+    while not _stop_event.is_set():
+        for index in indexes.values():
+            if _stop_event.is_set():
+                break
+            _maintain(index)
+        _wake.wait(settings.SIMILARITY_REFRESH_INTERVAL)
+        _wake.clear()
+
+
+def start_indexing() -> None:
+    """Запускает фоновое построение и обновление индексов похожих партий"""
+    global _thread
+    if not settings.SIMILARITY_ENABLED or (_thread is not None and _thread.is_alive()):
+        return
+    _stop_event.clear()
+    _thread = threading.Thread(target=_indexing_loop, name="similarity-index", daemon=True)
+    _thread.start()
+
+
+def stop_indexing() -> None:
+    _stop_event.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join()
+    for index in indexes.values():
+        if index.dirty:
+            try:
+                index.save()
+            except OSError:
+                logger.exception("Could not save similarity index of plant %s", index.plant)
+
+
+tracing.instrument_module(globals(), "similarity")
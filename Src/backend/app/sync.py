@@ -0,0 +1,116 @@
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any
+
+from sqlalchemy import delete, text, tuple_
+from sqlalchemy.orm import Session
+
+from . import models, schemas, fieldsets
+from .config import settings
+from .utils import as_utc
+
+# Синхронизируемые сущности (имена ресурсов fieldsets)
+ENTITIES = ("product_types", "defect_types", "inspection_points", "batches", "inspections", "defects")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class ResyncRequired(Exception):
+    """Записи об удалении за запрошенный период уже очищены - нужна полная синхронизация"""
+
+
+def encode_cursor(position: Dict[str, Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return {
+            "u": [as_utc(datetime.fromisoformat(position["u"][0])), int(position["u"][1])],
+            "d": [as_utc(datetime.fromisoformat(position["d"][0])), int(position["d"][1])],
+        }
+    except (ValueError, KeyError, IndexError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+def horizon(db: Session) -> datetime:
+    """Граница выдачи изменений: строки новее нее еще могут появиться.
+
+    updated_at и deleted_at ставит CURRENT_TIMESTAMP - время начала транзакции, поэтому долгая
+    транзакция (импорт, массовое изменение) коммитит строки со временем в прошлом. Граница не позже
+    начала самой старой открытой транзакции базы и отстает от now() на SYNC_SAFETY_LAG.
+    """
+    now, oldest = db.execute(text(
+        "SELECT now(), (SELECT min(xact_start) FROM pg_stat_activity "
+        "WHERE datname = current_database() AND backend_type = 'client backend' AND pid <> pg_backend_pid())"
+    )).one()
+    bound = as_utc(now) - timedelta(seconds=settings.SYNC_SAFETY_LAG)
+    return min(bound, as_utc(oldest)) if oldest is not None else bound
+
+
+def changes(
+    db: Session,
+    entity: str,
+    updated_since: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = settings.SYNC_PAGE_SIZE
+) -> Dict[str, Any]:
+    """Страница изменений сущности в порядке (updated_at, id) и записи об удалениях.
+
+    Курсор хранит позиции в обоих потоках; его же клиент передает при следующем опросе.
+    Без updated_since и курсора отдаются все строки, а удаления - только начиная с этого момента.
+    """
+    resource = fieldsets.RESOURCES[entity]
+    model = resource.model
+    upper = horizon(db)
+
+    if cursor:
+        position = decode_cursor(cursor)
+    elif updated_since:
+        since = as_utc(updated_since)
+        position = {"u": [since, 0], "d": [since, 0]}
+    else:
+        position = {"u": [EPOCH, 0], "d": [upper, 0]}
+
+    retention_start = upper - timedelta(days=settings.SYNC_TOMBSTONE_RETENTION_DAYS)
+    if position["d"][0] < retention_start:
+        raise ResyncRequired()
+
+    projection = fieldsets.parse(entity, "", "")
+    rows = projection.fetch(
+        db,
+        [tuple_(model.updated_at, model.id) > tuple_(*position["u"]), model.updated_at < upper],
+        limit=limit,
+        order_by=[model.updated_at, model.id]
+    )
+
+    deleted = db.query(models.DeletedRecord).filter(
+        models.DeletedRecord.entity == model.__tablename__,
+        tuple_(models.DeletedRecord.deleted_at, models.DeletedRecord.id) > tuple_(*position["d"]),
+        models.DeletedRecord.deleted_at < upper
+    ).order_by(models.DeletedRecord.deleted_at, models.DeletedRecord.id).limit(limit).all()
+
+    if rows:
+        position["u"] = [rows[-1]["updated_at"], rows[-1]["id"]]
+    if deleted:
+        position["d"] = [deleted[-1].deleted_at, deleted[-1].id]
+
+    return {
+        "entity": entity,
+        "items": projection.dump(rows),
+        "deleted": [schemas.DeletedRecord.model_validate(record).model_dump(mode="json") for record in deleted],
+        "next_cursor": encode_cursor({
+            "u": [position["u"][0].isoformat(), position["u"][1]],
+            "d": [position["d"][0].isoformat(), position["d"][1]],
+        }),
+        "has_more": len(rows) == limit or len(deleted) == limit,
+    }
+
+
+def purge_deleted_records(db: Session, older_than_days: int = settings.SYNC_TOMBSTONE_RETENTION_DAYS) -> int:
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    result = db.execute(delete(models.DeletedRecord).where(models.DeletedRecord.deleted_at < cutoff))
+    db.commit()
+    return result.rowcount
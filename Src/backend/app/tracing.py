@@ -0,0 +1,413 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import Request
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+
+from .config import settings
+from .database import shards
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT = b"traceparent"
+# W3C Trace Context: версия-trace_id-parent_id-флаги
+_TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$")
+_SAMPLED = 0x01
+
+
+def _span_id() -> str:
+    return os.urandom(8).hex()
+
+
+class Span:
+    """Интервал работы внутри трассы; по завершении передается экспортеру"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        attributes: Optional[Dict[str, Any]] = None,
+        start: Optional[int] = None
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _span_id()
+        self.parent_id = parent_id
+        self.start = start or time.time_ns()
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    def child(self, name: str, attributes: Optional[Dict[str, Any]] = None, start: Optional[int] = None) -> "Span":
+        return Span(name, self.trace_id, self.span_id, attributes, start)
+
+    def fail(self, exc: BaseException) -> None:
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    def finish(self) -> None:
+        self.end = time.time_ns()
+        exporter.export(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "start_time_unix_nano": self.start,
+            "end_time_unix_nano": self.end,
+            "duration_ms": round((self.end - self.start) / 1e6, 3),
+            "attributes": self.attributes,
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+        }
+
+
+# Текущий спан; только у запросов, попавших в выборку (копируется и в пул потоков)
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("trace_span", default=None)
+# Момент завершения обработчика маршрута: с него начинается сериализация ответа
+_endpoint_end: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar("trace_endpoint_end", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.fail(e)
+        raise
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+def traced(name: Optional[str] = None):
+    """Декоратор: вызов функции - спан в трассе текущего запроса.
+
+    Вне выборки функция вызывается напрямую после одной проверки contextvar.
+    """
+    def decorate(func):
+        span_name = name or f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if _current.get() is None:
+                    return await func(*args, **kwargs)
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+def instrument_module(namespace: Dict[str, Any], prefix: str) -> None:
+    """Оборачивает в спаны публичные функции, определенные в модуле"""
+    module = namespace["__name__"]
+    for name, value in list(namespace.items()):
+        if inspect.isfunction(value) and value.__module__ == module and not name.startswith("_"):
+            namespace[name] = traced(f"{prefix}.{name}")(value)
+
+
+def parse_traceparent(value: str) -> Optional[Tuple[str, str, bool]]:
+    """(trace_id, parent_id, sampled) из заголовка traceparent; None, если заголовок некорректен"""
+    match = _TRACEPARENT.match(value.strip().lower())
+    if match is None:
+        return None
+    version, trace_id, parent_id, flags, rest = match.groups()
+    # Версия ff запрещена, нулевые идентификаторы недействительны; у версии 00 нет продолжения
+    if version == "ff" or (version == "00" and rest) or trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & _SAMPLED)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    parent = _current.get()
+    if parent is not None and context is not None:
+        context.trace_span = parent.child("sql", {
+            "db.statement": statement[:settings.TRACING_MAX_STATEMENT_LENGTH],
+            "db.executemany": executemany,
+            "db.plant": context.execution_options.get("plant"),
+        })
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    sql_span = getattr(context, "trace_span", None)
+    if sql_span is not None:
+        sql_span.attributes["db.rows"] = cursor.rowcount
+        sql_span.finish()
+        context.trace_span = None
+
+
+def _handle_error(exception_context):
+    sql_span = getattr(exception_context.execution_context, "trace_span", None)
+    if sql_span is not None:
+        sql_span.fail(exception_context.original_exception)
+        sql_span.finish()
+        exception_context.execution_context.trace_span = None
+
+
+if settings.TRACING_ENABLED:
+    for _engine in shards.all_engines():
+        event.listen(_engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(_engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(_engine, "handle_error", _handle_error)
+
+
+class SpanExporter:
+    """Пакетная выгрузка завершенных спанов в файл JSON Lines или HTTP-коллектор.
+
+    Спаны копятся в ограниченной очереди; при переполнении новые отбрасываются и считаются.
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue[Span]" = queue.Queue(maxsize=settings.TRACING_QUEUE_SIZE)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._file_logger: Optional[logging.Logger] = None
+        self.exported = 0
+        self.dropped = 0
+
+    def export(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self, first: Span) -> List[Span]:
+        batch = [first]
+        while len(batch) < settings.TRACING_BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _file(self) -> logging.Logger:
+        # Ротируемый файл, как у непрерывного профилирования: размер TRACING_FILE ограничен
+        if self._file_logger is None:
+            os.makedirs(os.path.dirname(settings.TRACING_FILE), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                settings.TRACING_FILE,
+                maxBytes=settings.TRACING_FILE_MAX_BYTES,
+                backupCount=settings.TRACING_FILE_BACKUPS,
+                encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            file_logger = logging.getLogger(f"{__name__}.spans")
+            file_logger.handlers = [handler]
+            file_logger.setLevel(logging.INFO)
+            file_logger.propagate = False
+            self._file_logger = file_logger
+        return self._file_logger
+
+    def _write(self, batch: List[Span]) -> None:
+        spans = [span.to_dict() for span in batch]
+        try:
+            if settings.TRACING_EXPORTER == "collector":
+                request = urllib.request.Request(
+                    settings.TRACING_COLLECTOR_URL,
+                    data=json.dumps({"spans": spans}).encode(),
+                    headers={"Content-Type": "application/json"},
+                    method="POST"
+                )
+                with urllib.request.urlopen(request, timeout=settings.TRACING_EXPORT_TIMEOUT):
+                    pass
+            else:
+                # Пакет - одна запись: ротация происходит между пакетами и не разрывает строки
+                self._file().info("\n".join(json.dumps(span, ensure_ascii=False) for span in spans))
+            self.exported += len(spans)
+        except Exception:
+            self.dropped += len(spans)
+            logger.warning("Span export failed, dropped %s spans", len(spans), exc_info=True)
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                first = self._queue.get(timeout=settings.TRACING_FLUSH_INTERVAL)
+            except queue.Empty:
+                continue
+            self._write(self._drain(first))
+
+    def flush(self) -> None:
+        while True:
+            try:
+                first = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self._write(self._drain(first))
+
+    def start(self) -> None:
+        if not settings.TRACING_ENABLED or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+exporter = SpanExporter()
+
+
+class TracedRoute(APIRoute):
+    """Маршрут со спанами обработчика и сериализации ответа; корневой спан получает шаблон пути"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, self._trace_endpoint(endpoint), **kwargs)
+
+    @staticmethod
+    def _trace_endpoint(endpoint):
+        # include_router пересоздает маршрут с уже обернутым обработчиком
+        if getattr(endpoint, "__traced_endpoint__", False):
+            return endpoint
+        traced_endpoint = traced(f"endpoint.{endpoint.__name__}")(endpoint)
+
+        if asyncio.iscoroutinefunction(traced_endpoint):
+            @functools.wraps(endpoint)
+            async def async_marked(*args, **kwargs):
+                try:
+                    return await traced_endpoint(*args, **kwargs)
+                finally:
+                    _mark_endpoint_end()
+            async_marked.__traced_endpoint__ = True
+            return async_marked
+
+        @functools.wraps(endpoint)
+        def marked(*args, **kwargs):
+            try:
+                return traced_endpoint(*args, **kwargs)
+            finally:
+                _mark_endpoint_end()
+        marked.__traced_endpoint__ = True
+        return marked
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            root = _current.get()
+            if root is None:
+                return await handler(request)
+            root.name = f"{request.method} {self.path_format}"
+            root.attributes["http.route"] = self.path_format
+            # Список общий для копий контекста, поэтому отметка видна и из пула потоков
+            endpoint_end: List[int] = []
+            token = _endpoint_end.set(endpoint_end)
+            try:
+                response = await handler(request)
+            finally:
+                _endpoint_end.reset(token)
+            if endpoint_end:
+                # Проверка response_model и рендер тела после возврата из обработчика
+                root.child("serialize", start=endpoint_end[0]).finish()
+            return response
+
+        return route_handler
+
+
+def _mark_endpoint_end() -> None:
+    endpoint_end = _endpoint_end.get()
+    if endpoint_end is not None:
+        endpoint_end.append(time.time_ns())
+
+
+class TracingMiddleware:
+    """ASGI-middleware трассировки запросов.
+
+    Трасса продолжается из заголовка traceparent (nginx, клиенты) с его решением о выборке;
+    без заголовка запрос попадает в выборку с вероятностью TRACING_SAMPLE_RATE.
+    Ответ получает traceparent с идентификатором трассы в любом случае.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.TRACING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        parent = None
+        for name, value in scope["headers"]:
+            if name == TRACEPARENT:
+                parent = parse_traceparent(value.decode("latin-1"))
+                break
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id = os.urandom(16).hex(), None
+            sampled = random.random() < settings.TRACING_SAMPLE_RATE
+
+        root = None
+        if sampled:
+            root = Span(f"{scope['method']} {scope['path']}", trace_id, parent_id, {
+                "http.method": scope["method"],
+                "http.target": scope["path"],
+            })
+        traceparent = f"00-{trace_id}-{root.span_id if root else _span_id()}-{'01' if sampled else '00'}"
+        write_span = None
+
+        async def traced_send(message):
+            nonlocal write_span
+            if message["type"] == "http.response.start":
+                message = dict(message, headers=list(message.get("headers", [])) + [(TRACEPARENT, traceparent.encode())])
+                if root is not None:
+                    root.attributes["http.status_code"] = message["status"]
+                    write_span = root.child("http.response.write")
+            await send(message)
+            if write_span is not None and message["type"] == "http.response.body" and not message.get("more_body"):
+                write_span.finish()
+                write_span = None
+
+        token = _current.set(root)
+        try:
+            await self.app(scope, receive, traced_send)
+        except BaseException as e:
+            if root is not None:
+                root.fail(e)
+            raise
+        finally:
+            _current.reset(token)
+            if root is not None:
+                root.finish()
@@ -0,0 +1,193 @@
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Any, Tuple, Iterable
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import plant_of
+
+# Вердикты и статусы, которые выставляет движок
+VERDICT_OK = "соответствует"
+VERDICT_CONDITIONAL = "условно соответствует"
+VERDICT_FAIL = "не соответствует"
+STATUS_PROCESSING = "обработка"
+STATUS_CHECKED = "проверено"
+
+CRITICAL_SEVERITY = "критический"
+
+# Ключи measurement_data, проверяемые по спецификации вида продукции
+SPEC_METRICS = ("thickness_mm", "width_mm")
+
+# Замеры дефектов передаются в measurement_data["defects"]: {"CRACK": 0.02, ...}
+DEFECTS_KEY = "defects"
+
+_RANGE_RE = re.compile(r"(\d+(?:[.,]\d+)?)(?:\s*[xх]\s*\d+(?:[.,]\d+)?)?\s*[-–]\s*(\d+(?:[.,]\d+)?)")
+
+_VERDICTS = np.array([VERDICT_OK, VERDICT_CONDITIONAL, VERDICT_FAIL], dtype=object)
+
+
+def parse_range(value: Optional[str]) -> Tuple[float, float]:
+    """Разбирает строку вида "1.5-12 мм" или "20x20-100x100 мм" в (min, max).
+
+    Если строку разобрать нельзя, возвращает (nan, nan) - такая граница не проверяется.
+    """
+    if not value:
+        return np.nan, np.nan
+    match = _RANGE_RE.search(value)
+    if not match:
+        return np.nan, np.nan
+    low, high = (float(group.replace(",", ".")) for group in match.groups())
+    return min(low, high), max(low, high)
+
+
+@dataclass
+class Verdict:
+    overall_verdict: Optional[str]
+    is_defect_detected: bool
+    status: str
+    violations: List[str] = field(default_factory=list)
+
+
+@dataclass
+class CompiledRules:
+    """Скомпилированные правила: границы спецификаций и пороги дефектов в виде массивов."""
+    product_index: Dict[int, int]
+    spec_low: np.ndarray        # (products, metrics)
+    spec_high: np.ndarray       # (products, metrics)
+    defect_index: Dict[str, int]
+    defect_codes: List[str]
+    defect_threshold: np.ndarray  # (defect types,)
+    defect_critical: np.ndarray   # (defect types,) bool
+
+    @classmethod
+    def compile(cls, product_types: Iterable[Any], defect_types: Iterable[Any]) -> "CompiledRules":
+        product_types = list(product_types)
+        defect_types = list(defect_types)
+
+        spec_low = np.full((len(product_types), len(SPEC_METRICS)), np.nan)
+        spec_high = np.full((len(product_types), len(SPEC_METRICS)), np.nan)
+        for row, product_type in enumerate(product_types):
+            spec_low[row, 0], spec_high[row, 0] = parse_range(product_type.thickness_range)
+            spec_low[row, 1], spec_high[row, 1] = parse_range(product_type.width_range)
+
+        thresholds = np.array(
+            [np.nan if d.threshold_value is None else float(d.threshold_value) for d in defect_types],
+            dtype=float
+        )
+        critical = np.array([d.severity_level == CRITICAL_SEVERITY for d in defect_types], dtype=bool)
+
+        return cls(
+            product_index={p.id: row for row, p in enumerate(product_types)},
+            spec_low=spec_low,
+            spec_high=spec_high,
+            defect_index={d.defect_code: col for col, d in enumerate(defect_types)},
+            defect_codes=[d.defect_code for d in defect_types],
+            defect_threshold=thresholds,
+            defect_critical=critical,
+        )
+
+    def evaluate_bulk(
+        self,
+        product_type_ids: List[Optional[int]],
+        measurements: List[Dict[str, Any]]
+    ) -> List[Verdict]:
+        """Оценивает пакет результатов контроля за один векторизованный проход."""
+        n = len(measurements)
+        if n == 0:
+            return []
+
+        # Матрица измерений по спецификации (n, metrics); отсутствующие значения - nan
+        values = np.array(
+            [[_as_float(data.get(metric)) for metric in SPEC_METRICS] for data in measurements],
+            dtype=float
+        ).reshape(n, len(SPEC_METRICS))
+
+        rows = np.array([self.product_index.get(pid, -1) for pid in product_type_ids], dtype=np.intp)
+        known = rows >= 0
+        low = np.full_like(values, np.nan)
+        high = np.full_like(values, np.nan)
+        low[known] = self.spec_low[rows[known]]
+        high[known] = self.spec_high[rows[known]]
+
+        with np.errstate(invalid="ignore"):
+            out_of_spec = (values < low) | (values > high)
+        spec_checked = ~np.isnan(values) & ~(np.isnan(low) & np.isnan(high))
+
+        # Матрица замеров дефектов (n, defect types)
+        measured = np.full((n, len(self.defect_index)), np.nan)
+        for i, data in enumerate(measurements):
+            defects = data.get(DEFECTS_KEY)
+            if isinstance(defects, dict):
+                for code, value in defects.items():
+                    col = self.defect_index.get(code)
+                    if col is not None:
+                        measured[i, col] = _as_float(value)
+
+        with np.errstate(invalid="ignore"):
+            exceeded = measured > self.defect_threshold
+        defects_checked = ~np.isnan(measured)
+
+        any_out_of_spec = out_of_spec.any(axis=1)
+        any_exceeded = exceeded.any(axis=1)
+        any_critical = (exceeded & self.defect_critical).any(axis=1)
+        evaluated = spec_checked.any(axis=1) | defects_checked.any(axis=1)
+
+        verdict_codes = np.select(
+            [any_out_of_spec | any_critical, any_exceeded],
+            [2, 1],
+            default=0
+        )
+
+        result = []
+        for i in range(n):
+            if not evaluated[i]:
+                result.append(Verdict(None, False, STATUS_PROCESSING))
+                continue
+            violations = [SPEC_METRICS[j] for j in np.flatnonzero(out_of_spec[i])]
+            violations += [self.defect_codes[j] for j in np.flatnonzero(exceeded[i])]
+            result.append(Verdict(
+                overall_verdict=_VERDICTS[verdict_codes[i]],
+                is_defect_detected=bool(any_exceeded[i]),
+                status=STATUS_CHECKED,
+                violations=violations,
+            ))
+        return result
+
+    def evaluate(self, product_type_id: Optional[int], measurement_data: Dict[str, Any]) -> Verdict:
+        return self.evaluate_bulk([product_type_id], [measurement_data])[0]
+
+
+def _as_float(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+# Правила по заводам: справочники видов продукции и дефектов у каждого завода свои
+_rules: Dict[str, CompiledRules] = {}
+_rules_lock = threading.Lock()
+
+
+def get_rules(db: Session) -> CompiledRules:
+    """Возвращает скомпилированные правила завода сессии, компилируя их при первом обращении."""
+    plant = plant_of(db)
+    rules = _rules.get(plant)
+    if rules is None:
+        with _rules_lock:
+            rules = _rules.get(plant)
+            if rules is None:
+                rules = _rules[plant] = CompiledRules.compile(
+                    db.query(models.ProductType).all(),
+                    db.query(models.DefectType).all()
+                )
+    return rules
+
+
+def invalidate_rules() -> None:
+    """Сбрасывает кэш правил; вызывается при изменении видов продукции и типов дефектов."""
+    with _rules_lock:
+        _rules.clear()
@@ -0,0 +1,274 @@
+import contextvars
+import json
+import zlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from fastapi import HTTPException, Request, status
+from fastapi.responses import JSONResponse
+
+from .anomaly import SENSOR_READINGS_KEY
+from .config import settings
+from .tracing import TracedRoute
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - формат недоступен, остается JSON
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+_MEDIA_TYPES = {
+    "application/json": JSON,
+    "application/msgpack": MSGPACK,
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.apache.arrow.stream": ARROW_STREAM,
+}
+
+# Упакованные числовые массивы в MessagePack: ExtType(код, сырые байты little-endian)
+FLOAT64_ARRAY = 1
+FLOAT32_ARRAY = 2
+_EXT_DTYPES = {FLOAT64_ARRAY: np.dtype("<f8"), FLOAT32_ARRAY: np.dtype("<f4")}
+
+# Accept текущего запроса для NegotiatedResponse (ответ создается в том же контексте)
+_accept: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("wire_accept", default=None)
+
+
+def _media_type(value: str) -> str:
+    return value.split(";")[0].strip().lower()
+
+
+def negotiate(accept: Optional[str], available: List[str]) -> str:
+    """Выбирает формат ответа по Accept с учетом q; по умолчанию JSON"""
+    best, best_q = JSON, 0.0
+    for item in (accept or "").split(","):
+        media_type = _MEDIA_TYPES.get(_media_type(item))
+        if media_type is None or media_type not in available:
+            continue
+        q = 1.0
+        for param in item.split(";")[1:]:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        # При равном q побеждает указанный раньше
+        if q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+def _ext_hook(code: int, data: bytes) -> Any:
+    dtype = _EXT_DTYPES.get(code)
+    if dtype is None or len(data) % dtype.itemsize:
+        raise ValueError(f"Unsupported MessagePack extension type {code}")
+    # Массив ссылается на буфер запроса: объекты на каждый элемент не создаются
+    return np.frombuffer(data, dtype=dtype)
+
+
+def _pack_default(value: Any) -> Any:
+    if isinstance(value, np.ndarray):
+        return msgpack.ExtType(FLOAT64_ARRAY, np.ascontiguousarray(value, dtype="<f8").tobytes())
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _pack_readings(content: Any) -> Any:
+    # Показания датчиков уходят упакованным массивом, а не списком чисел
+    items = content if isinstance(content, list) else [content]
+    for item in items:
+        measurement_data = item.get("measurement_data") if isinstance(item, dict) else None
+        readings = measurement_data.get(SENSOR_READINGS_KEY) if isinstance(measurement_data, dict) else None
+        if isinstance(readings, list):
+            try:
+                measurement_data[SENSOR_READINGS_KEY] = np.asarray(readings, dtype="<f8")
+            except (TypeError, ValueError):
+                pass
+    return content
+
+
+def _arrow_stream(rows: List[Dict[str, Any]]) -> bytes:
+    import pyarrow as pa
+
+    names: Dict[str, None] = {}
+    for row in rows:
+        names.update(dict.fromkeys(row))
+    columns = {}
+    for name in names:
+        values = [row.get(name) for row in rows]
+        # Вложенные объекты (measurement_data, product_type) передаются JSON-строкой
+        if any(isinstance(value, (dict, list)) for value in values):
+            values = [None if value is None else json.dumps(value, ensure_ascii=False) for value in values]
+        columns[name] = values
+    table = pa.table(columns)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+class NegotiatedResponse(JSONResponse):
+    """Ответ в формате из Accept: JSON, MessagePack или Arrow IPC (только для списков)"""
+
+    def render(self, content: Any) -> bytes:
+        if content is None:
+            return super().render(content)
+        available = [JSON]
+        if msgpack is not None:
+            available.append(MSGPACK)
+        if isinstance(content, list) and content and all(isinstance(row, dict) for row in content):
+            available.append(ARROW_STREAM)
+        wire_format = negotiate(_accept.get(), available)
+        if wire_format == MSGPACK:
+            self.media_type = MSGPACK
+            return msgpack.packb(_pack_readings(content), default=_pack_default, use_bin_type=True)
+        if wire_format == ARROW_STREAM:
+            self.media_type = ARROW_STREAM
+            return _arrow_stream(content)
+        return super().render(content)
+
+
+class WireRequest(Request):
+    async def json(self) -> Any:
+        if self.scope.get("wire_format") != MSGPACK:
+            return await super().json()
+        if not hasattr(self, "_json"):
+            self._json = msgpack.unpackb(await self.body(), raw=False, ext_hook=_ext_hook)
+        return self._json
+
+
+class WireRoute(TracedRoute):
+    """Маршрут с телом запроса в MessagePack и согласованием формата ответа.
+
+    Тело MessagePack подставляется FastAPI вместо JSON, поэтому валидация схем не меняется.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            headers = request.scope["headers"]
+            for index, (name, value) in enumerate(headers):
+                if name == b"content-type" and _MEDIA_TYPES.get(_media_type(value.decode("latin-1"))) == MSGPACK:
+                    if msgpack is None:
+                        return JSONResponse({"detail": "MessagePack is not supported"}, status_code=415)
+                    request.scope["wire_format"] = MSGPACK
+                    headers[index] = (b"content-type", JSON.encode())
+                    request = WireRequest(request.scope, request.receive)
+                    break
+            token = _accept.set(request.headers.get("accept"))
+            try:
+                return await handler(request)
+            finally:
+                _accept.reset(token)
+
+        return route_handler
+
+
+class _DecodedTooLarge(Exception):
+    pass
+
+
+class _Decoder:
+    """Потоковая распаковка с ограничением на общий объем результата"""
+
+    def __init__(self, encoding: str, limit: int):
+        self._gzip = encoding == "gzip"
+        self._remaining = limit
+        if self._gzip:
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            # decompressobj zstd не ограничивает выход: распакованные данные пишутся порциями
+            # по write_size в write(), которая прерывает распаковку сразу за пределом
+            self._output = bytearray()
+            self._decoder = zstandard.ZstdDecompressor().stream_writer(self, write_size=65536, closefd=False)
+
+    def write(self, data: bytes) -> int:
+        self._output += data
+        if len(self._output) > self._remaining:
+            raise _DecodedTooLarge()
+        return len(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        too_large = False
+        try:
+            if self._gzip:
+                # Ограничение на выходной объем защищает от zip-бомб
+                chunk = self._decoder.decompress(data, self._remaining + 1)
+                too_large = bool(self._decoder.unconsumed_tail)
+            else:
+                try:
+                    self._decoder.write(data)
+                except _DecodedTooLarge:
+                    too_large = True
+                chunk = bytes(self._output)
+                self._output.clear()
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid compressed request body: {e}")
+        self._remaining -= len(chunk)
+        if too_large or self._remaining < 0:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail="Decompressed request body is too large"
+            )
+        return chunk
+
+
+class DecompressionMiddleware:
+    """ASGI-middleware распаковки тела запроса с Content-Encoding gzip или zstd.
+
+    Ошибки распаковки поднимаются как HTTPException при чтении тела и превращаются в 400/413.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = None
+        for name, value in scope["headers"]:
+            if name == b"content-encoding":
+                encoding = value.decode("latin-1").strip().lower()
+        if encoding in (None, "identity"):
+            await self.app(scope, receive, send)
+            return
+        if encoding not in ("gzip", "zstd") or (encoding == "zstd" and zstandard is None):
+            body = json.dumps({"detail": f"Unsupported Content-Encoding: {encoding}"}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 415,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        # Размер тела после распаковки заранее неизвестен
+        scope["headers"] = [
+            (name, value) for name, value in scope["headers"]
+            if name not in (b"content-encoding", b"content-length")
+        ]
+        decoder = _Decoder(encoding, settings.WIRE_MAX_DECOMPRESSED_BYTES)
+
+        async def decompressing_receive():
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+            return {
+                "type": "http.request",
+                "body": decoder.decompress(message.get("body", b"")),
+                "more_body": message.get("more_body", False),
+            }
+
+        await self.app(scope, decompressing_receive, send)
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import re
+import time
+from typing import Dict, Any, List
+
+import anyio
+
+from .config import settings
+from .database import shards, DEFAULT_WORKLOAD
+
+INGESTION = "ingestion"
+INTERACTIVE = "interactive"
+REPORTING = "reporting"
+
+# Классы нагрузки маршрутов: (методы или None для любых, шаблон пути, класс); первое совпадение
+WORKLOAD_ROUTES = (
+    (("GET",), re.compile(r"^/api/maintenance/workload$"), INTERACTIVE),
+    (("POST",), re.compile(r"^/api/inspections/reevaluate$"), REPORTING),
+    (("POST",), re.compile(r"^/api/batches/import$"), REPORTING),
+    (("POST",), re.compile(r"^/api/(inspections|defects)/?$"), INGESTION),
+    (None, re.compile(r"^/api/(analytics|maintenance)/"), REPORTING),
+    (("GET",), re.compile(r"^/api/jobs/\d+/result$"), REPORTING),
+    (("GET",), re.compile(r"^/api/batches/\d+/certificate$"), REPORTING),
+)
+
+
+def classify(method: str, path: str) -> str:
+    for methods, pattern, name in WORKLOAD_ROUTES:
+        if (methods is None or method in methods) and pattern.match(path):
+            return name
+    return DEFAULT_WORKLOAD
+
+
+class WorkloadClass:
+    """Ограничение одновременно выполняемых запросов класса и метрики его очереди.
+
+    Счетчики меняются только в потоке event loop, поэтому блокировки не нужны.
+    """
+
+    def __init__(self, name: str, concurrency: int, max_queue: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def metrics(self) -> Dict[str, Any]:
+        # Пул класса есть в базе каждого завода; метрики суммируются
+        pools = [shards.engine(plant, self.name).pool for plant in shards.plants]
+        return {
+            "name": self.name,
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_ms": self.wait_total / self.admitted * 1000 if self.admitted else 0.0,
+            "max_wait_ms": self.wait_max * 1000,
+            "db_pool_size": sum(pool.size() for pool in pools),
+            "db_checked_out": sum(pool.checkedout() for pool in pools),
+            "db_overflow": sum(pool.overflow() for pool in pools),
+        }
+
+
+classes = {
+    name: WorkloadClass(name, limits["concurrency"], limits["max_queue"])
+    for name, limits in settings.WORKLOAD_CLASSES.items()
+}
+
+
+def metrics() -> List[Dict[str, Any]]:
+    return [workload_class.metrics() for workload_class in classes.values()]
+
+
+def configure_threadpool() -> None:
+    """Общий пул потоков не должен ограничивать сильнее, чем лимиты классов"""
+    total = sum(workload_class.concurrency for workload_class in classes.values())
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens, total + settings.JOBS_WORKERS)
+
+
+class WorkloadMiddleware:
+    """ASGI-middleware допуска запросов по классам нагрузки.
+
+    Запрос ждет свободного слота своего класса, при переполненной очереди получает 503.
+    Класс сохраняется в scope["workload"], по нему get_db выбирает пул соединений.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        name = classify(scope["method"], scope["path"])
+        scope["workload"] = name
+        workload_class = classes[name]
+
+        if workload_class.semaphore.locked() and workload_class.waiting >= workload_class.max_queue:
+            workload_class.rejected += 1
+            body = json.dumps({"detail": "Server is busy"}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", b"1"),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        started = time.monotonic()
+        workload_class.waiting += 1
+        try:
+            await workload_class.semaphore.acquire()
+        finally:
+            workload_class.waiting -= 1
+
+        waited = time.monotonic() - started
+        workload_class.admitted += 1
+        workload_class.wait_total += waited
+        workload_class.wait_max = max(workload_class.wait_max, waited)
+        workload_class.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            workload_class.in_flight -= 1
+            workload_class.semaphore.release()
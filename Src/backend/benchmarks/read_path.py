@@ -0,0 +1,72 @@
+"""Сравнение путей чтения списков: ORM-объекты против Core-проекции в словари.
+
+Запуск из Src/backend на базе с данными (DATABASE_URL как у приложения):
+
+    python -m benchmarks.read_path --limit 1000 --repeat 20
+
+Для каждого ресурса измеряется чтение страницы и сериализация в JSON:
+медиана времени и пик выделенной памяти (tracemalloc).
+"""
+import argparse
+import statistics
+import time
+import tracemalloc
+from typing import Callable, List
+
+from pydantic import TypeAdapter
+
+from app import crud, fieldsets, schemas
+from app.database import SessionLocal
+
+RESOURCES = {
+    "batches": (crud.get_batches, crud.list_batches, schemas.ProductionBatch),
+    "inspections": (crud.get_inspection_results, crud.list_inspection_results, schemas.InspectionResult),
+    "product_types": (crud.get_product_types, crud.list_product_types, schemas.ProductType),
+}
+
+
+def _measure(run: Callable[[], bytes], repeat: int):
+    run()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--resource", choices=sorted(RESOURCES), action="append")
+    args = parser.parse_args(argv)
+
+    print(f"{'resource':<14} {'path':<5} {'rows':>6} {'median ms':>10} {'peak KiB':>10}")
+    for name in args.resource or sorted(RESOURCES):
+        orm_list, core_list, schema = RESOURCES[name]
+        adapter = TypeAdapter(List[schema])
+        projection = fieldsets.full(name)
+
+        def orm() -> bytes:
+            with SessionLocal() as db:
+                rows = orm_list(db, skip=0, limit=args.limit)
+                return adapter.dump_json(adapter.validate_python(rows, from_attributes=True))
+
+        def core() -> bytes:
+            with SessionLocal() as db:
+                rows = core_list(db, projection, skip=0, limit=args.limit)
+                return adapter.dump_json(adapter.validate_python(rows))
+
+        rows = len(adapter.validate_json(core()))
+        for path, run in (("orm", orm), ("core", core)):
+            median, peak = _measure(run, args.repeat)
+            print(f"{name:<14} {path:<5} {rows:>6} {median * 1000:>10.2f} {peak / 1024:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
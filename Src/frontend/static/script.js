@@ -384,8 +384,23 @@ function editBatch(batchId) {
     openBatchModal(batchId);
 }
 
-function viewBatch(batchId) {
-    const batch = batches.find(b => b.id === batchId);
+async function viewBatch(batchId) {
+    let batch = batches.find(b => b.id === batchId);
+    let inspectionsCount = null;
+    let defectsCount = null;
+    
+    // Полное дерево партии одним запросом
+    try {
+        const response = await fetchWithAuth(`${API_BASE_URL}/batches/${batchId}/full`);
+        if (response.ok) {
+            batch = await response.json();
+            inspectionsCount = batch.inspection_results.length;
+            defectsCount = batch.inspection_results.reduce((sum, inspection) => sum + inspection.defect_details.length, 0);
+        }
+    } catch (error) {
+        console.error('Ошибка загрузки партии:', error);
+    }
+    
     if (batch) {
         alert(`
             Детали партии:
@@ -396,6 +411,8 @@ function viewBatch(batchId) {
             Печь: ${batch.furnace_number || 'Не указана'}
             Вес: ${batch.total_weight_kg ? batch.total_weight_kg + ' кг' : 'Не указан'}
             Длина: ${batch.total_length_m ? batch.total_length_m + ' м' : 'Не указана'}
+            Результатов контроля: ${inspectionsCount !== null ? inspectionsCount : 'Нет данных'}
+            Дефектов: ${defectsCount !== null ? defectsCount : 'Нет данных'}
         `);
     }
 }
@@ -1,3 +1,9 @@
+-- Код завода, чьи данные хранит эта база (шард): psql -v plant_code=north -f init-db.sql
+\if :{?plant_code}
+\else
+    \set plant_code main
+\endif
+
 -- Удаляем существующую базу данных (для чистой установки)
 DROP DATABASE IF EXISTS metal_quality_control;
 CREATE DATABASE metal_quality_control
@@ -6,6 +12,9 @@ CREATE DATABASE metal_quality_control
     LC_CTYPE 'ru_RU.UTF-8'
     TEMPLATE template0;
 
+-- Значение по умолчанию для plant_code производственных таблиц во всех сессиях этой базы
+ALTER DATABASE metal_quality_control SET app.plant_code = :'plant_code';
+
 \c metal_quality_control;
 
 -- ============================================
@@ -49,14 +58,16 @@ CREATE TABLE product_types (
     width_range VARCHAR(100), -- диапазон ширины
     material_grade VARCHAR(100), -- марка стали
     description TEXT,
-    created_by INTEGER REFERENCES users(id),
+    created_by INTEGER, -- без внешнего ключа: пользователи в центральной базе, строка - в базе завода
     created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    version INTEGER NOT NULL DEFAULT 1 -- версия строки для If-Match
 );
 
 -- Производственные партии
 CREATE TABLE production_batches (
-    id SERIAL PRIMARY KEY,
+    id SERIAL PRIMARY KEY, -- уникален в базе завода; между заводами строку определяет (plant_code, id)
+    plant_code VARCHAR(20) NOT NULL DEFAULT current_setting('app.plant_code'), -- завод (шард)
     batch_number VARCHAR(100) UNIQUE NOT NULL,
     product_type_id INTEGER REFERENCES product_types(id) ON DELETE RESTRICT,
     production_date DATE NOT NULL,
@@ -67,9 +78,10 @@ CREATE TABLE production_batches (
     status VARCHAR(50) DEFAULT 'в производстве', -- в производстве, произведено, отгружено
     quality_rating INTEGER CHECK (quality_rating >= 1 AND quality_rating <= 5),
     metadata JSONB, -- дополнительные данные
-    created_by INTEGER REFERENCES users(id),
+    created_by INTEGER, -- без внешнего ключа: пользователи в центральной базе, строка - в базе завода
     created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    version INTEGER NOT NULL DEFAULT 1 -- версия строки для If-Match
 );
 
 -- Типы дефектов
@@ -82,8 +94,10 @@ CREATE TABLE defect_types (
     description TEXT,
     measurement_unit VARCHAR(50), -- мм, %, ед.
     threshold_value DECIMAL(10, 4), -- пороговое значение
-    created_by INTEGER REFERENCES users(id),
-    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+    created_by INTEGER, -- без внешнего ключа: пользователи в центральной базе, строка - в базе завода
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    version INTEGER NOT NULL DEFAULT 1 -- версия строки для If-Match
 );
 
 -- Контрольные точки/зоны контроля
@@ -95,16 +109,19 @@ CREATE TABLE inspection_points (
     equipment_type VARCHAR(100), -- тип оборудования контроля
     location_in_line VARCHAR(100), -- расположение на линии
     coordinates JSONB, -- координаты на схеме линии
-    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
 );
 
--- Результаты контроля (основная таблица)
+-- Результаты контроля (основная таблица, секционирована по месяцам inspection_time)
 CREATE TABLE inspection_results (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     batch_id INTEGER REFERENCES production_batches(id) ON DELETE CASCADE,
     inspection_point_id INTEGER REFERENCES inspection_points(id),
-    inspection_time TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
-    inspector_id INTEGER REFERENCES users(id), -- кто провел контроль
+    inspection_time TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    plant_code VARCHAR(20) NOT NULL DEFAULT current_setting('app.plant_code'),
+    edge_id VARCHAR(36), -- UUID записи на линейном узле (edge), ключ идемпотентной пересылки
+    inspector_id INTEGER, -- кто провел контроль; без внешнего ключа: пользователи в центральной базе
     inspector_name VARCHAR(200), -- или имя системы
     measurement_data JSONB NOT NULL, -- основные данные измерений
     -- Пример measurement_data:
@@ -122,13 +139,18 @@ CREATE TABLE inspection_results (
     status VARCHAR(50) DEFAULT 'обработка', -- обработка, проверено, утверждено
     notes TEXT,
     created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
-);
+    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    version INTEGER NOT NULL DEFAULT 1, -- версия строки для If-Match
+    PRIMARY KEY (id, inspection_time)
+) PARTITION BY RANGE (inspection_time);
 
--- Детализация дефектов
+-- Детализация дефектов (секционирована так же, как inspection_results)
 CREATE TABLE defect_details (
-    id SERIAL PRIMARY KEY,
-    inspection_result_id INTEGER REFERENCES inspection_results(id) ON DELETE CASCADE,
+    id SERIAL,
+    inspection_result_id INTEGER NOT NULL,
+    inspection_time TIMESTAMPTZ NOT NULL, -- копия inspection_results.inspection_time, ключ секционирования
+    plant_code VARCHAR(20) NOT NULL DEFAULT current_setting('app.plant_code'),
+    edge_id VARCHAR(36),
     defect_type_id INTEGER REFERENCES defect_types(id),
     defect_location JSONB, -- координаты дефекта
     -- Пример: {"x_mm": 150.5, "y_mm": 45.0, "length_mm": 2.3, "width_mm": 0.5}
@@ -139,9 +161,197 @@ CREATE TABLE defect_details (
     repair_method VARCHAR(200),
     repair_date TIMESTAMPTZ,
     repair_notes TEXT,
-    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, inspection_time),
+    FOREIGN KEY (inspection_result_id, inspection_time)
+        REFERENCES inspection_results(id, inspection_time) ON DELETE CASCADE
+) PARTITION BY RANGE (inspection_time);
+
+-- Тревоги по выбросам в показаниях датчиков (sensor_readings)
+CREATE TABLE anomaly_alerts (
+    id SERIAL,
+    inspection_result_id INTEGER NOT NULL,
+    inspection_time TIMESTAMPTZ NOT NULL,
+    plant_code VARCHAR(20) NOT NULL DEFAULT current_setting('app.plant_code'),
+    inspection_point_id INTEGER REFERENCES inspection_points(id),
+    detectors JSONB NOT NULL, -- сработавшие детекторы: shewhart, ewma, cusum
+    flagged_count INTEGER NOT NULL,
+    details JSONB, -- индексы показаний по детекторам
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, inspection_time),
+    FOREIGN KEY (inspection_result_id, inspection_time)
+        REFERENCES inspection_results(id, inspection_time) ON DELETE CASCADE
+) PARTITION BY RANGE (inspection_time);
+
+-- Фоновые задачи (отчеты и выгрузки)
+CREATE TABLE jobs (
+    id SERIAL PRIMARY KEY,
+    job_type VARCHAR(100) NOT NULL,
+    params JSONB,
+    priority INTEGER DEFAULT 0,
+    status VARCHAR(50) DEFAULT 'queued', -- queued, running, succeeded, failed, cancelled
+    progress DOUBLE PRECISION DEFAULT 0,
+    message TEXT,
+    error TEXT,
+    cancel_requested BOOLEAN DEFAULT FALSE,
+    result_path VARCHAR(500),
+    result_content_type VARCHAR(100),
+    created_by INTEGER REFERENCES users(id),
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    heartbeat_at TIMESTAMPTZ -- последняя отметка обработчика; устаревшая - процесс упал, задача снова в очереди
+);
+
+-- Записи об удалении строк для инкрементальной синхронизации (заполняются триггерами)
+CREATE TABLE deleted_records (
+    id BIGSERIAL PRIMARY KEY,
+    entity VARCHAR(100) NOT NULL, -- имя таблицы
+    entity_id INTEGER NOT NULL,
+    reason VARCHAR(50) NOT NULL DEFAULT 'deleted', -- deleted, archived
+    deleted_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Партии, у которых результат контроля удален или перенесен в другую партию (заполняются триггерами):
+-- updated_at самой партии при этом не меняется, а индекс похожих партий должен пересчитать ее профиль
+CREATE TABLE batch_profile_changes (
+    id BIGSERIAL PRIMARY KEY,
+    batch_id INTEGER NOT NULL,
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Журнал аудита изменений (только добавление): кто и когда изменил запись, прежние и новые значения
+CREATE TABLE audit_log (
+    id BIGSERIAL PRIMARY KEY,
+    entity VARCHAR(100) NOT NULL, -- имя таблицы
+    entity_id INTEGER NOT NULL,
+    action VARCHAR(20) NOT NULL, -- update, delete
+    changes JSONB NOT NULL, -- {"колонка": {"old": ..., "new": ...}}
+    actor_id INTEGER, -- без внешнего ключа: запись переживает удаление пользователя
+    actor VARCHAR(50),
+    trace_id VARCHAR(32),
+    plant_code VARCHAR(20), -- завод, в базе которого изменена запись
+    changed_at TIMESTAMPTZ NOT NULL
 );
 
+-- ============================================
+-- 2a. СЕКЦИОНИРОВАНИЕ ПО МЕСЯЦАМ
+-- ============================================
+
+-- Создает помесячные секции на текущий и months_ahead следующих месяцев.
+-- Вызывается при инициализации и периодически фоновой задачей приложения.
+-- Строки месяца, уже попавшие в секцию по умолчанию (дата из будущего с часов линии или опечатка),
+-- переносятся в новую секцию; ошибка одного месяца пишется в WARNING и не мешает остальным.
+CREATE OR REPLACE FUNCTION create_monthly_partitions(months_ahead INTEGER DEFAULT 3)
+RETURNS INTEGER AS $$
+DECLARE
+    -- Порядок важен: сначала родительская таблица внешних ключей
+    tables TEXT[] := ARRAY['inspection_results', 'defect_details', 'anomaly_alerts'];
+    parent_table TEXT;
+    default_name TEXT;
+    month_start DATE;
+    month_end DATE;
+    partition_name TEXT;
+    moving TEXT[];
+    stray BOOLEAN;
+    moved BIGINT;
+    created INTEGER := 0;
+    month_created INTEGER;
+BEGIN
+    FOR i IN 0..months_ahead LOOP
+        month_start := (date_trunc('month', CURRENT_DATE) + make_interval(months => i))::date;
+        month_end := (month_start + INTERVAL '1 month')::date;
+        moving := ARRAY[]::TEXT[];
+        month_created := 0;
+        BEGIN
+            FOREACH parent_table IN ARRAY tables LOOP
+                partition_name := format('%s_y%s', parent_table, to_char(month_start, 'YYYY"m"MM'));
+                CONTINUE WHEN to_regclass(partition_name) IS NOT NULL;
+                default_name := parent_table || '_default';
+                -- Новые строки месяца не должны попасть в секцию по умолчанию до присоединения новой
+                EXECUTE format('LOCK TABLE %I IN SHARE ROW EXCLUSIVE MODE', default_name);
+                EXECUTE format(
+                    'SELECT EXISTS (SELECT 1 FROM %I WHERE inspection_time >= %L AND inspection_time < %L)',
+                    default_name, month_start, month_end
+                ) INTO stray;
+                IF stray THEN
+                    -- CREATE ... PARTITION OF не проходит проверку секции по умолчанию: строки копируются
+                    -- в отдельную таблицу, которая присоединяется после их удаления из секции по умолчанию
+                    EXECUTE format(
+                        'CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                        partition_name, parent_table
+                    );
+                    EXECUTE format(
+                        'INSERT INTO %I SELECT * FROM %I WHERE inspection_time >= %L AND inspection_time < %L',
+                        partition_name, default_name, month_start, month_end
+                    );
+                    moving := moving || parent_table;
+                ELSE
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                        partition_name, parent_table, month_start, month_end
+                    );
+                END IF;
+                month_created := month_created + 1;
+            END LOOP;
+
+            -- Удаление напрямую из секции не вызывает триггеров уровня оператора родительской таблицы
+            -- (записи об удалении для синхронизации); ссылающиеся строки удаляются первыми
+            FOREACH parent_table IN ARRAY ARRAY['anomaly_alerts', 'defect_details', 'inspection_results'] LOOP
+                CONTINUE WHEN NOT parent_table = ANY(moving);
+                EXECUTE format(
+                    'DELETE FROM %I WHERE inspection_time >= %L AND inspection_time < %L',
+                    parent_table || '_default', month_start, month_end
+                );
+            END LOOP;
+            FOREACH parent_table IN ARRAY tables LOOP
+                CONTINUE WHEN NOT parent_table = ANY(moving);
+                partition_name := format('%s_y%s', parent_table, to_char(month_start, 'YYYY"m"MM'));
+                EXECUTE format(
+                    'ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                    parent_table, partition_name, month_start, month_end
+                );
+                EXECUTE format('SELECT count(*) FROM %I', partition_name) INTO moved;
+                RAISE WARNING 'Moved % rows of % from the default partition into %', moved, parent_table, partition_name;
+            END LOOP;
+            created := created + month_created;
+        EXCEPTION WHEN OTHERS THEN
+            RAISE WARNING 'Partitions for % were not created: %', to_char(month_start, 'YYYY-MM'), SQLERRM;
+        END;
+    END LOOP;
+    RETURN created;
+END;
+$$ language 'plpgsql';
+
+-- Удаляет секции месяца целиком: DETACH + DROP вместо массового DELETE.
+CREATE OR REPLACE FUNCTION drop_monthly_partitions(month_start DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    parent_table TEXT;
+    partition_name TEXT;
+    dropped INTEGER := 0;
+BEGIN
+    -- Порядок обратный созданию: сначала ссылающиеся таблицы
+    FOREACH parent_table IN ARRAY ARRAY['anomaly_alerts', 'defect_details', 'inspection_results'] LOOP
+        partition_name := format('%s_y%s', parent_table, to_char(month_start, 'YYYY"m"MM'));
+        IF to_regclass(partition_name) IS NOT NULL THEN
+            EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent_table, partition_name);
+            EXECUTE format('DROP TABLE %I', partition_name);
+            dropped := dropped + 1;
+        END IF;
+    END LOOP;
+    RETURN dropped;
+END;
+$$ language 'plpgsql';
+
+-- Секции по умолчанию принимают строки вне созданных месяцев (например, загрузку старых данных)
+CREATE TABLE inspection_results_default PARTITION OF inspection_results DEFAULT;
+CREATE TABLE defect_details_default PARTITION OF defect_details DEFAULT;
+CREATE TABLE anomaly_alerts_default PARTITION OF anomaly_alerts DEFAULT;
+
+SELECT create_monthly_partitions(3);
+
 -- ============================================
 -- 3. ИНДЕКСЫ
 -- ============================================
@@ -157,12 +367,42 @@ CREATE INDEX idx_inspection_time ON inspection_results(inspection_time);
 CREATE INDEX idx_inspection_verdict ON inspection_results(overall_verdict);
 CREATE INDEX idx_inspection_status ON inspection_results(status);
 CREATE INDEX idx_inspection_defect_detected ON inspection_results(is_defect_detected);
+CREATE INDEX idx_inspection_flow ON inspection_results(batch_id, inspection_time, inspection_point_id);
+-- Поток за период по всем партиям: окно по времени без обращения к таблице
+CREATE INDEX idx_inspection_flow_time ON inspection_results(inspection_time) INCLUDE (batch_id, inspection_point_id, id);
 
 -- Индексы для таблицы defect_details
 CREATE INDEX idx_defect_inspection_id ON defect_details(inspection_result_id);
+CREATE INDEX idx_defect_time ON defect_details(inspection_time);
 CREATE INDEX idx_defect_type_id ON defect_details(defect_type_id);
 CREATE INDEX idx_defect_severity ON defect_details(severity);
 
+-- Индексы для таблицы anomaly_alerts
+CREATE INDEX idx_anomaly_inspection_id ON anomaly_alerts(inspection_result_id);
+CREATE INDEX idx_anomaly_time ON anomaly_alerts(inspection_time);
+CREATE INDEX idx_anomaly_point_id ON anomaly_alerts(inspection_point_id);
+
+-- Индексы для таблицы jobs
+CREATE INDEX idx_job_status ON jobs(status);
+CREATE INDEX idx_job_created_by ON jobs(created_by);
+
+-- Индексы для инкрементальной синхронизации (updated_since + курсор)
+CREATE INDEX idx_product_types_updated ON product_types(updated_at, id);
+CREATE INDEX idx_batch_updated ON production_batches(updated_at, id);
+CREATE INDEX idx_defect_types_updated ON defect_types(updated_at, id);
+CREATE INDEX idx_inspection_points_updated ON inspection_points(updated_at, id);
+CREATE INDEX idx_inspection_updated ON inspection_results(updated_at, id);
+CREATE INDEX idx_defect_updated ON defect_details(updated_at, id);
+CREATE INDEX idx_deleted_records_entity ON deleted_records(entity, deleted_at, id);
+CREATE INDEX idx_batch_profile_changes ON batch_profile_changes(changed_at);
+CREATE INDEX idx_audit_entity ON audit_log(entity, entity_id, changed_at);
+CREATE INDEX idx_audit_changed_at ON audit_log(changed_at);
+CREATE INDEX idx_audit_actor ON audit_log(actor_id, changed_at);
+
+-- Повторная пересылка с линейного узла не создает дублей: INSERT ... ON CONFLICT по этим индексам
+CREATE UNIQUE INDEX uq_inspection_edge ON inspection_results(edge_id, inspection_time);
+CREATE UNIQUE INDEX uq_defect_edge ON defect_details(edge_id, inspection_time);
+
 -- Индекс для JSONB поля (если часто фильтруем по thickness)
 CREATE INDEX idx_measurement_thickness ON inspection_results USING gin ((measurement_data->'thickness_mm'));
 
@@ -224,9 +464,13 @@ INSERT INTO inspection_results (batch_id, inspection_point_id, inspector_id, ins
 (2, 2, 3, 'Сидоров А.П.', '{"thickness_mm": 2.1, "width_mm": 1200.0, "temperature_c": 720, "hardness_hb": 180}', FALSE, 0, 'соответствует', 'обработка');
 
 -- Тестовые дефекты
-INSERT INTO defect_details (inspection_result_id, defect_type_id, defect_location, severity, size_mm) VALUES
-(2, 1, '{"x_mm": 150.5, "y_mm": 45.0, "length_mm": 2.3, "width_mm": 0.05}', 2.5, 2.3),
-(2, 6, '{"x_mm": 320.0, "y_mm": 120.5, "length_mm": 5.0, "width_mm": 3.0}', 1.0, 5.0);
+INSERT INTO defect_details (inspection_result_id, inspection_time, defect_type_id, defect_location, severity, size_mm)
+SELECT ir.id, ir.inspection_time, d.defect_type_id, d.defect_location::jsonb, d.severity, d.size_mm
+FROM (VALUES
+    (2, 1, '{"x_mm": 150.5, "y_mm": 45.0, "length_mm": 2.3, "width_mm": 0.05}', 2.5, 2.3),
+    (2, 6, '{"x_mm": 320.0, "y_mm": 120.5, "length_mm": 5.0, "width_mm": 3.0}', 1.0, 5.0)
+) AS d(inspection_result_id, defect_type_id, defect_location, severity, size_mm)
+JOIN inspection_results ir ON ir.id = d.inspection_result_id;
 
 -- ============================================
 -- 5. ТРИГГЕРЫ И ФУНКЦИИ
@@ -254,6 +498,95 @@ CREATE TRIGGER update_production_batches_updated_at BEFORE UPDATE ON production_
 CREATE TRIGGER update_inspection_results_updated_at BEFORE UPDATE ON inspection_results
     FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
 
+CREATE TRIGGER update_defect_types_updated_at BEFORE UPDATE ON defect_types
+    FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+
+CREATE TRIGGER update_inspection_points_updated_at BEFORE UPDATE ON inspection_points
+    FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+
+CREATE TRIGGER update_defect_details_updated_at BEFORE UPDATE ON defect_details
+    FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+
+-- Версия строки для оптимистичной блокировки (If-Match): растет при любом UPDATE,
+-- включая массовые операции и пересчет defect_count
+CREATE OR REPLACE FUNCTION increment_row_version()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.version = OLD.version + 1;
+    RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER increment_product_types_version BEFORE UPDATE ON product_types
+    FOR EACH ROW EXECUTE FUNCTION increment_row_version();
+
+CREATE TRIGGER increment_production_batches_version BEFORE UPDATE ON production_batches
+    FOR EACH ROW EXECUTE FUNCTION increment_row_version();
+
+CREATE TRIGGER increment_inspection_results_version BEFORE UPDATE ON inspection_results
+    FOR EACH ROW EXECUTE FUNCTION increment_row_version();
+
+CREATE TRIGGER increment_defect_types_version BEFORE UPDATE ON defect_types
+    FOR EACH ROW EXECUTE FUNCTION increment_row_version();
+
+-- Записи об удалении для синхронизации: одна вставка на оператор DELETE, включая каскадные.
+-- Причина берется из app.delete_reason (архивирование выставляет 'archived' через SET LOCAL)
+CREATE OR REPLACE FUNCTION record_deleted_rows()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO deleted_records (entity, entity_id, reason)
+    SELECT TG_TABLE_NAME, deleted_rows.id, COALESCE(NULLIF(current_setting('app.delete_reason', TRUE), ''), 'deleted')
+    FROM deleted_rows;
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER record_product_types_deleted AFTER DELETE ON product_types
+    REFERENCING OLD TABLE AS deleted_rows FOR EACH STATEMENT EXECUTE FUNCTION record_deleted_rows();
+
+CREATE TRIGGER record_production_batches_deleted AFTER DELETE ON production_batches
+    REFERENCING OLD TABLE AS deleted_rows FOR EACH STATEMENT EXECUTE FUNCTION record_deleted_rows();
+
+CREATE TRIGGER record_defect_types_deleted AFTER DELETE ON defect_types
+    REFERENCING OLD TABLE AS deleted_rows FOR EACH STATEMENT EXECUTE FUNCTION record_deleted_rows();
+
+CREATE TRIGGER record_inspection_points_deleted AFTER DELETE ON inspection_points
+    REFERENCING OLD TABLE AS deleted_rows FOR EACH STATEMENT EXECUTE FUNCTION record_deleted_rows();
+
+CREATE TRIGGER record_inspection_results_deleted AFTER DELETE ON inspection_results
+    REFERENCING OLD TABLE AS deleted_rows FOR EACH STATEMENT EXECUTE FUNCTION record_deleted_rows();
+
+CREATE TRIGGER record_defect_details_deleted AFTER DELETE ON defect_details
+    REFERENCING OLD TABLE AS deleted_rows FOR EACH STATEMENT EXECUTE FUNCTION record_deleted_rows();
+
+-- Партии, потерявшие результаты контроля. Архивирование пропускается: архивные партии остаются
+-- в индексе похожих партий с прежним профилем
+CREATE OR REPLACE FUNCTION record_deleted_inspection_batches()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('app.delete_reason', TRUE) IS DISTINCT FROM 'archived' THEN
+        INSERT INTO batch_profile_changes (batch_id)
+        SELECT DISTINCT deleted_rows.batch_id FROM deleted_rows WHERE deleted_rows.batch_id IS NOT NULL;
+    END IF;
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER record_inspection_results_batch_deleted AFTER DELETE ON inspection_results
+    REFERENCING OLD TABLE AS deleted_rows FOR EACH STATEMENT EXECUTE FUNCTION record_deleted_inspection_batches();
+
+CREATE OR REPLACE FUNCTION record_moved_inspection_batch()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO batch_profile_changes (batch_id) VALUES (OLD.batch_id);
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+-- Перенос результата в другую партию: новая партия видна по updated_at результата, прежняя - здесь
+CREATE TRIGGER record_inspection_results_batch_moved AFTER UPDATE OF batch_id ON inspection_results
+    FOR EACH ROW WHEN (OLD.batch_id IS NOT NULL AND OLD.batch_id IS DISTINCT FROM NEW.batch_id) EXECUTE FUNCTION record_moved_inspection_batch();
+
 -- Функция для автоматического подсчета дефектов
 CREATE OR REPLACE FUNCTION update_defect_count()
 RETURNS TRIGGER AS $$
@@ -270,7 +603,8 @@ BEGIN
             FROM defect_details 
             WHERE inspection_result_id = COALESCE(NEW.inspection_result_id, OLD.inspection_result_id)
         )
-        WHERE id = COALESCE(NEW.inspection_result_id, OLD.inspection_result_id);
+        WHERE id = COALESCE(NEW.inspection_result_id, OLD.inspection_result_id)
+          AND inspection_time = COALESCE(NEW.inspection_time, OLD.inspection_time);
     END IF;
     RETURN NULL;
 END;
@@ -280,6 +614,17 @@ CREATE TRIGGER update_defect_count_trigger
 AFTER INSERT OR DELETE ON defect_details
 FOR EACH ROW EXECUTE FUNCTION update_defect_count();
 
+-- Журнал аудита только дополняется
+CREATE OR REPLACE FUNCTION forbid_audit_log_changes()
+RETURNS TRIGGER AS $$
+BEGIN
+    RAISE EXCEPTION 'audit_log is append-only';
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER forbid_audit_log_changes BEFORE UPDATE OR DELETE OR TRUNCATE ON audit_log
+    FOR EACH STATEMENT EXECUTE FUNCTION forbid_audit_log_changes();
+
 -- ============================================
 -- 6. ПРАВА ДОСТУПА
 -- ============================================
@@ -290,6 +635,7 @@ GRANT CONNECT ON DATABASE metal_quality_control TO app_user;
 GRANT USAGE ON SCHEMA public TO app_user;
 GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA public TO app_user;
 GRANT USAGE ON ALL SEQUENCES IN SCHEMA public TO app_user;
+REVOKE UPDATE, DELETE, TRUNCATE ON audit_log FROM app_user;
 
 -- ============================================
 -- СООБЩЕНИЕ ОБ УСПЕШНОМ СОЗДАНИИ
@@ -297,7 +643,7 @@ GRANT USAGE ON ALL SEQUENCES IN SCHEMA public TO app_user;
 DO $$
 BEGIN
     RAISE NOTICE 'База данных "metal_quality_control" успешно создана!';
-    RAISE NOTICE 'Таблиц создано: 8';
+    RAISE NOTICE 'Таблиц создано: 11';
     RAISE NOTICE 'Тестовых записей добавлено:';
     RAISE NOTICE '  - Ролей: 4';
     RAISE NOTICE '  - Пользователей: 3';